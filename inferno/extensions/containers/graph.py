@@ -1,7 +1,9 @@
 from collections import OrderedDict
+import multiprocessing
 
 import networkx as nx
-from networkx import is_directed_acyclic_graph, topological_sort
+from networkx import is_directed_acyclic_graph
+import torch
 from torch import nn as nn
 
 from ...utils import python_utils as pyu
@@ -19,6 +21,109 @@ class Identity(nn.Module):
         return input
 
 
+class ExecutionStep(object):
+    """
+    A step of an `ExecutionPlan`: a node, the slots it reads from and writes to, and the
+    slots that are no longer needed once it has run.
+    """
+    __slots__ = ('name', 'module', 'input_slots', 'output_slots', 'release_slots')
+
+    def __init__(self, name, module, input_slots, output_slots, release_slots=None):
+        self.name = name
+        self.module = module
+        self.input_slots = input_slots
+        self.output_slots = output_slots
+        self.release_slots = [] if release_slots is None else release_slots
+
+    def __repr__(self):
+        return "ExecutionStep(name={}, input_slots={}, output_slots={})"\
+            .format(self.name, self.input_slots, self.output_slots)
+
+
+class RecomputedSegment(object):
+    """
+    A sequence of `ExecutionStep`s that is run with activation checkpointing: the
+    activations inside the segment are not kept for the backward pass, but recomputed.
+    """
+    def __init__(self, steps, input_slots, output_slots):
+        """
+        Parameters
+        ----------
+        steps : list of ExecutionStep
+            Steps in the segment, in topological order.
+        input_slots : list of int
+            Slots read by the segment but written outside of it.
+        output_slots : list of int
+            Slots written by the segment but read outside of it.
+        """
+        self.steps = steps
+        self.input_slots = input_slots
+        self.output_slots = output_slots
+
+    def run(self, *inputs):
+        payloads = dict(zip(self.input_slots, inputs))
+        for step in self.steps:
+            Graph.execute_step(step, payloads)
+        return tuple(payloads[slot] for slot in self.output_slots)
+
+    def __call__(self, *inputs):
+        if not torch.is_grad_enabled():
+            # Nothing to save for backward anyway
+            return self.run(*inputs)
+        from torch.utils.checkpoint import checkpoint
+        return checkpoint(self.run, *inputs, use_reentrant=False)
+
+    def to_step(self):
+        return ExecutionStep(name='+'.join(step.name for step in self.steps),
+                             module=self,
+                             input_slots=self.input_slots,
+                             output_slots=self.output_slots)
+
+
+class ExecutionPlan(object):
+    """
+    A compiled `Graph`: the nodes to run (in order), where every edge is mapped to an
+    integer slot in a list of payloads.
+    """
+    def __init__(self, input_steps, steps, output_slots, num_slots):
+        """
+        Parameters
+        ----------
+        input_steps : list of ExecutionStep
+            Steps for the input nodes, in the order in which the inputs are passed to
+            the forward method.
+        steps : list of ExecutionStep
+            Steps for all other nodes (except output nodes), in topological order.
+        output_slots : list of list of int
+            For every output node, the slots of the incoming edges.
+        num_slots : int
+            Total number of slots (i.e. the number of edges).
+        """
+        self.input_steps = input_steps
+        self.steps = steps
+        self.output_slots = output_slots
+        self.num_slots = num_slots
+        self.levels = self._find_levels()
+
+    def _find_levels(self):
+        # Group the steps by topological level, i.e. the length of the longest path from
+        # the input nodes. Steps in the same level do not depend on each other.
+        slot_levels = {}
+        levels = []
+        for step in self.steps:
+            level = max([slot_levels.get(slot, -1) for slot in step.input_slots] + [-1]) + 1
+            for slot in step.output_slots:
+                slot_levels[slot] = level
+            if level == len(levels):
+                levels.append([])
+            levels[level].append(step)
+        return levels
+
+    def __repr__(self):
+        return "ExecutionPlan(num_steps={}, num_slots={})"\
+            .format(len(self.input_steps) + len(self.steps), self.num_slots)
+
+
 class Graph(nn.Module):
     """
     A graph structure to build networks with complex architectures. The resulting graph model
@@ -67,6 +172,17 @@ class Graph(nn.Module):
             self._graph = graph
         else:
             self._graph = NNGraph()
+        # The execution plan is compiled on demand
+        self._execution_plan = None
+        # Payloads (one per edge, as in the plan) of the last forward pass. These are only
+        # kept around if payloads are never released.
+        self._payloads = None
+        self._release_payloads = 'early'
+        # Nodes whose activations are recomputed in the backward pass
+        self._recomputed_nodes = set()
+        # Thread pool to run independent branches with (built on demand)
+        self._num_branch_workers = None
+        self._branch_executor = None
 
     def is_node_in_graph(self, name):
         """
@@ -204,6 +320,7 @@ class Graph(nn.Module):
         assert isinstance(module, nn.Module)
         self.add_module(name, module)
         self._graph.add_node(name, module=module)
+        self.invalidate_execution_plan()
         if previous is not None:
             for _previous in pyu.to_iterable(previous):
                 self.add_edge(_previous, name)
@@ -225,6 +342,7 @@ class Graph(nn.Module):
             self
         """
         self._graph.add_node(name, module=Identity(), is_input_node=True)
+        self.invalidate_execution_plan()
         return self
 
     def add_output_node(self, name, previous=None):
@@ -243,6 +361,7 @@ class Graph(nn.Module):
             self
         """
         self._graph.add_node(name, is_output_node=True)
+        self.invalidate_execution_plan()
         if previous is not None:
             for _previous in pyu.to_iterable(previous):
                 self.add_edge(_previous, name)
@@ -274,69 +393,361 @@ class Graph(nn.Module):
         assert self.is_node_in_graph(to_node)
         self._graph.add_edge(from_node, to_node)
         assert self.graph_is_valid
+        self.invalidate_execution_plan()
         return self
 
     def apply_on_graph(self, function, *args, **kwargs):
         """Applies a `function` on the internal graph."""
+        # The function might change the structure of the graph
+        self.invalidate_execution_plan()
         return function(self, *args, **kwargs)
 
     def forward_through_node(self, name, input=None):
+        """
+        Runs the module of the node `name` alone. If `input` is not given, the inputs are
+        the payloads of the incoming edges from the last forward pass, which are only
+        kept if payloads are not released (see `release_payloads`). The outputs then
+        replace the payloads of the outgoing edges.
+        """
         # If input is a tuple/list, it will NOT be unpacked.
-        # Make sure the node is in the graph
+        assert self.is_node_in_graph(name)
+        slots = self.get_edge_slots()
+        step = ExecutionStep(name=name, module=self._graph.node[name]['module'],
+                             input_slots=[slots[edge] for edge in self._graph.in_edges(name)],
+                             output_slots=[slots[edge]
+                                           for edge in self._graph.out_edges(name)])
+        payloads = getattr(self, '_payloads', None)
         if input is None:
             # Make sure the node is not a source node
             assert not self.is_source_node(name), \
                 "Node '{}' did not get an input but is a source node.".format(name)
-            # Get input from payload
-            incoming_edges = self._graph.in_edges(name)
-            input = [self._graph[incoming][this]['payload']
-                     for incoming, this in incoming_edges]
+            assert payloads is not None, \
+                "No payloads to forward through node '{}', call " \
+                "release_payloads('never') before the forward pass.".format(name)
+        elif payloads is None:
+            # The outputs are not kept
+            payloads = [None] * len(slots)
+        return pyu.from_iterable(self.execute_step(step, payloads, input=input))
+
+    def invalidate_execution_plan(self):
+        """
+        Drops the compiled execution plan. This is called whenever the structure of the
+        graph changes, and must be called manually if the internal graph (`Graph._graph`) is
+        modified directly.
+        """
+        self._execution_plan = None
+        return self
+
+    @property
+    def releasing_payloads(self):
+        # Graphs loaded from pickle files might not have the attribute
+        return getattr(self, '_release_payloads', 'never')
+
+    def release_payloads(self, when='early'):
+        """
+        Sets when the payloads (i.e. the intermediate activations) are released in the
+        forward pass.
+
+        Parameters
+        ----------
+        when : {'early', 'after_forward', 'never'}
+            If 'early', every payload is released as soon as the last node consuming it
+            has run. If 'after_forward', all payloads are released once the forward pass
+            is done. If 'never', the payloads of the last forward pass are kept around
+            (as `Graph._payloads`) until the next one.
+
+        Returns
+        -------
+        Graph
+            self.
+        """
+        assert when in ['early', 'after_forward', 'never'], \
+            "`when` must be one of 'early', 'after_forward' or 'never', got {}.".format(when)
+        self._release_payloads = when
+        return self
+
+    @property
+    def recomputed_nodes(self):
+        # Graphs loaded from pickle files might not have the attribute
+        return getattr(self, '_recomputed_nodes', set())
+
+    def recompute(self, names):
+        """
+        Marks nodes for recomputation (activation checkpointing): their activations are
+        not stored for the backward pass, but recomputed from their inputs when required.
+        This trades compute for memory. Consecutive nodes (in the order of execution)
+        are recomputed together, such that only the inputs of the segment are stored.
+
+        Parameters
+        ----------
+        names : str or list of str
+            Name(s) of the node(s) to recompute.
+
+        Returns
+        -------
+        Graph
+            self.
+        """
+        names = pyu.to_iterable(names)
+        for name in names:
+            assert self.is_node_in_graph(name), "Node '{}' is not in graph.".format(name)
+            assert not self._graph.node[name].get('is_input_node', False) and \
+                not self._graph.node[name].get('is_output_node', False), \
+                "Input and output nodes can not be recomputed (node '{}').".format(name)
+        self._recomputed_nodes = self.recomputed_nodes | set(names)
+        self.invalidate_execution_plan()
+        return self
+
+    def recompute_path(self, from_node, to_node):
+        """
+        Marks all nodes on the paths between `from_node` and `to_node` (both included) for
+        recomputation. See `Graph.recompute` for more.
+
+        Parameters
+        ----------
+        from_node : str
+            Name of the first node.
+        to_node : str
+            Name of the last node.
+
+        Returns
+        -------
+        Graph
+            self.
+        """
+        assert self.is_node_in_graph(from_node)
+        assert self.is_node_in_graph(to_node)
+        assert nx.has_path(self._graph, from_node, to_node), \
+            "There is no path from '{}' to '{}'.".format(from_node, to_node)
+        on_path = (nx.descendants(self._graph, from_node) &
+                   nx.ancestors(self._graph, to_node)) | {from_node, to_node}
+        return self.recompute(list(on_path))
+
+    def stop_recomputing(self):
+        """Makes sure that no node is recomputed."""
+        self._recomputed_nodes = set()
+        self.invalidate_execution_plan()
+        return self
+
+    @property
+    def parallelizing_branches(self):
+        # Graphs loaded from pickle files might not have the attribute
+        return getattr(self, '_num_branch_workers', None) is not None
+
+    def parallelize_branches(self, num_workers=None):
+        """
+        Run independent nodes (i.e. nodes at the same topological level) concurrently on
+        a thread pool. Since most PyTorch operations release the GIL, this can speed up
+        graphs with parallel branches (like the inception module).
+
+        Parameters
+        ----------
+        num_workers : int or bool
+            Number of threads. Defaults to the number of CPUs. Set to 0 (or False) to run
+            all nodes on the calling thread.
+
+        Returns
+        -------
+        Graph
+            self.
+        """
+        if num_workers is None or num_workers is True:
+            num_workers = multiprocessing.cpu_count()
+        assert num_workers >= 0
+        # Shut down the current executor
+        if getattr(self, '_branch_executor', None) is not None:
+            self._branch_executor.shutdown()
+            self._branch_executor = None
+        self._num_branch_workers = int(num_workers) if num_workers > 0 else None
+        return self
+
+    @property
+    def branch_executor(self):
+        """Gets the thread pool for running branches, which is built if required."""
+        assert self.parallelizing_branches, "Branches are not parallelized."
+        if getattr(self, '_branch_executor', None) is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._branch_executor = ThreadPoolExecutor(max_workers=self._num_branch_workers)
+        return self._branch_executor
+
+    def __getstate__(self):
+        # Thread pools can't be pickled (or deep-copied)
+        state = self.__dict__.copy()
+        state['_branch_executor'] = None
+        return state
+
+    def toposort(self):
+        """
+        Sorts the nodes topologically. Ties are broken by the order in which the nodes
+        were added, which makes the order deterministic.
+
+        Returns
+        -------
+        list
+            List of node names.
+        """
+        in_degrees = OrderedDict((name, self._graph.in_degree(name))
+                                 for name in self._graph.nodes())
+        ready = [name for name, in_degree in in_degrees.items() if in_degree == 0]
+        toposorted = []
+        while ready:
+            name = ready.pop(0)
+            toposorted.append(name)
+            for _, successor in self._graph.out_edges(name):
+                in_degrees[successor] -= 1
+                if in_degrees[successor] == 0:
+                    ready.append(successor)
+        assert len(toposorted) == len(in_degrees), "Graph is not a DAG."
+        return toposorted
+
+    def get_edge_slots(self):
+        """Gets the slots (in the payloads of an `ExecutionPlan`) of all edges."""
+        return {edge: slot for slot, edge in enumerate(self._graph.edges())}
+
+    def compile_execution_plan(self):
+        """
+        Validates the graph and compiles it to an `ExecutionPlan`, where every edge is
+        assigned an integer slot for its payload.
+
+        Returns
+        -------
+        ExecutionPlan
+        """
+        self.assert_graph_is_valid()
+        input_nodes = self.input_nodes
+        output_nodes = self.output_nodes
+        slots = self.get_edge_slots()
+
+        def make_step(name):
+            return ExecutionStep(name=name,
+                                 module=self._graph.node[name]['module'],
+                                 input_slots=[slots[edge]
+                                              for edge in self._graph.in_edges(name)],
+                                 output_slots=[slots[edge]
+                                               for edge in self._graph.out_edges(name)])
+
+        input_steps = [make_step(name) for name in input_nodes]
+        steps = []
+        for name in self.toposort():
+            if name in input_nodes or name in output_nodes:
+                continue
+            # Make sure the node is not a source node
+            assert not self.is_source_node(name), \
+                "Node '{}' did not get an input but is a source node.".format(name)
+            steps.append(make_step(name))
+        output_slots = [[slots[edge] for edge in self._graph.in_edges(name)]
+                        for name in output_nodes]
+        if self.recomputed_nodes:
+            steps = self._group_recomputed_steps(steps)
+        # Liveness analysis: find the last step reading from every slot. Slots read by the
+        # output nodes must live until the end of the forward pass.
+        last_readers = {}
+        for step in steps:
+            for slot in step.input_slots:
+                last_readers[slot] = step
+        for slot in (slot for slots_ in output_slots for slot in slots_):
+            last_readers.pop(slot, None)
+        for slot, step in last_readers.items():
+            step.release_slots.append(slot)
+        return ExecutionPlan(input_steps=input_steps, steps=steps,
+                             output_slots=output_slots, num_slots=len(slots))
+
+    def _group_recomputed_steps(self, steps):
+        # Replace runs of consecutive recomputed steps with a single step running them
+        # as a `RecomputedSegment`.
+        recomputed_nodes = self.recomputed_nodes
+        grouped_steps = []
+        run = []
+        for step in steps + [None]:
+            if step is not None and step.name in recomputed_nodes:
+                run.append(step)
+                continue
+            if run:
+                written = [slot for step_ in run for slot in step_.output_slots]
+                read = [slot for step_ in run for slot in step_.input_slots]
+                segment = RecomputedSegment(steps=run,
+                                            input_slots=[slot for slot in read
+                                                         if slot not in written],
+                                            output_slots=[slot for slot in written
+                                                          if slot not in read])
+                grouped_steps.append(segment.to_step())
+                run = []
+            if step is not None:
+                grouped_steps.append(step)
+        return grouped_steps
+
+    @property
+    def execution_plan(self):
+        """Gets the execution plan, which is compiled if required."""
+        if getattr(self, '_execution_plan', None) is None:
+            self._execution_plan = self.compile_execution_plan()
+        return self._execution_plan
+
+    @staticmethod
+    def execute_step(step, payloads, input=None):
+        # If input is a tuple/list, it will NOT be unpacked.
+        if input is None:
+            input = [payloads[slot] for slot in step.input_slots]
         else:
-            assert self.is_node_in_graph(name)
-            # Convert input to list
             input = [input]
         # Get outputs
-        outputs = pyu.to_iterable(self._graph.node[name]['module'](*input))
+        outputs = pyu.to_iterable(step.module(*input))
         # Distribute outputs to outgoing payloads if required
-        if not self.is_sink_node(name):
-            outgoing_edges = self._graph.out_edges(name)
+        if step.output_slots:
             if len(outputs) == 1:
                 # Support for replication
-                outputs *= len(outgoing_edges)
+                outputs = list(outputs) * len(step.output_slots)
             # Make sure the number of outputs check out
-            assert len(outputs) == len(outgoing_edges), \
+            assert len(outputs) == len(step.output_slots), \
                 "Number of outputs from the model ({}) does not match the number " \
-                "of out-edges ({}) in the graph for this node ('{}').".format(len(outputs),
-                                                                              len(outgoing_edges),
-                                                                              name)
-            for (this, outgoing), output in zip(outgoing_edges, outputs):
-                self._graph[this][outgoing].update({'payload': output})
-        # Return outputs
-        return pyu.from_iterable(outputs)
+                "of out-edges ({}) in the graph for this node ('{}')."\
+                .format(len(outputs), len(step.output_slots), step.name)
+            for slot, output in zip(step.output_slots, outputs):
+                payloads[slot] = output
+        return outputs
 
     def forward(self, *inputs):
-        self.assert_graph_is_valid()
-        input_nodes = self.input_nodes
-        output_nodes = self.output_nodes
-        assert len(inputs) == len(input_nodes), "Was expecting {} " \
-                                                "arguments for as many input nodes, got {}."\
-            .format(len(input_nodes), len(inputs))
+        plan = self.execution_plan
+        assert len(inputs) == len(plan.input_steps), "Was expecting {} " \
+                                                     "arguments for as many input nodes, " \
+                                                     "got {}."\
+            .format(len(plan.input_steps), len(inputs))
+        payloads = [None] * plan.num_slots
         # Unpack inputs to input nodes
-        for input, input_node in zip(inputs, input_nodes):
-            self.forward_through_node(input_node, input=input)
-        # Toposort the graph
-        toposorted = topological_sort(self._graph)
-        # Remove all input and output nodes
-        toposorted = [name for name in toposorted
-                      if name not in input_nodes and name not in output_nodes]
+        for input, input_step in zip(inputs, plan.input_steps):
+            self.execute_step(input_step, payloads, input=input)
         # Forward
-        for node in toposorted:
-            self.forward_through_node(node)
+        release_early = self.releasing_payloads == 'early'
+
+        def run_step(step):
+            self.execute_step(step, payloads)
+            if release_early:
+                for slot in step.release_slots:
+                    payloads[slot] = None
+
+        if self.parallelizing_branches:
+            # Grad mode is thread local, so it must be passed on to the workers
+            grad_enabled = torch.is_grad_enabled()
+
+            def run_step_in_worker(step):
+                with torch.set_grad_enabled(grad_enabled):
+                    run_step(step)
+
+            for level in plan.levels:
+                if len(level) == 1:
+                    run_step(level[0])
+                else:
+                    futures = [self.branch_executor.submit(run_step_in_worker, step)
+                               for step in level]
+                    # This raises the exceptions from the workers, if any
+                    for future in futures:
+                        future.result()
+        else:
+            for step in plan.steps:
+                run_step(step)
         # Read outputs from output nodes
-        outputs = []
-        for output_node in output_nodes:
-            # Get all incoming edges to output node
-            outputs_from_node = [self._graph[incoming][this]['payload']
-                                 for incoming, this in self._graph.in_edges(output_node)]
-            outputs.append(pyu.from_iterable(outputs_from_node))
-        return pyu.from_iterable(outputs)
\ No newline at end of file
+        outputs = [pyu.from_iterable([payloads[slot] for slot in slots])
+                   for slots in plan.output_slots]
+        # Keep the payloads around until the next forward pass if required
+        self._payloads = payloads if self.releasing_payloads == 'never' else None
+        return pyu.from_iterable(outputs)
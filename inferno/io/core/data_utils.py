@@ -1,3 +1,5 @@
+import numpy as np
+
 
 def implements_sync_primitives(dataset):
     return hasattr(dataset, 'sync_with') and callable(getattr(dataset, 'sync_with'))
@@ -5,3 +7,71 @@ def implements_sync_primitives(dataset):
 
 def defines_base_sequence(dataset):
     return hasattr(dataset, 'base_sequence') and dataset.base_sequence is not None
+
+
+class ZippedSequence(object):
+    """Like `zip(*sequences)`, but lazy and indexable (and without making a list)."""
+    def __init__(self, *sequences):
+        assert len(sequences) >= 1
+        self.sequences = sequences
+
+    def __len__(self):
+        return min([len(sequence) for sequence in self.sequences])
+
+    def __getitem__(self, index):
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Index {} is out of range.".format(index))
+        return tuple(sequence[index] for sequence in self.sequences)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def find_seedable_transforms(dataset):
+    """
+    Finds the transforms (see `inferno.io.transform.Transform.set_seed`) of `dataset`
+    and of the datasets it's made of (e.g. for `Zip` or `Concatenate`), in a fixed order.
+    """
+    found = []
+    transforms = getattr(dataset, 'transforms', None)
+    if callable(getattr(transforms, 'set_seed', None)):
+        found.append(transforms)
+    for sub_dataset in getattr(dataset, 'datasets', None) or []:
+        found.extend(find_seedable_transforms(sub_dataset))
+    return found
+
+
+def seed_transforms(dataset, seed):
+    """Seeds the transforms of `dataset`, each with an independent seed spawned from `seed`."""
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    transforms = find_seedable_transforms(dataset)
+    for transform, child_seed in zip(transforms, seed.spawn(len(transforms))):
+        transform.set_seed(child_seed)
+    return dataset
+
+
+def seed_worker(worker_id, seed=None):
+    """
+    Seeds the transforms of the dataset of a `torch.utils.data.DataLoader` worker, to be
+    used as its `worker_init_fn`. By default, the seed is the one torch draws for the
+    worker (which changes from epoch to epoch, and is reproducible with
+    `torch.manual_seed`). A fixed `seed` (with `functools.partial`) replays the same
+    augmentations in every epoch, which is useful for debugging.
+
+    Examples
+    --------
+        >>> loader = DataLoader(dataset, num_workers=4, worker_init_fn=seed_worker)
+        >>> loader = DataLoader(dataset, num_workers=4,
+        >>>                     worker_init_fn=functools.partial(seed_worker, seed=42))
+
+    """
+    from torch.utils.data import get_worker_info
+    worker_info = get_worker_info()
+    assert worker_info is not None, "seed_worker must be called in a DataLoader worker."
+    seed = worker_info.seed if seed is None else [seed, worker_id]
+    seed_transforms(worker_info.dataset, seed)
@@ -13,7 +13,7 @@ class Zip(SyncableDataset):
     # arguments, becuase the former is NOT python 2.7 compatible
     def __init__(self, *datasets, **kwargs):
         sync = kwargs.get('sync', False)
-        sync = kwargs.get('transforms', None)
+        transforms = kwargs.get('transforms', None)
         super(Zip, self).__init__()
         assert len(datasets) >= 1
         assert all([isinstance(dataset, Dataset) for dataset in datasets])
@@ -25,7 +25,8 @@ class Zip(SyncableDataset):
             self.sync_datasets()
         # Inherit base sequence if sync'ing
         if self.sync and all([du.defines_base_sequence(dataset) for dataset in self.datasets]):
-            self.base_sequence = list(zip(*[dataset.base_sequence for dataset in self.datasets]))
+            self.base_sequence = du.ZippedSequence(*[dataset.base_sequence
+                                                     for dataset in self.datasets])
         else:
             self.base_sequence = None
 
@@ -1,3 +1,4 @@
+import os
 from ...utils import python_utils as pyu
 import numpy as np
 
@@ -16,17 +17,98 @@ class Transform(object):
     For example, if both `volume_function` and `image_function` are defined, this means that
     only the former will be called. If the inputs are therefore not 5D batch-tensors of 3D
     volumes, a `NotImplementedError` is raised.
+
+    By default, `image_function` (`volume_function`) is called for every image (volume)
+    along the leading (e.g. batch and channel) axes of a tensor, and the results are
+    written to one output array. Transforms whose `image_function` (`volume_function`)
+    operates on the last two (three) axes of arrays with arbitrary leading axes should
+    set `BROADCASTS_OVER_LEADING_AXES` to True, in which case it's called once on the
+    entire tensor.
+
+    Elementwise transforms (like `Cast` or `Normalize`) can set `ELEMENTWISE` to True and
+    implement `elementwise_function(tensor, out)` and `elementwise_output_dtype(dtype)`,
+    which allows `Compose` to run consecutive elementwise transforms in one buffer.
+
+    Random transforms draw their random variables from `rng`, a `numpy.random.Generator`
+    owned by the transform. If the transform is seeded (with `seed` or `set_seed`), every
+    `torch.utils.data.DataLoader` worker it's sent to gets its own stream, spawned from
+    the seed with the worker id, such that runs are reproducible. Unseeded transforms are
+    seeded from the operating system once per process. See also
+    `inferno.io.core.data_utils.seed_worker`.
     """
-    def __init__(self, apply_to=None):
+    BROADCASTS_OVER_LEADING_AXES = False
+    ELEMENTWISE = False
+
+    def __init__(self, apply_to=None, seed=None):
         """
         Parameters
         ----------
         apply_to : list or tuple
             Indices of tensors to apply this transform to. The indices are with respect
             to the list of arguments this object is called with.
+        seed : int or list of int or numpy.random.SeedSequence
+            Seed of the random number generator (optional, see `set_seed`).
         """
         self._random_variables = {}
         self._apply_to = list(apply_to) if apply_to is not None else None
+        self._rng = None
+        self._rng_pid = None
+        self._seed_sequence = None
+        if seed is not None:
+            self.set_seed(seed)
+
+    @property
+    def rng(self):
+        """
+        Gets the random number generator. If the generator was not made in this process
+        (e.g. in a DataLoader worker), it's made again: from the seed (spawned with the
+        worker id in workers, such that workers don't share random streams), or from the
+        operating system if the transform was never seeded.
+        """
+        # Transforms loaded from pickle files might not have the attribute
+        if getattr(self, '_rng', None) is None or self._rng_pid != os.getpid():
+            seed_sequence = getattr(self, '_seed_sequence', None)
+            if seed_sequence is not None:
+                worker_id = self._get_worker_id()
+                if worker_id is not None:
+                    seed_sequence = np.random.SeedSequence(
+                        seed_sequence.entropy,
+                        spawn_key=tuple(seed_sequence.spawn_key) + (worker_id,))
+            self._rng = np.random.default_rng(seed_sequence)
+            self._rng_pid = os.getpid()
+        return self._rng
+
+    @staticmethod
+    def _get_worker_id():
+        # Id of the DataLoader worker we're in (None if not in a worker)
+        try:
+            from torch.utils.data import get_worker_info
+        except ImportError:
+            return None
+        worker_info = get_worker_info()
+        return None if worker_info is None else worker_info.id
+
+    def set_seed(self, seed):
+        """
+        Seeds the random number generator.
+
+        Parameters
+        ----------
+        seed : int or list of int or numpy.random.SeedSequence
+            The seed. To replay the random variables of a sample, use the seed (e.g.
+            `[seed, worker_id]`) it was drawn with.
+
+        Returns
+        -------
+        Transform
+            self.
+        """
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self._seed_sequence = seed
+        self._rng = np.random.default_rng(seed)
+        self._rng_pid = os.getpid()
+        return self
 
     def build_random_variables(self, **kwargs):
         pass
@@ -48,6 +130,22 @@ class Transform(object):
     def set_random_variable(self, key, value):
         self._random_variables.update({key: value})
 
+    def applies_to(self, tensor_index):
+        """Whether the transform applies to the tensor at `tensor_index`."""
+        return self._apply_to is None or tensor_index in self._apply_to
+
+    def elementwise_function(self, tensor, out):
+        """
+        Applies the (elementwise) transform on `tensor` and writes the result to `out`,
+        which has the shape of `tensor` and the data type given by
+        `elementwise_output_dtype`. Note that `out` might be `tensor` itself.
+        """
+        raise NotImplementedError
+
+    def elementwise_output_dtype(self, dtype):
+        """Gets the data type of the result of `elementwise_function`."""
+        raise NotImplementedError
+
     def __call__(self, *tensors):
         tensors = pyu.to_iterable(tensors)
         # Get the list of the indices of the tensors to which we're going to apply the transform
@@ -78,43 +176,52 @@ class Transform(object):
             raise NotImplementedError
 
     def _apply_image_function(self, tensor):
-        # 2D case
-        if tensor.ndim == 4:
-            return np.array([np.array([getattr(self, 'image_function')(image)
-                                       for image in channel_image])
-                             for channel_image in tensor])
-        # 3D case
-        elif tensor.ndim == 5:
-            return np.array([np.array([np.array([getattr(self, 'image_function')(image)
-                                                 for image in volume])
-                                       for volume in channel_volume])
-                             for channel_volume in tensor])
-        elif tensor.ndim == 3:
-            # Assume we have a 3D volume (signature zyx) and apply the image function
-            # on all yx slices.
-            return np.array([getattr(self, 'image_function')(image) for image in tensor])
-        elif tensor.ndim == 2:
-            # Assume we really do have an image.
-            return getattr(self, 'image_function')(tensor)
-        else:
+        # Images are 2D, and we expect the signature (N, C, [Z,] Y, X) for batches.
+        if tensor.ndim < 2 or tensor.ndim > 5:
             raise NotImplementedError
+        return self._apply_on_trailing_axes(getattr(self, 'image_function'), tensor, 2)
 
     def _apply_volume_function(self, tensor):
-        # 3D case
-        if tensor.ndim == 5:
-            return np.array([np.array([np.array([getattr(self, 'volume_function')(volume)
-                                                 for volume in channel_volume])
-                                       for channel_volume in batch])
-                             for batch in tensor])
-        elif tensor.ndim == 3:
-            # We're applying the volume function on the volume itself
-            return getattr(self, 'volume_function')(tensor)
-        else:
+        # Volumes are 3D, and we expect the signature (N, C, Z, Y, X) for batches.
+        if tensor.ndim not in [3, 4, 5]:
             raise NotImplementedError
+        return self._apply_on_trailing_axes(getattr(self, 'volume_function'), tensor, 3)
+
+    def __getstate__(self):
+        # The generator of this process is not sent to others, which make their own from
+        # the seed (see `rng`)
+        state = self.__dict__.copy()
+        state.update({'_rng': None, '_rng_pid': None})
+        return state
+
+    def _apply_on_trailing_axes(self, function, tensor, num_axes):
+        num_leading_axes = tensor.ndim - num_axes
+        if num_leading_axes == 0:
+            return function(tensor)
+        if self.BROADCASTS_OVER_LEADING_AXES:
+            # Like the loop below, make sure the output is a (contiguous) array and not
+            # a view with negative strides (e.g. from flips), which torch can't handle.
+            return np.ascontiguousarray(function(tensor))
+        # Loop over the leading axes and write to a preallocated output
+        leading_shape = tensor.shape[:num_leading_axes]
+        output = None
+        for index in np.ndindex(*leading_shape):
+            result = np.asarray(function(tensor[index]))
+            if output is None:
+                output = np.empty(leading_shape + result.shape, dtype=result.dtype)
+            output[index] = result
+        return output
 
 
 class Compose(object):
-    """Composes multiple callables (including but not limited to `Transform` objects)."""
+    """
+    Composes multiple callables (including but not limited to `Transform` objects).
+
+    Runs of consecutive elementwise transforms (see `Transform`) on numpy arrays are fused:
+    the first transform in a run writes to a new buffer, and the others work on it in
+    place (unless they change the data type). Set `fuse_elementwise` to False to run
+    every transform on its own.
+    """
     def __init__(self, *transforms):
         """
         Parameters
@@ -124,14 +231,84 @@ class Compose(object):
         """
         assert all([callable(transform) for transform in transforms])
         self.transforms = list(transforms)
+        self.fuse_elementwise = True
 
     def add(self, transform):
         assert callable(transform)
         self.transforms.append(transform)
         return self
 
+    def set_seed(self, seed):
+        """
+        Seeds the transforms (see `Transform.set_seed`), each with an independent seed
+        spawned from `seed`. Callables that can't be seeded are skipped.
+        """
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        for transform, child_seed in zip(self.transforms, seed.spawn(len(self.transforms))):
+            if callable(getattr(transform, 'set_seed', None)):
+                transform.set_seed(child_seed)
+        return self
+
+    @staticmethod
+    def _is_elementwise(transform):
+        return isinstance(transform, Transform) and transform.ELEMENTWISE
+
+    def get_fused_transforms(self):
+        """
+        Groups the transforms, such that runs of (at least two) consecutive elementwise
+        transforms are in lists.
+        """
+        # Composes loaded from pickle files might not have the attribute
+        if not getattr(self, 'fuse_elementwise', True):
+            return list(self.transforms)
+        fused, run = [], []
+        for transform in self.transforms + [None]:
+            if transform is not None and self._is_elementwise(transform):
+                run.append(transform)
+                continue
+            if len(run) > 1:
+                fused.append(run)
+            else:
+                fused.extend(run)
+            run = []
+            if transform is not None:
+                fused.append(transform)
+        return fused
+
+    @staticmethod
+    def apply_elementwise(transforms, tensors):
+        """Applies elementwise transforms on (numpy) tensors, in one buffer per tensor."""
+        # Like in `Transform.__call__`, random variables are built for every call
+        for transform in transforms:
+            transform.clear_random_variables()
+        transformed = []
+        for tensor_index, tensor in enumerate(tensors):
+            # We don't own the input, so we must not write to it
+            current, owned = tensor, False
+            for transform in transforms:
+                if not transform.applies_to(tensor_index):
+                    continue
+                dtype = np.dtype(transform.elementwise_output_dtype(current.dtype))
+                if owned and dtype == current.dtype:
+                    out = current
+                else:
+                    out = np.empty(current.shape, dtype=dtype)
+                current = transform.elementwise_function(current, out)
+                owned = True
+            transformed.append(current)
+        return transformed
+
     def __call__(self, *tensors):
         intermediate = tensors
-        for transform in self.transforms:
-            intermediate = pyu.to_iterable(transform(*intermediate))
+        for transform in self.get_fused_transforms():
+            if isinstance(transform, list):
+                if all([isinstance(tensor, np.ndarray) for tensor in intermediate]):
+                    intermediate = self.apply_elementwise(transform, intermediate)
+                else:
+                    # Fall back to running the transforms one by one
+                    for _transform in transform:
+                        intermediate = pyu.to_iterable(_transform(*intermediate))
+            else:
+                intermediate = pyu.to_iterable(transform(*intermediate))
         return pyu.from_iterable(intermediate)
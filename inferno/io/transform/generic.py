@@ -5,6 +5,8 @@ from .base import Transform
 
 class Normalize(Transform):
     """Normalizes input to zero mean unit variance."""
+    ELEMENTWISE = True
+
     def __init__(self, eps=1e-4, **super_kwargs):
         """
         Parameters
@@ -21,9 +23,20 @@ class Normalize(Transform):
         tensor = (tensor - tensor.mean())/(tensor.std() + self.eps)
         return tensor
 
+    def elementwise_output_dtype(self, dtype):
+        return dtype if np.issubdtype(dtype, np.floating) else np.dtype('float64')
+
+    def elementwise_function(self, tensor, out):
+        mean, std = tensor.mean(), tensor.std()
+        np.subtract(tensor, mean, out=out)
+        np.divide(out, std + self.eps, out=out)
+        return out
+
 
 class NormalizeRange(Transform):
     """Normalizes input by a constant."""
+    ELEMENTWISE = True
+
     def __init__(self, normalize_by=255., **super_kwargs):
         """
         Parameters
@@ -39,9 +52,16 @@ class NormalizeRange(Transform):
     def tensor_function(self, tensor):
         return tensor / self.normalize_by
 
+    def elementwise_output_dtype(self, dtype):
+        return dtype if np.issubdtype(dtype, np.floating) else np.dtype('float64')
+
+    def elementwise_function(self, tensor, out):
+        return np.true_divide(tensor, self.normalize_by, out=out)
+
 
 class Cast(Transform):
     """Casts inputs to a specified datatype."""
+    ELEMENTWISE = True
     DTYPE_MAPPING = {'float32': 'float32',
                      'float': 'float32',
                      'double': 'float64',
@@ -65,6 +85,14 @@ class Cast(Transform):
     def tensor_function(self, tensor):
         return getattr(np, self.dtype)(tensor)
 
+    def elementwise_output_dtype(self, dtype):
+        return np.dtype(self.dtype)
+
+    def elementwise_function(self, tensor, out):
+        if out is not tensor:
+            np.copyto(out, tensor, casting='unsafe')
+        return out
+
 
 class AsTorchBatch(Transform):
     """Converts a given numpy array to a torch batch tensor.
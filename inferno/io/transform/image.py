@@ -6,22 +6,58 @@ from .base import Transform
 
 
 class ElasticTransform(Transform):
-    """Random Elastic Transformation."""
+    """
+    Random Elastic Transformation.
+
+    With `fast=True`, the displacement field is drawn at a coarse resolution, smoothed
+    there and upsampled (linearly, one axis at a time) to the resolution of the image,
+    which is much cheaper than smoothing at full resolution. The field is made once per
+    call and shared by all images of a stack, and the sampling grid and coordinate buffer
+    are reused between calls (as long as the image shape doesn't change).
+    """
     NATIVE_DTYPES = {'float32', 'float64'}
     PREFERRED_DTYPE = 'float32'
 
-    def __init__(self, alpha, sigma, order=1, invert=False, **super_kwargs):
+    def __init__(self, alpha, sigma, order=1, invert=False, fast=False, coarsening=None,
+                 **super_kwargs):
+        """
+        Parameters
+        ----------
+        alpha : float
+            Strength of the deformation.
+        sigma : float or list of float
+            Smoothness of the deformation (standard deviation of the Gaussian the random
+            field is smoothed with, in pixels). Can be given per axis if `fast`.
+        order : int
+            Order of the spline interpolation (0 for labels).
+        invert : bool
+            Whether to invert the displacement.
+        fast : bool
+            Whether to make the displacement field at a coarse resolution.
+        coarsening : int or list of int
+            Factor (per axis) by which the coarse field is smaller than the image (if
+            `fast`). Defaults to `sigma / 2`, such that the field is still smoothed over 2
+            pixels at the coarse resolution.
+        """
         self._initial_dtype = None
         super(ElasticTransform, self).__init__(**super_kwargs)
         self.alpha = alpha
         self.sigma = sigma
         self.order = order
         self.invert = invert
+        self.fast = fast
+        self.coarsening = coarsening
+        self._grid = None
+        self._coordinates = None
 
     def build_random_variables(self, **kwargs):
-        np.random.seed()
-        self.set_random_variable('random_field_x', np.random.uniform(-1, 1, kwargs.get('imshape')))
-        self.set_random_variable('random_field_y', np.random.uniform(-1, 1, kwargs.get('imshape')))
+        # Transforms loaded from pickle files might not have the attribute
+        if getattr(self, 'fast', False):
+            self.set_random_variable('displacement',
+                                     self.make_displacement(kwargs.get('imshape')))
+            return
+        self.set_random_variable('random_field_x', self.rng.uniform(-1, 1, kwargs.get('imshape')))
+        self.set_random_variable('random_field_y', self.rng.uniform(-1, 1, kwargs.get('imshape')))
 
     def cast(self, image):
         if image.dtype not in self.NATIVE_DTYPES:
@@ -35,7 +71,88 @@ class ElasticTransform(Transform):
         self._initial_dtype = None
         return image
 
+    def get_sigmas(self, ndim):
+        return [float(sigma) for sigma in np.broadcast_to(self.sigma, (ndim,))]
+
+    def get_coarsening(self, ndim):
+        if self.coarsening is not None:
+            return [int(factor) for factor in np.broadcast_to(self.coarsening, (ndim,))]
+        return [max(1, int(sigma // 2)) for sigma in self.get_sigmas(ndim)]
+
+    def get_grid(self, shape):
+        """Gets the (cached) grid of pixel coordinates for images of `shape`."""
+        shape = tuple(shape)
+        grid = getattr(self, '_grid', None)
+        if grid is None or grid.shape[1:] != shape:
+            grid = self._grid = np.indices(shape, dtype='float32')
+            self._coordinates = np.empty_like(grid)
+        return grid
+
+    def get_coordinate_buffer(self, shape):
+        """Gets the (reused) buffer for the coordinates to sample images of `shape` at."""
+        self.get_grid(shape)
+        return self._coordinates
+
+    @staticmethod
+    def _upsampling_matrix(size, coarse_size, factor):
+        # Linear interpolation from the coarse pixels (the coarse pixel i is at the pixel
+        # i * factor) to all pixels along an axis
+        positions = np.arange(size, dtype='float32') / factor
+        lower = np.minimum(np.floor(positions).astype('int64'), coarse_size - 2)
+        weights = positions - lower
+        matrix = np.zeros((size, coarse_size), dtype='float32')
+        matrix[np.arange(size), lower] = 1 - weights
+        matrix[np.arange(size), lower + 1] = weights
+        return matrix
+
+    def make_displacement(self, shape):
+        """
+        Makes a smooth random displacement field of shape `(len(shape),) + shape`, at a
+        coarse resolution.
+        """
+        ndim = len(shape)
+        factors = self.get_coarsening(ndim)
+        coarse_shape = [max(-(-(size - 1) // factor) + 1, 2)
+                        for size, factor in zip(shape, factors)]
+        fields = self.rng.uniform(-1, 1, [ndim] + coarse_shape).astype('float32')
+        # Smoothed white noise has a standard deviation proportional to the product of
+        # sigma ** (-1 / 2) over the axes, so the coarse field is scaled to match a field
+        # smoothed at full resolution.
+        scale = self.alpha / np.sqrt(np.prod(factors))
+        coarse_sigmas = [sigma / factor
+                         for sigma, factor in zip(self.get_sigmas(ndim), factors)]
+        # The field is smooth, so upsampling it linearly (and separably) is good enough
+        matrices = [self._upsampling_matrix(size, coarse_size, factor)
+                    for size, coarse_size, factor in zip(shape, coarse_shape, factors)]
+        displacement = np.empty([ndim] + list(shape), dtype='float32')
+        for axis, field in enumerate(fields):
+            upsampled = gaussian_filter(field, sigma=coarse_sigmas, mode='reflect')
+            # Upsample the last axis (which moves to the front) until all axes are done
+            for matrix in reversed(matrices):
+                upsampled = np.tensordot(matrix, upsampled, axes=([1], [ndim - 1]))
+            np.multiply(upsampled, scale, out=displacement[axis])
+        return displacement
+
+    def deform(self, image, order=None):
+        """
+        Deforms `image` with the displacement (see `make_displacement`) of this call, with
+        splines of `order` (defaults to `self.order`).
+        """
+        order = self.order if order is None else order
+        if order > 0:
+            # Nearest neighbour interpolation works with any dtype (e.g. for labels)
+            image = self.cast(image)
+        displacement = self.get_random_variable('displacement', imshape=image.shape)
+        _inverter = 1. if not self.invert else -1.
+        coordinates = np.multiply(displacement, _inverter,
+                                  out=self.get_coordinate_buffer(image.shape))
+        coordinates += self.get_grid(image.shape)
+        transformed_image = map_coordinates(image, coordinates, mode='reflect', order=order)
+        return self.uncast(transformed_image)
+
     def image_function(self, image):
+        if getattr(self, 'fast', False):
+            return self.deform(image)
         # Cast image to one of the native dtypes (one which that is supported by scipy)
         image = self.cast(image)
         # Take measurements
@@ -59,64 +176,135 @@ class ElasticTransform(Transform):
         transformed_image = self.uncast(transformed_image)
         return transformed_image
 
+    def __getstate__(self):
+        # The grid and buffer are not worth pickling
+        state = super(ElasticTransform, self).__getstate__()
+        state.update({'_grid': None, '_coordinates': None})
+        return state
+
+
+class ElasticTransform3D(ElasticTransform):
+    """
+    Random elastic transformation of 3D volumes, with one smooth 3D displacement field
+    (made at a coarse resolution, see `ElasticTransform`) per call. Every volume is
+    resampled with one `map_coordinates` call, and label volumes (`label_indices`) are
+    resampled with the same field, but with nearest neighbour interpolation.
+    """
+    def __init__(self, alpha, sigma, order=1, invert=False, coarsening=None,
+                 label_indices=None, **super_kwargs):
+        """
+        Parameters
+        ----------
+        alpha : float
+            Strength of the deformation.
+        sigma : float or list of float
+            Smoothness of the deformation in pixels, per axis for anisotropic volumes.
+        order : int
+            Order of the spline interpolation of (non-label) volumes.
+        invert : bool
+            Whether to invert the displacement.
+        coarsening : int or list of int
+            Factor (per axis) by which the field is made at a coarser resolution. Defaults
+            to `sigma / 2`.
+        label_indices : list
+            Indices of the tensors with labels, which are resampled with order 0.
+        """
+        super(ElasticTransform3D, self).__init__(alpha, sigma, order=order, invert=invert,
+                                                 fast=True, coarsening=coarsening,
+                                                 **super_kwargs)
+        self.label_indices = [] if label_indices is None else list(label_indices)
+
+    def volume_function(self, volume):
+        return self.deform(volume)
+
+    def batch_function(self, tensors):
+        # Like `volume_function`, but with the interpolation order depending on the tensor
+        apply_to = list(range(len(tensors))) if self._apply_to is None else self._apply_to
+        transformed = []
+        for tensor_index, tensor in enumerate(tensors):
+            if tensor_index not in apply_to:
+                transformed.append(tensor)
+                continue
+            if tensor.ndim not in [3, 4, 5]:
+                raise NotImplementedError
+            order = 0 if tensor_index in self.label_indices else self.order
+            transformed.append(self._apply_on_trailing_axes(
+                lambda volume: self.deform(volume, order=order), tensor, 3))
+        return transformed
+
 
 class AdditiveGaussianNoise(Transform):
-    """Add gaussian noise to the input."""
+    """Add gaussian noise to the input. Floating point inputs keep their data type."""
+    BROADCASTS_OVER_LEADING_AXES = True
+    ELEMENTWISE = True
+
     def __init__(self, sigma, **super_kwargs):
         super(AdditiveGaussianNoise, self).__init__(**super_kwargs)
         self.sigma = sigma
 
     def build_random_variables(self, **kwargs):
-        np.random.seed()
-        self.set_random_variable('noise', np.random.normal(loc=0, scale=self.sigma,
-                                                           size=kwargs.get('imshape')))
+        self.set_random_variable('noise', self.rng.normal(loc=0, scale=self.sigma,
+                                                          size=kwargs.get('imshape')))
 
     def image_function(self, image):
-        image = image + self.get_random_variable('noise', imshape=image.shape)
-        return image
+        out = np.empty(image.shape, dtype=self.elementwise_output_dtype(image.dtype))
+        return self.elementwise_function(image, out)
+
+    def elementwise_output_dtype(self, dtype):
+        return dtype if np.issubdtype(dtype, np.floating) else np.dtype('float64')
+
+    def elementwise_function(self, tensor, out):
+        # Like for transforms that don't broadcast, one noise image is drawn per call and
+        # added to all images (of all tensors)
+        noise = self.get_random_variable('noise', imshape=tensor.shape[-2:])
+        return np.add(tensor, noise, out=out, casting='same_kind')
 
 
 class RandomRotate(Transform):
     """Random 90-degree rotations."""
+    BROADCASTS_OVER_LEADING_AXES = True
+
     def __init__(self, **super_kwargs):
         super(RandomRotate, self).__init__(**super_kwargs)
 
     def build_random_variables(self, **kwargs):
-        np.random.seed()
-        self.set_random_variable('k', np.random.randint(0, 4))
+        self.set_random_variable('k', self.rng.integers(0, 4))
 
     def image_function(self, image):
-        return np.rot90(image, k=self.get_random_variable('k'))
+        return np.rot90(image, k=self.get_random_variable('k'), axes=(-2, -1))
 
 
 class RandomFlip(Transform):
     """Random left-right or up-down flips."""
+    BROADCASTS_OVER_LEADING_AXES = True
+
     def __init__(self, **super_kwargs):
         super(RandomFlip, self).__init__(**super_kwargs)
 
     def build_random_variables(self, **kwargs):
-        np.random.seed()
-        self.set_random_variable('flip_lr', np.random.uniform() > 0.5)
-        self.set_random_variable('flip_ud', np.random.uniform() > 0.5)
+        self.set_random_variable('flip_lr', self.rng.uniform() > 0.5)
+        self.set_random_variable('flip_ud', self.rng.uniform() > 0.5)
 
     def image_function(self, image):
         if self.get_random_variable('flip_lr'):
-            image = np.fliplr(image)
+            image = image[..., ::-1]
         if self.get_random_variable('flip_ud'):
-            image = np.flipud(image)
+            image = image[..., ::-1, :]
         return image
 
 
 class CenterCrop(Transform):
     """ Crop patch of size `size` from the center of the image """
+    BROADCASTS_OVER_LEADING_AXES = True
+
     def __init__(self, size, **super_kwargs):
         super(CenterCrop, self).__init__(**super_kwargs)
         assert isinstance(size, (int, tuple))
         self.size = (size, size) if isinstance(size, int) else size
 
     def image_function(self, image):
-        h,  w  = image.shape
+        h,  w  = image.shape[-2:]
         th, tw = self.size
         x1 = int(round((w - tw) / 2.))
         y1 = int(round((h - th) / 2.))
-        return image[x1:x1+tw, y1:y1+th]
\ No newline at end of file
+        return image[..., x1:x1+tw, y1:y1+th]
\ No newline at end of file
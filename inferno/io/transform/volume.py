@@ -1,28 +1,30 @@
-import numpy as np
 from .base import Transform
 
 
 class RandomFlip3D(Transform):
+    BROADCASTS_OVER_LEADING_AXES = True
+
     def __init__(self, **super_kwargs):
         super(RandomFlip3D, self).__init__(**super_kwargs)
 
     def build_random_variables(self, **kwargs):
-        np.random.seed()
-        self.set_random_variable('flip_lr', np.random.uniform() > 0.5)
-        self.set_random_variable('flip_ud', np.random.uniform() > 0.5)
-        self.set_random_variable('flip_z', np.random.uniform() > 0.5)
+        self.set_random_variable('flip_lr', self.rng.uniform() > 0.5)
+        self.set_random_variable('flip_ud', self.rng.uniform() > 0.5)
+        self.set_random_variable('flip_z', self.rng.uniform() > 0.5)
 
     def volume_function(self, volume):
         if self.get_random_variable('flip_lr'):
-            volume = volume[:, :, ::-1]
+            volume = volume[..., :, :, ::-1]
         if self.get_random_variable('flip_ud'):
-            volume = volume[:, ::-1, :]
+            volume = volume[..., :, ::-1, :]
         if self.get_random_variable('flip_z'):
-            volume = volume[::-1, :, :]
+            volume = volume[..., ::-1, :, :]
         return volume
 
 
 class CentralSlice(Transform):
+    BROADCASTS_OVER_LEADING_AXES = True
+
     def volume_function(self, volume):
-        half_z = volume.shape[0] // 2
-        return volume[half_z:half_z + 1, ...]
+        half_z = volume.shape[-3] // 2
+        return volume[..., half_z:half_z + 1, :, :]
@@ -1 +1,7 @@
-from .volume import VolumeLoader, HDF5VolumeLoader, TIFVolumeLoader
\ No newline at end of file
+from .volume import VolumeLoader, HDF5VolumeLoader, TIFVolumeLoader, MemmapVolumeLoader
+from .volume import ChunkedVolumeLoader, PyramidVolumeLoader
+from .lazy import LazyVolume, LazyHDF5Volume, LazyTIFVolume
+from .cache import BlockCache, CachedVolume
+from .chunked import ChunkedVolume
+from .sampler import WeightedWindowSampler
+from .inference import SlidingWindowPredictor
@@ -0,0 +1,177 @@
+from collections import OrderedDict
+import itertools as it
+import threading
+import uuid
+import numpy as np
+
+from .lazy import LazyVolume
+
+
+class BlockCache(object):
+    """
+    A least-recently-used cache for blocks (numpy arrays) with a budget in bytes. Blocks
+    are evicted (least recently used first) as soon as the budget is exceeded.
+    """
+    def __init__(self, max_bytes=(512 * 1024 ** 2)):
+        """
+        Parameters
+        ----------
+        max_bytes : int
+            Maximum number of bytes to cache. Defaults to 512 MB.
+        """
+        assert max_bytes >= 0
+        self.max_bytes = max_bytes
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def __contains__(self, key):
+        return key in self._blocks
+
+    @property
+    def hit_rate(self):
+        num_requests = self.hits + self.misses
+        return self.hits / float(num_requests) if num_requests > 0 else 0.
+
+    def get(self, key, load):
+        """
+        Gets the block at `key` from the cache. If it's not cached, it's loaded by calling
+        `load` (without arguments) and cached.
+        """
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is not None:
+                # Mark as most recently used (OrderedDict.move_to_end is not available
+                # in Python 2.7)
+                self._blocks[key] = self._blocks.pop(key)
+                self.hits += 1
+                return block
+            self.misses += 1
+        # Load outside the lock, such that other threads can use the cache
+        block = load()
+        self.put(key, block)
+        return block
+
+    def put(self, key, block):
+        """Adds a block to the cache, and evicts blocks as required."""
+        with self._lock:
+            if block.nbytes > self.max_bytes:
+                # Would evict everything else and then itself
+                return
+            if key in self._blocks:
+                self.num_bytes -= self._blocks.pop(key).nbytes
+            self._blocks[key] = block
+            self.num_bytes += block.nbytes
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self._blocks.popitem(last=False)
+                self.num_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        """Empties the cache (but keeps the counters)."""
+        with self._lock:
+            self._blocks.clear()
+            self.num_bytes = 0
+
+    def reset_counters(self):
+        self.hits = self.misses = self.evictions = 0
+
+    def __getstate__(self):
+        # Locks can't be pickled, and the blocks are not worth sending to other processes.
+        state = self.__dict__.copy()
+        state.update({'_blocks': OrderedDict(), '_lock': None, 'num_bytes': 0})
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "BlockCache(num_blocks={}, num_bytes={}, max_bytes={}, hits={}, misses={})"\
+            .format(len(self), self.num_bytes, self.max_bytes, self.hits, self.misses)
+
+
+class CachedVolume(LazyVolume):
+    """
+    Wraps a `LazyVolume` to read it in blocks, which are cached in a `BlockCache`. The
+    blocks are aligned to a grid over the volume on disk, which should match its chunks
+    (e.g. HDF5 chunks), such that overlapping windows don't read (and decompress) the
+    same chunks over and over.
+    """
+    DEFAULT_BLOCK_SIZE = 64
+
+    def __init__(self, volume, block_shape=None, cache=None, max_bytes=None):
+        """
+        Parameters
+        ----------
+        volume : LazyVolume
+            The volume to read from.
+        block_shape : list of int
+            Shape of the blocks. Defaults to the chunks of `volume` if it has any (like
+            `LazyHDF5Volume`), and blocks of 64 pixels along every axis otherwise.
+        cache : BlockCache
+            Cache to store the blocks in (can be shared between volumes). A new cache is
+            made if not provided.
+        max_bytes : int
+            Budget for the new cache, if `cache` is not provided.
+        """
+        assert isinstance(volume, LazyVolume)
+        if block_shape is None:
+            block_shape = getattr(volume, 'chunks', None)
+        if block_shape is None:
+            block_shape = [self.DEFAULT_BLOCK_SIZE] * volume.ndim
+        assert len(block_shape) == volume.ndim
+        if cache is None:
+            cache = BlockCache() if max_bytes is None else BlockCache(max_bytes)
+        else:
+            assert max_bytes is None, "Can't set max_bytes if a cache is given."
+        self.volume = volume
+        self.block_shape = tuple(block_shape)
+        self.cache = cache
+        # Tells the blocks of volumes sharing a cache apart (unlike `id`, it's never reused,
+        # not even across processes)
+        self.token = uuid.uuid4().hex
+        super(CachedVolume, self).__init__(full_shape=volume.full_shape, dtype=volume.dtype)
+        # Slice like the wrapped volume
+        self.data_ranges = list(volume.data_ranges)
+
+    def read_block(self, block_index):
+        block_slices = tuple(slice(index * block_size, min((index + 1) * block_size, size))
+                             for index, block_size, size in zip(block_index,
+                                                                self.block_shape,
+                                                                self.full_shape))
+        return np.asarray(self.volume.read(block_slices))
+
+    def read(self, full_slices):
+        starts = [_slice.start for _slice in full_slices]
+        stops = [_slice.stop for _slice in full_slices]
+        if any([stop <= start for start, stop in zip(starts, stops)]):
+            return self.volume.read(full_slices)
+        # Assemble the bounding box of the slices from blocks
+        window = np.empty([stop - start for start, stop in zip(starts, stops)],
+                          dtype=self.dtype)
+        block_ranges = [range(start // block_size, (stop - 1) // block_size + 1)
+                        for start, stop, block_size in zip(starts, stops, self.block_shape)]
+        for block_index in it.product(*block_ranges):
+            block = self.cache.get((self.token, block_index),
+                                   lambda: self.read_block(block_index))
+            window_slices, block_slices = [], []
+            for index, start, stop, block_size in zip(block_index, starts, stops,
+                                                      self.block_shape):
+                block_start = index * block_size
+                low, high = max(start, block_start), min(stop, block_start + block_size)
+                window_slices.append(slice(low - start, high - start))
+                block_slices.append(slice(low - block_start, high - block_start))
+            window[tuple(window_slices)] = block[tuple(block_slices)]
+        # Apply the steps
+        return window[tuple(slice(None, None, _slice.step) for _slice in full_slices)]
+
+    def __repr__(self):
+        return "CachedVolume({}, block_shape={}, cache={})"\
+            .format(self.volume, self.block_shape, self.cache)
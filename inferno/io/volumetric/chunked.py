@@ -0,0 +1,273 @@
+import itertools as it
+import json
+import multiprocessing
+import os
+import zlib
+import numpy as np
+
+from .lazy import LazyVolume
+from ...utils import checkpoint_utils as cu
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+
+def _make_compressors():
+    compressors = {'raw': (lambda buffer: bytes(buffer), lambda buffer: buffer),
+                   'zlib': (lambda buffer: zlib.compress(buffer, 1), zlib.decompress)}
+    if lz4 is not None:
+        compressors['lz4'] = (lz4.compress, lz4.decompress)
+    if blosc is not None:
+        compressors['blosc'] = (blosc.compress, blosc.decompress)
+    return compressors
+
+
+# Maps the name of a compression to the functions to compress and decompress a buffer
+COMPRESSORS = _make_compressors()
+
+
+class ChunkedVolume(LazyVolume):
+    """
+    A chunked N-dimensional array on the local file system, similar in spirit to zarr or
+    N5. The array lives in a directory, with a JSON header (`attributes.json`) and one
+    (compressed) file per chunk, named after the chunk index (e.g. `0.2.1`). Chunks that
+    were never written read as `fill_value`.
+
+    Reading and writing is parallelized over chunks with a thread pool. Chunks are written
+    atomically, so readers never see a partially written chunk. However, writes that cover
+    a chunk only partly read, modify and write it, and there's no locking: concurrent
+    writes (from threads or processes) must not touch the same chunks.
+
+    Examples
+    --------
+        >>> volume = ChunkedVolume.create('/path/to/volume', shape=(100, 1000, 1000),
+        >>>                               chunks=(32, 128, 128), dtype='float32')
+        >>> volume[0:10, 0:100, 0:100] = np.ones((10, 100, 100))
+        >>> window = volume[5:15, 50:150, 50:150]
+
+    """
+    HEADER_FILE_NAME = 'attributes.json'
+    FORMAT_NAME = 'inferno-chunked'
+    FORMAT_VERSION = 1
+
+    def __init__(self, directory, data_slice=None, num_threads=None):
+        """
+        Opens an existing chunked volume (see `ChunkedVolume.create` to make a new one).
+
+        Parameters
+        ----------
+        directory : str
+            Directory of the volume.
+        data_slice : list of slice
+            Slice of the volume (optional).
+        num_threads : int
+            Number of threads to read and write chunks with. Defaults to the number of
+            CPUs.
+        """
+        self.directory = directory
+        header = self.read_header(directory)
+        self.chunks = tuple(header['chunks'])
+        self.compression = header['compression']
+        self.fill_value = header['fill_value']
+        assert self.compression in COMPRESSORS, \
+            "Compression '{}' is not available.".format(self.compression)
+        self.num_threads = multiprocessing.cpu_count() if num_threads is None else num_threads
+        self._executor = None
+        self._pid = None
+        super(ChunkedVolume, self).__init__(full_shape=header['shape'],
+                                            dtype=header['dtype'],
+                                            data_slice=data_slice)
+
+    @classmethod
+    def read_header(cls, directory):
+        header_file_name = os.path.join(directory, cls.HEADER_FILE_NAME)
+        assert os.path.exists(header_file_name), \
+            "{} is not a chunked volume.".format(directory)
+        with open(header_file_name, 'r') as header_file:
+            header = json.load(header_file)
+        assert header.get('format') == cls.FORMAT_NAME
+        assert header.get('format_version') <= cls.FORMAT_VERSION, \
+            "Volume format version {} is not supported.".format(header['format_version'])
+        return header
+
+    @classmethod
+    def create(cls, directory, shape, chunks, dtype, compression='zlib', fill_value=0,
+               overwrite=False, num_threads=None):
+        """
+        Makes a new (empty) chunked volume.
+
+        Parameters
+        ----------
+        directory : str
+            Directory to create the volume in.
+        shape : tuple
+            Shape of the volume.
+        chunks : tuple
+            Shape of the chunks.
+        dtype : numpy.dtype
+            Data type of the volume.
+        compression : {'zlib', 'lz4', 'blosc', 'raw'}
+            Compression of the chunks. 'lz4' and 'blosc' require the respective packages.
+        fill_value : scalar
+            Value of chunks that were not written.
+        overwrite : bool
+            Whether to overwrite the header of an existing volume in `directory`. Note that
+            the chunks of the existing volume are not removed.
+        num_threads : int
+            Number of threads to read and write chunks with.
+
+        Returns
+        -------
+        ChunkedVolume
+        """
+        assert len(shape) == len(chunks)
+        assert all([chunk_size > 0 for chunk_size in chunks])
+        assert compression in COMPRESSORS, \
+            "Compression '{}' is not available, use one of {}."\
+            .format(compression, list(COMPRESSORS.keys()))
+        header_file_name = os.path.join(directory, cls.HEADER_FILE_NAME)
+        assert overwrite or not os.path.exists(header_file_name), \
+            "There is a volume in {} already.".format(directory)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        dtype = np.dtype(dtype)
+        header = {'format': cls.FORMAT_NAME,
+                  'format_version': cls.FORMAT_VERSION,
+                  'shape': [int(size) for size in shape],
+                  'chunks': [int(chunk_size) for chunk_size in chunks],
+                  'dtype': dtype.str,
+                  'compression': compression,
+                  'fill_value': np.asarray(fill_value, dtype=dtype).item()}
+        cu.atomic_write(header_file_name,
+                        lambda header_file: header_file.write(json.dumps(header,
+                                                                         indent=2).encode()))
+        return cls(directory, num_threads=num_threads)
+
+    @classmethod
+    def from_array(cls, directory, array, chunks, compression='zlib', **kwargs):
+        """Makes a chunked volume in `directory` and writes `array` to it."""
+        volume = cls.create(directory, shape=array.shape, chunks=chunks,
+                            dtype=array.dtype, compression=compression, **kwargs)
+        volume[tuple(slice(None) for _ in array.shape)] = array
+        return volume
+
+    @property
+    def chunk_grid_shape(self):
+        return tuple((size + chunk_size - 1) // chunk_size
+                     for size, chunk_size in zip(self.full_shape, self.chunks))
+
+    @property
+    def executor(self):
+        """Gets the thread pool, which is made (in this process) if required."""
+        if self._executor is None or self._pid != os.getpid():
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+            self._pid = os.getpid()
+        return self._executor
+
+    def _map(self, function, iterable):
+        iterable = list(iterable)
+        if len(iterable) <= 1 or self.num_threads <= 1:
+            return [function(element) for element in iterable]
+        return list(self.executor.map(function, iterable))
+
+    def chunk_file_name(self, chunk_index):
+        return os.path.join(self.directory, '.'.join(str(index) for index in chunk_index))
+
+    def chunk_slices(self, chunk_index):
+        """Gets the slices of the volume (on disk) the chunk covers."""
+        return tuple(slice(index * chunk_size, min((index + 1) * chunk_size, size))
+                     for index, chunk_size, size in zip(chunk_index, self.chunks,
+                                                        self.full_shape))
+
+    def read_chunk(self, chunk_index):
+        """Reads a chunk. Chunks at the border of the volume might be smaller."""
+        chunk_shape = [_slice.stop - _slice.start for _slice in self.chunk_slices(chunk_index)]
+        file_name = self.chunk_file_name(chunk_index)
+        if not os.path.exists(file_name):
+            return np.full(chunk_shape, self.fill_value, dtype=self.dtype)
+        with open(file_name, 'rb') as chunk_file:
+            buffer = chunk_file.read()
+        decompress = COMPRESSORS[self.compression][1]
+        return np.frombuffer(decompress(buffer), dtype=self.dtype).reshape(chunk_shape)
+
+    def write_chunk(self, chunk_index, chunk):
+        """Writes a (complete) chunk."""
+        chunk_shape = tuple(_slice.stop - _slice.start
+                            for _slice in self.chunk_slices(chunk_index))
+        assert chunk.shape == chunk_shape, \
+            "Chunk {} must have the shape {}, got {}.".format(chunk_index, chunk_shape,
+                                                              chunk.shape)
+        compress = COMPRESSORS[self.compression][0]
+        buffer = compress(np.ascontiguousarray(chunk, dtype=self.dtype).data)
+        # Chunks are many, so they're not flushed to disk one by one
+        cu.atomic_write(self.chunk_file_name(chunk_index),
+                        lambda chunk_file: chunk_file.write(buffer), fsync=False)
+
+    def _chunks_in(self, full_slices):
+        chunk_ranges = [range(_slice.start // chunk_size, (_slice.stop - 1) // chunk_size + 1)
+                        for _slice, chunk_size in zip(full_slices, self.chunks)]
+        return it.product(*chunk_ranges)
+
+    @staticmethod
+    def _intersection(full_slices, chunk_slices):
+        # Get the slices of the intersection, relative to the box of `full_slices` and
+        # relative to the chunk
+        box_slices, in_chunk_slices = [], []
+        for _slice, chunk_slice in zip(full_slices, chunk_slices):
+            low, high = max(_slice.start, chunk_slice.start), min(_slice.stop, chunk_slice.stop)
+            box_slices.append(slice(low - _slice.start, high - _slice.start))
+            in_chunk_slices.append(slice(low - chunk_slice.start, high - chunk_slice.start))
+        return tuple(box_slices), tuple(in_chunk_slices)
+
+    def read(self, full_slices):
+        box = np.empty([max(_slice.stop - _slice.start, 0) for _slice in full_slices],
+                       dtype=self.dtype)
+        if box.size > 0:
+            def read_into_box(chunk_index):
+                box_slices, in_chunk_slices = \
+                    self._intersection(full_slices, self.chunk_slices(chunk_index))
+                box[box_slices] = self.read_chunk(chunk_index)[in_chunk_slices]
+            self._map(read_into_box, self._chunks_in(full_slices))
+        # Apply the steps
+        return box[tuple(slice(None, None, _slice.step) for _slice in full_slices)]
+
+    def write(self, full_slices, data):
+        """Writes `data` to the volume on disk at `full_slices` (without steps)."""
+        assert all([_slice.step == 1 for _slice in full_slices]), \
+            "Steps are not supported for writing."
+        box_shape = tuple(_slice.stop - _slice.start for _slice in full_slices)
+        data = np.broadcast_to(np.asarray(data, dtype=self.dtype), box_shape)
+        if data.size == 0:
+            return
+
+        def write_from_box(chunk_index):
+            chunk_slices = self.chunk_slices(chunk_index)
+            box_slices, in_chunk_slices = self._intersection(full_slices, chunk_slices)
+            chunk_shape = tuple(_slice.stop - _slice.start for _slice in chunk_slices)
+            if data[box_slices].shape == chunk_shape:
+                # The chunk is overwritten entirely
+                chunk = data[box_slices]
+            else:
+                chunk = self.read_chunk(chunk_index).copy()
+                chunk[in_chunk_slices] = data[box_slices]
+            self.write_chunk(chunk_index, chunk)
+        self._map(write_from_box, self._chunks_in(full_slices))
+
+    def __setitem__(self, slices, data):
+        self.write(self.to_full_slices(slices), data)
+
+    def __getstate__(self):
+        # Thread pools can't be pickled
+        state = self.__dict__.copy()
+        state.update({'_executor': None, '_pid': None})
+        return state
+
+    def __repr__(self):
+        return "ChunkedVolume(directory={}, shape={}, chunks={}, dtype={}, compression={})"\
+            .format(self.directory, self.shape, self.chunks, self.dtype, self.compression)
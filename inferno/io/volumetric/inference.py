@@ -0,0 +1,219 @@
+import numpy as np
+import torch
+
+from . import volumetric_utils as vu
+
+
+def constant_weights(window_size):
+    """Weights every pixel of a window equally."""
+    return np.ones(window_size, dtype='float32')
+
+
+def gaussian_weights(window_size, sigma_scale=0.125, minimum=1e-3):
+    """
+    Weights the pixels of a window with a Gaussian centred in the window (with standard
+    deviation `sigma_scale * window_size` along every axis), which suppresses the
+    predictions at the borders of windows.
+    """
+    weights = np.ones(window_size, dtype='float32')
+    for axis, size in enumerate(window_size):
+        coordinates = np.arange(size, dtype='float32') - (size - 1) / 2.
+        sigma = max(sigma_scale * size, 1e-6)
+        profile = np.exp(-0.5 * (coordinates / sigma) ** 2)
+        shape = [1] * len(window_size)
+        shape[axis] = size
+        weights = weights * profile.reshape(shape)
+    weights /= weights.max()
+    return np.maximum(weights, minimum).astype('float32')
+
+
+class SlidingWindowPredictor(object):
+    """
+    Runs a model over a (possibly lazy, see `inferno.io.volumetric.lazy`) volume with a
+    sliding window, and blends the predictions of overlapping windows.
+
+    The windows are run through the model in batches, slab by slab along the first axis.
+    The blended prediction is accumulated in a rolling buffer, which is only as deep as
+    the window, and every slab of the output is written as soon as no window overlaps it
+    anymore. The output can therefore be any store that supports assignment to slices,
+    like a `numpy.ndarray`, a `h5py.Dataset` or an `inferno.io.volumetric.ChunkedVolume`,
+    and the full prediction never needs to fit in memory.
+
+    Examples
+    --------
+        >>> predictor = SlidingWindowPredictor(model, window_size=[32, 128, 128],
+        >>>                                    stride=[16, 64, 64], padding=[8, 32, 32],
+        >>>                                    batch_size=4, blending='gaussian')
+        >>> with h5py.File('prediction.h5', 'w') as h5file:
+        >>>     output = h5file.create_dataset('data', predictor.output_shape(volume, 2),
+        >>>                                    dtype='float32', chunks=(1, 16, 64, 64))
+        >>>     predictor.predict(volume, output=output)
+
+    """
+    def __init__(self, model, window_size, stride, padding=None, batch_size=1,
+                 blending='gaussian', preprocess=None, device=None):
+        """
+        Parameters
+        ----------
+        model : torch.nn.Module
+            Model mapping a batch of windows of shape `(N, C_in, *window_size)` to dense
+            predictions of shape `(N, C_out, *window_size)` (or `(N, *window_size)`).
+        window_size : list of int
+            Size of the window.
+        stride : list of int
+            Stride of the sliding window (at most the window size along every axis).
+        padding : int or list of int
+            Padding (mode 'reflect') along every axis, such that the predictions at the
+            border of the volume come from the inner parts of windows.
+        batch_size : int
+            Number of windows to run through the model at once.
+        blending : {'gaussian', 'constant'} or numpy.ndarray
+            How to weight the predictions of overlapping windows, or the weights.
+        preprocess : callable
+            Function mapping a window (numpy array) to the input of the model (with the
+            channel axis, but without the batch axis). Defaults to adding a channel axis.
+        device : torch.device or str
+            Device to run the model on. Defaults to the device of the model parameters.
+        """
+        self.model = model
+        self.window_size = list(window_size)
+        self.stride = list(stride)
+        assert len(self.window_size) == len(self.stride)
+        assert all([0 < stride <= window_size
+                    for stride, window_size in zip(self.stride, self.window_size)]), \
+            "Stride must be positive and not larger than the window size."
+        if padding is None:
+            padding = [0] * len(self.window_size)
+        elif isinstance(padding, int):
+            padding = [padding] * len(self.window_size)
+        assert len(padding) == len(self.window_size)
+        self.padding = list(padding)
+        assert batch_size > 0
+        self.batch_size = batch_size
+        if isinstance(blending, np.ndarray):
+            assert list(blending.shape) == self.window_size
+            self.weights = blending.astype('float32')
+        elif blending == 'gaussian':
+            self.weights = gaussian_weights(self.window_size)
+        elif blending == 'constant':
+            self.weights = constant_weights(self.window_size)
+        else:
+            raise NotImplementedError("Blending '{}' is not supported.".format(blending))
+        self.preprocess = (lambda window: window[None]) if preprocess is None else preprocess
+        self.device = device
+
+    def get_padding(self, shape):
+        """
+        Gets the padding (before and after) of a volume of `shape`. The padding after is
+        extended such that the windows tile the padded volume.
+        """
+        padding = []
+        for size, pad, window_size, stride in zip(shape, self.padding, self.window_size,
+                                                  self.stride):
+            padded_size = max(size + 2 * pad, window_size)
+            extra = (-(padded_size - window_size)) % stride
+            padding.append([pad, padded_size - size - pad + extra])
+        return padding
+
+    def output_shape(self, volume, num_output_channels):
+        return (num_output_channels,) + tuple(volume.shape)
+
+    def run_model(self, windows):
+        input = np.stack([self.preprocess(window) for window in windows])
+        input = torch.from_numpy(np.ascontiguousarray(input, dtype='float32'))
+        device = self.device
+        if device is None:
+            parameter = next(iter(self.model.parameters()), None)
+            device = parameter.device if parameter is not None else 'cpu'
+        with torch.no_grad():
+            prediction = self.model(input.to(device))
+        prediction = prediction.detach().float().cpu().numpy()
+        if prediction.ndim == len(self.window_size) + 1:
+            # No channel axis
+            prediction = prediction[:, None]
+        assert list(prediction.shape[2:]) == self.window_size, \
+            "Model must predict windows of the input shape ({}), got {}."\
+            .format(self.window_size, list(prediction.shape[2:]))
+        return prediction
+
+    def predict(self, volume, output=None):
+        """
+        Predicts on `volume`.
+
+        Parameters
+        ----------
+        volume : numpy.ndarray or array-like
+            Volume to predict on, without channel axis (lazy volumes are read window by
+            window).
+        output : numpy.ndarray or array-like
+            Store to write the prediction of shape `(C_out, *volume.shape)` to. If not
+            given, a numpy array is made.
+
+        Returns
+        -------
+        numpy.ndarray or array-like
+            The output.
+        """
+        assert volume.ndim == len(self.window_size)
+        padding = self.get_padding(volume.shape)
+        padded_shape = [size + pad_before + pad_after
+                        for size, (pad_before, pad_after) in zip(volume.shape, padding)]
+        windows = vu.SlidingWindowIndex(padded_shape, self.window_size, self.stride)
+        num_rows = windows.grid_shape[0]
+        num_windows_per_row = len(windows) // num_rows
+        was_training = self.model.training
+        self.model.eval()
+        buffer, norm = None, None
+        try:
+            for row in range(num_rows):
+                row_windows = [windows[row * num_windows_per_row + index]
+                               for index in range(num_windows_per_row)]
+                for batch_start in range(0, len(row_windows), self.batch_size):
+                    batch_slices = row_windows[batch_start:batch_start + self.batch_size]
+                    predictions = self.run_model([vu.slice_padded(volume, slices, padding)
+                                                  for slices in batch_slices])
+                    if buffer is None:
+                        # The buffer spans the window along the first axis, and the
+                        # padded volume along the others
+                        buffer = np.zeros([predictions.shape[1], self.window_size[0]] +
+                                          padded_shape[1:], dtype='float32')
+                        norm = np.zeros([self.window_size[0]] + padded_shape[1:],
+                                        dtype='float32')
+                        if output is None:
+                            output = np.zeros(self.output_shape(volume,
+                                                                predictions.shape[1]),
+                                              dtype='float32')
+                    for slices, prediction in zip(batch_slices, predictions):
+                        in_buffer = (slice(0, self.window_size[0]),) + tuple(slices[1:])
+                        buffer[(slice(None),) + in_buffer] += prediction * self.weights
+                        norm[in_buffer] += self.weights
+                # Rows of the buffer which no further window overlaps are done
+                is_last_row = row == num_rows - 1
+                num_done = self.window_size[0] if is_last_row else self.stride[0]
+                self._write(output, buffer[:, :num_done] / np.maximum(norm[:num_done], 1e-12),
+                            start=row * self.stride[0], padding=padding,
+                            shape=volume.shape)
+                if not is_last_row:
+                    # Roll the buffer
+                    buffer[:, :-num_done] = buffer[:, num_done:]
+                    buffer[:, -num_done:] = 0
+                    norm[:-num_done] = norm[num_done:]
+                    norm[-num_done:] = 0
+        finally:
+            self.model.train(was_training)
+        return output
+
+    @staticmethod
+    def _write(output, slab, start, padding, shape):
+        # Write a slab (starting at `start` in the padded volume) to the output, without
+        # the padding
+        stop = start + slab.shape[1]
+        low, high = max(start, padding[0][0]), min(stop, padding[0][0] + shape[0])
+        if low >= high:
+            return
+        slab = slab[:, low - start:high - start]
+        slab = slab[(slice(None), slice(None)) +
+                    tuple(slice(pad_before, pad_before + size)
+                          for (pad_before, _), size in zip(padding[1:], shape[1:]))]
+        output[(slice(None), slice(low - padding[0][0], high - padding[0][0])) +
+               tuple(slice(None) for _ in shape[1:])] = slab
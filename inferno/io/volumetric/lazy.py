@@ -0,0 +1,218 @@
+import os
+import h5py as h5
+import numpy as np
+try:
+    import tifffile
+except ImportError:
+    try:
+        from skimage.external import tifffile
+    except ImportError:
+        tifffile = None
+
+
+class LazyVolume(object):
+    """
+    Base class for volumes that are read lazily (i.e. window by window) from disk. The
+    volume can be restricted to a `data_slice` of the volume on disk, in which case it
+    behaves like the sliced volume. Subclasses must implement the `read` method.
+    """
+    def __init__(self, full_shape, dtype, data_slice=None):
+        """
+        Parameters
+        ----------
+        full_shape : tuple
+            Shape of the volume on disk.
+        dtype : numpy.dtype
+            Data type of the volume.
+        data_slice : list of slice
+            Slice of the volume on disk (optional, with positive steps).
+        """
+        self.full_shape = tuple(full_shape)
+        self.dtype = np.dtype(dtype)
+        data_slice = [] if data_slice is None else list(data_slice)
+        assert len(data_slice) <= len(self.full_shape)
+        data_slice += [slice(None)] * (len(self.full_shape) - len(data_slice))
+        # Normalize the data slice to ranges
+        self.data_ranges = [range(*_slice.indices(size))
+                            for _slice, size in zip(data_slice, self.full_shape)]
+        assert all([data_range.step > 0 for data_range in self.data_ranges]), \
+            "Only positive steps are supported in the data slice."
+
+    @property
+    def shape(self):
+        return tuple(len(data_range) for data_range in self.data_ranges)
+
+    @property
+    def ndim(self):
+        return len(self.full_shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def to_full_slices(self, slices):
+        """Converts slices of this volume to slices of the volume on disk."""
+        slices = list(slices) if isinstance(slices, (list, tuple)) else [slices]
+        assert all([isinstance(_slice, slice) for _slice in slices]), \
+            "Only slicing is supported, got {}.".format(slices)
+        assert len(slices) <= self.ndim
+        slices += [slice(None)] * (self.ndim - len(slices))
+        full_slices = []
+        for _slice, data_range in zip(slices, self.data_ranges):
+            sliced_range = data_range[_slice]
+            assert sliced_range.step > 0, "Only positive steps are supported."
+            if len(sliced_range) == 0:
+                full_slices.append(slice(data_range.start, data_range.start, 1))
+            else:
+                full_slices.append(slice(sliced_range.start, sliced_range[-1] + 1,
+                                         sliced_range.step))
+        return full_slices
+
+    def read(self, full_slices):
+        """Reads the volume on disk at `full_slices`."""
+        raise NotImplementedError
+
+    def __getitem__(self, slices):
+        return np.asarray(self.read(self.to_full_slices(slices)))
+
+    def __array__(self, dtype=None):
+        array = self[tuple()]
+        return array if dtype is None else array.astype(dtype)
+
+    def __repr__(self):
+        return "{}(shape={}, dtype={})".format(type(self).__name__, self.shape, self.dtype)
+
+
+class LazyHDF5Volume(LazyVolume):
+    """
+    A HDF5 dataset that is read lazily. The file is opened on demand (in 'r' mode) and
+    kept open, and it's opened again in every process it's used in (e.g. in the workers
+    of a `torch.utils.data.DataLoader`). HDF5 file handles must not be shared between
+    processes.
+    """
+    def __init__(self, path, path_in_h5_dataset=None, data_slice=None):
+        """
+        Parameters
+        ----------
+        path : str
+            Path to the HDF5 file.
+        path_in_h5_dataset : str
+            Path to the dataset in the HDF5 file. Defaults to the first dataset in the file.
+        data_slice : list of slice
+            Slice of the dataset (optional).
+        """
+        assert os.path.exists(path), "Path {} does not exist.".format(path)
+        self.path = path
+        with h5.File(path, 'r') as h5file:
+            if path_in_h5_dataset is None:
+                path_in_h5_dataset = list(h5file.keys())[0]
+            dataset = h5file[path_in_h5_dataset]
+            full_shape, dtype, chunks = dataset.shape, dataset.dtype, dataset.chunks
+        self.path_in_h5_dataset = path_in_h5_dataset
+        # Chunk shape of the dataset on disk (None if the dataset is not chunked)
+        self.chunks = chunks
+        self._h5file = None
+        self._dataset = None
+        self._pid = None
+        super(LazyHDF5Volume, self).__init__(full_shape=full_shape, dtype=dtype,
+                                             data_slice=data_slice)
+
+    @property
+    def dataset(self):
+        """Gets the h5py dataset, which is opened in this process if required."""
+        if self._dataset is None or self._pid != os.getpid():
+            # Handles inherited from the parent process (after a fork) are not closed,
+            # because they're not ours to close.
+            self._h5file = h5.File(self.path, 'r')
+            self._dataset = self._h5file[self.path_in_h5_dataset]
+            self._pid = os.getpid()
+        return self._dataset
+
+    def read(self, full_slices):
+        return self.dataset[tuple(full_slices)]
+
+    def close(self):
+        if self._h5file is not None and self._pid == os.getpid():
+            self._h5file.close()
+        self._h5file = None
+        self._dataset = None
+        self._pid = None
+
+    def __getstate__(self):
+        # Open files can't be pickled
+        state = self.__dict__.copy()
+        state.update({'_h5file': None, '_dataset': None, '_pid': None})
+        return state
+
+
+class LazyTIFVolume(LazyVolume):
+    """
+    A multi-page TIFF stack that is read lazily, page by page (the pages being the first
+    axis). Like when reading the file eagerly, single-page files have no page axis.
+    Decoded pages are cached in a `BlockCache`. Like `LazyHDF5Volume`, the file is opened
+    once per process.
+    """
+    def __init__(self, path, data_slice=None, cache_size=(256 * 1024 ** 2)):
+        """
+        Parameters
+        ----------
+        path : str
+            Path to the TIFF file.
+        data_slice : list of slice
+            Slice of the stack (optional).
+        cache_size : int
+            Budget (in bytes) of the cache for decoded pages.
+        """
+        from .cache import BlockCache
+        assert tifffile is not None, "tifffile is required to read TIFF files lazily."
+        assert os.path.exists(path), "Path {} does not exist.".format(path)
+        self.path = path
+        with tifffile.TiffFile(path) as tif:
+            num_pages = len(tif.pages)
+            page = tif.pages[0]
+            page_shape, dtype = tuple(page.shape), page.dtype
+        self.page_cache = BlockCache(cache_size)
+        self.num_pages = num_pages
+        self._tif = None
+        self._pid = None
+        full_shape = page_shape if num_pages == 1 else (num_pages,) + page_shape
+        super(LazyTIFVolume, self).__init__(full_shape=full_shape, dtype=dtype,
+                                            data_slice=data_slice)
+
+    @property
+    def tif(self):
+        """Gets the TIFF file, which is opened in this process if required."""
+        if self._tif is None or self._pid != os.getpid():
+            self._tif = tifffile.TiffFile(self.path)
+            self._pid = os.getpid()
+        return self._tif
+
+    def read_page(self, index):
+        return self.page_cache.get(index, lambda: self.tif.pages[index].asarray())
+
+    def read(self, full_slices):
+        if self.num_pages == 1:
+            return self.read_page(0)[tuple(full_slices)]
+        page_slice, in_page_slices = full_slices[0], tuple(full_slices[1:])
+        pages = [self.read_page(index)[in_page_slices]
+                 for index in range(*page_slice.indices(self.full_shape[0]))]
+        if not pages:
+            return np.empty((0,) + np.empty(self.full_shape[1:])[in_page_slices].shape,
+                            dtype=self.dtype)
+        return np.stack(pages)
+
+    def close(self):
+        if self._tif is not None and self._pid == os.getpid():
+            self._tif.close()
+        self._tif = None
+        self._pid = None
+
+    def __getstate__(self):
+        # Open files can't be pickled
+        state = self.__dict__.copy()
+        state.update({'_tif': None, '_pid': None})
+        return state
@@ -0,0 +1,156 @@
+import itertools as it
+import os
+try:
+    from math import gcd
+except ImportError:
+    # Python 2.7
+    from fractions import gcd
+import numpy as np
+import torch
+from torch.utils.data.sampler import Sampler
+
+from . import volumetric_utils as vu
+
+
+def default_weighting(statistics):
+    """Weights windows by their foreground fraction, such that empty windows are still
+    drawn every now and then."""
+    return 0.1 + statistics
+
+
+class WeightedWindowSampler(Sampler):
+    """
+    Draws the windows of a `VolumeLoader` (or of a `Zip` synced with one) in proportion to
+    a weight computed from a per-window statistic, which is the fraction of foreground
+    pixels in the window of a label volume. This is useful to train on sparse labels.
+
+    The statistic is computed once for all windows with a block reduction over the label
+    volume: the volume is reduced to blocks of size `gcd(window_size, stride)` (read slab
+    by slab, such that lazy volumes are not loaded to memory), from which the sums over
+    all windows are computed with a summed-area table. If the table would be too large
+    (more than `MAX_TABLE_BYTES`, e.g. if the window size and stride are coprime), the
+    windows are read one by one instead. The statistics can be cached to a .npy file.
+    """
+    SLAB_BYTES = 64 * 1024 ** 2
+    MAX_TABLE_BYTES = 256 * 1024 ** 2
+
+    def __init__(self, label_loader, weighting=default_weighting, foreground=None,
+                 num_samples=None, cache_path=None):
+        """
+        Parameters
+        ----------
+        label_loader : VolumeLoader
+            Loader of the label volume. Its windows must be synced with the dataset the
+            sampler is used for.
+        weighting : callable
+            Function mapping the (numpy array of) statistics to (non-negative) weights.
+        foreground : callable
+            Function mapping a label window to a boolean foreground mask. Defaults to
+            labels larger than 0.
+        num_samples : int
+            Number of windows to draw per epoch (with replacement). Defaults to the number
+            of windows.
+        cache_path : str
+            Path of a .npy file to cache the statistics in (optional). If it exists, the
+            statistics are loaded from it.
+        """
+        assert callable(weighting)
+        assert foreground is None or callable(foreground)
+        self.label_loader = label_loader
+        self.weighting = weighting
+        self.foreground = (lambda labels: labels > 0) if foreground is None else foreground
+        self.num_samples = len(label_loader) if num_samples is None else num_samples
+        self.cache_path = cache_path
+        self.statistics = self.load_or_compute_statistics()
+        weights = np.asarray(self.weighting(self.statistics), dtype='float64')
+        assert weights.shape == self.statistics.shape
+        assert np.all(weights >= 0) and weights.sum() > 0, \
+            "Weights must be non-negative and not all zero."
+        self.weights = weights
+        self._cumulative_weights = torch.from_numpy(np.cumsum(weights))
+
+    def load_or_compute_statistics(self):
+        if self.cache_path is not None and os.path.exists(self.cache_path):
+            statistics = np.load(self.cache_path)
+            assert statistics.shape == (len(self.label_loader),), \
+                "Cached statistics in {} don't match the loader.".format(self.cache_path)
+            return statistics
+        statistics = self.compute_statistics()
+        if self.cache_path is not None:
+            np.save(self.cache_path, statistics)
+        return statistics
+
+    def compute_statistics(self):
+        """Computes the foreground fraction of every window."""
+        windows = self.label_loader.base_sequence
+        if isinstance(windows, vu.SlidingWindowIndex) and all([ds == 1 for ds in windows.ds]):
+            # The block sums and the summed-area table (both int64)
+            num_blocks = self._get_num_blocks(windows)
+            table_bytes = 8 * (int(np.prod(num_blocks)) +
+                               int(np.prod([num + 1 for num in num_blocks])))
+            if table_bytes <= self.MAX_TABLE_BYTES:
+                return self._compute_statistics_with_blocks(windows)
+        # Fall back to reading every window
+        return np.array([np.mean(self.foreground(self.label_loader.read_window(slices)))
+                         for slices in self.label_loader.base_sequence], dtype='float64')
+
+    @staticmethod
+    def _get_block_shape(windows):
+        return [gcd(window_size, stride)
+                for window_size, stride in zip(windows.window_size, windows.stride)]
+
+    def _get_num_blocks(self, windows):
+        return [size // block_size
+                for size, block_size in zip(windows.shape, self._get_block_shape(windows))]
+
+    def _compute_statistics_with_blocks(self, windows):
+        assert all([ds == 1 for ds in windows.ds])
+        block_shape = self._get_block_shape(windows)
+        num_blocks = self._get_num_blocks(windows)
+        # Sum the foreground over blocks, reading the (padded) label volume in slabs
+        block_sums = np.zeros(num_blocks, dtype='int64')
+        slab_size = max(1, self.SLAB_BYTES //
+                        int(np.prod(windows.shape[1:]) * block_shape[0] *
+                            self.label_loader.volume.dtype.itemsize))
+        for slab_start in range(0, num_blocks[0], slab_size):
+            slab_stop = min(slab_start + slab_size, num_blocks[0])
+            slab_slices = [slice(slab_start * block_shape[0], slab_stop * block_shape[0])] + \
+                [slice(0, num * block_size)
+                 for num, block_size in zip(num_blocks[1:], block_shape[1:])]
+            mask = np.asarray(self.foreground(self.label_loader.read_window(slab_slices)))
+            blocks = mask.reshape([dim
+                                   for num, block_size in zip([slab_stop - slab_start] +
+                                                              num_blocks[1:], block_shape)
+                                   for dim in (num, block_size)])
+            block_sums[slab_start:slab_stop] = \
+                blocks.sum(axis=tuple(range(1, 2 * len(block_shape), 2)))
+        # Summed-area table, with a leading zero along every axis
+        table = np.zeros([num + 1 for num in num_blocks], dtype='int64')
+        table[tuple(slice(1, None) for _ in num_blocks)] = block_sums
+        for axis in range(table.ndim):
+            np.cumsum(table, axis=axis, out=table)
+        # Sum over every window by inclusion-exclusion over the corners of the windows
+        starts = [np.arange(num_starts) * (stride // block_size)
+                  for num_starts, stride, block_size in zip(windows.grid_shape,
+                                                            windows.stride, block_shape)]
+        stops = [start + window_size // block_size
+                 for start, window_size, block_size in zip(starts, windows.window_size,
+                                                           block_shape)]
+        window_sums = np.zeros(windows.grid_shape, dtype='int64')
+        for corner in it.product([0, 1], repeat=len(num_blocks)):
+            sign = (-1) ** (len(corner) - sum(corner))
+            indices = [stop if at_stop else start
+                       for start, stop, at_stop in zip(starts, stops, corner)]
+            window_sums += sign * table[np.ix_(*indices)]
+        return window_sums.ravel() / float(np.prod(windows.window_size))
+
+    def __iter__(self):
+        # Inverse transform sampling, which (unlike torch.multinomial) is not limited in
+        # the number of windows
+        uniform = torch.rand(self.num_samples, dtype=torch.float64) * \
+            self._cumulative_weights[-1]
+        indices = torch.searchsorted(self._cumulative_weights, uniform, right=True)
+        return iter(indices.clamp(max=len(self.weights) - 1).tolist())
+
+    def __len__(self):
+        return self.num_samples
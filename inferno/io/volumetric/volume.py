@@ -5,16 +5,26 @@ import skimage.io
 from ..core.base import SyncableDataset
 from ..core.base import IndexSpec
 from . import volumetric_utils as vu
+from .lazy import LazyHDF5Volume, LazyTIFVolume
+from .cache import CachedVolume
+from .chunked import ChunkedVolume
 from ...utils import io_utils as iou
 from ...utils import python_utils as pyu
 
 
 class VolumeLoader(SyncableDataset):
+    """
+    Loads sliding windows from a volume. If `padding` is given, the volume is padded in
+    mode 'reflect'. Unless `pad_virtually` is set to False, this is done for every window
+    (crossing the border) as it's read, instead of padding the entire volume up front.
+    """
     def __init__(self, volume, window_size, stride, downsampling_ratio=None, padding=None,
-                 transforms=None, return_index_spec=False, name=None):
+                 transforms=None, return_index_spec=False, name=None, pad_virtually=True):
         super(VolumeLoader, self).__init__()
-        # Validate volume
-        assert isinstance(volume, np.ndarray)
+        # Validate volume. Lazy volumes (e.g. `LazyHDF5Volume`) only need to support
+        # slicing and have a shape.
+        assert isinstance(volume, np.ndarray) or \
+            (hasattr(volume, 'shape') and hasattr(volume, '__getitem__'))
         # Validate window size and stride
         assert len(window_size) == volume.ndim
         assert len(stride) == volume.ndim
@@ -40,35 +50,60 @@ class VolumeLoader(SyncableDataset):
         else:
             raise NotImplementedError
 
+        # Lazy and memory-mapped volumes must be padded virtually, i.e. only the windows
+        # crossing the border are padded when they are read
+        if not isinstance(volume, np.ndarray) or isinstance(volume, np.memmap):
+            assert pad_virtually, "Lazy or memory-mapped volumes must be padded virtually."
+        self.pad_virtually = pad_virtually
         if padding is None:
             self.padding = [[0, 0]] * self.volume.ndim
         else:
             self.padding = padding
-            self.pad_volume()
+            if not self.pad_virtually:
+                self.pad_volume()
 
         self.base_sequence = self.make_sliding_windows()
 
+    @property
+    def shape(self):
+        """Shape of the (padded) volume the windows are taken from."""
+        if getattr(self, 'pad_virtually', False):
+            return tuple(size + pad_before + pad_after
+                         for size, (pad_before, pad_after) in zip(self.volume.shape,
+                                                                  self.padding))
+        else:
+            return tuple(self.volume.shape)
+
     def pad_volume(self, padding=None):
+        """Pads the entire volume (in memory)."""
         padding = self.padding if padding is None else padding
         if padding is None:
             return self.volume
         else:
             self.volume = np.pad(self.volume,
-                                 pad_width=self.padding,
+                                 pad_width=padding,
                                  mode='reflect')
+            # The padding is now part of the volume
+            self.pad_virtually = False
             return self.volume
 
     def make_sliding_windows(self):
-        return list(vu.slidingwindowslices(shape=list(self.volume.shape),
-                                           nhoodsize=self.window_size,
-                                           stride=self.stride,
-                                           shuffle=self.shuffle))
+        if self.shuffle:
+            return list(vu.slidingwindowslices(shape=list(self.shape),
+                                               nhoodsize=self.window_size,
+                                               stride=self.stride,
+                                               shuffle=self.shuffle))
+        else:
+            # Compute the windows on the fly instead of storing them
+            return vu.SlidingWindowIndex(shape=list(self.shape),
+                                         window_size=self.window_size,
+                                         stride=self.stride)
 
     def __getitem__(self, index):
         # Casting to int would allow index to be IndexSpec objects.
         index = int(index)
         slices = self.base_sequence[index]
-        sliced_volume = self.volume[tuple(slices)]
+        sliced_volume = self.read_window(slices)
         if self.transforms is None:
             transformed = sliced_volume
         else:
@@ -78,9 +113,18 @@ class VolumeLoader(SyncableDataset):
         else:
             return transformed
 
+    def read_window(self, slices):
+        """Reads the window at `slices` (in the coordinates of the padded volume)."""
+        if getattr(self, 'pad_virtually', False):
+            window = vu.slice_padded(self.volume, slices, self.padding)
+        else:
+            window = self.volume[tuple(slices)]
+        # Windows of memory-mapped volumes are returned as (zero-copy) arrays
+        return np.asarray(window)
+
     def clone(self, volume=None, transforms=None, name=None):
         # Make sure the volume shapes check out
-        assert volume.shape == self.volume.shape
+        assert volume is None or volume.shape == self.volume.shape
         # Make a new instance (without initializing)
         new = type(self).__new__(type(self))
         # Update dictionary to initialize
@@ -98,9 +142,157 @@ class VolumeLoader(SyncableDataset):
         return "{}(shape={}, name={})".format(type(self).__name__, self.volume.shape, self.name)
 
 
+class PyramidVolumeLoader(VolumeLoader):
+    """
+    Loads aligned windows from several scales of a volume at once, e.g. a window at full
+    resolution and a (larger) context window around it from a downsampled level. Level
+    `s` is downsampled by `downsampling_ratio ** s` relative to the volume, and is
+    computed (from level `s - 1`, slab by slab) when it's first required. Levels are kept
+    in memory, or in .npy memory maps in `level_directory` for volumes that don't fit in
+    memory. Computed levels are sent along when the loader is pickled (memory maps by
+    path), so call `precompute_levels` before handing the loader to the workers of a
+    `torch.utils.data.DataLoader`, such that the levels are only computed once.
+
+    The windows of all scales have the same `window_size` and are centred on the window
+    at full resolution (from the sliding window over the volume), where the downsampled
+    levels are padded virtually as required. Items are tuples of windows, one for every
+    scale in `scales`, and the transforms (if any) are applied on all of them together.
+    """
+    def __init__(self, volume, window_size, stride, scales=(0, 1), downsampling_ratio=2,
+                 downsampling_mode='mean', padding=None, transforms=None,
+                 return_index_spec=False, name=None, level_directory=None):
+        """
+        Parameters
+        ----------
+        volume : numpy.ndarray or array-like
+            The volume (see `VolumeLoader`).
+        window_size : list of int
+            Size of the windows at every scale.
+        stride : list of int
+            Stride of the sliding window at full resolution.
+        scales : list of int
+            Scales to load windows from, where scale 0 is the full resolution.
+        downsampling_ratio : int or list of int
+            Downsampling ratio between consecutive levels.
+        downsampling_mode : {'mean', 'stride'}
+            How to downsample (see `volumetric_utils.downsample`). Use 'stride' for labels.
+        padding : list of list of int
+            Padding of the volume at full resolution.
+        level_directory : str
+            Directory to store the downsampled levels in (as memory maps). If not given,
+            the levels are kept in memory.
+        """
+        super(PyramidVolumeLoader, self).__init__(volume=volume, window_size=window_size,
+                                                  stride=stride,
+                                                  downsampling_ratio=downsampling_ratio,
+                                                  padding=padding, transforms=transforms,
+                                                  return_index_spec=return_index_spec,
+                                                  name=name, pad_virtually=True)
+        self.scales = list(pyu.to_iterable(scales))
+        assert all([scale >= 0 for scale in self.scales])
+        assert max(self.scales) == 0 or all([ratio > 1 for ratio in self.downsampling_ratio])
+        assert downsampling_mode in ['mean', 'stride']
+        self.downsampling_mode = downsampling_mode
+        if level_directory is not None and not os.path.exists(level_directory):
+            os.makedirs(level_directory)
+        self.level_directory = level_directory
+        self._levels = {0: self.volume}
+
+    def precompute_levels(self):
+        """Computes all levels required for the scales."""
+        for scale in self.scales:
+            self.get_level(scale)
+        return self
+
+    def get_level(self, scale):
+        """Gets the volume at `scale`, which is computed if required."""
+        if scale not in self._levels:
+            previous_level = self.get_level(scale - 1)
+            shape = vu.downsampled_shape(previous_level.shape, self.downsampling_ratio,
+                                         self.downsampling_mode)
+            if self.level_directory is None:
+                level = np.empty(shape, dtype=previous_level.dtype)
+            else:
+                level = np.lib.format.open_memmap(self.get_level_path(scale), mode='w+',
+                                                  dtype=previous_level.dtype, shape=shape)
+            vu.downsample(previous_level, factor=self.downsampling_ratio,
+                          mode=self.downsampling_mode, out=level)
+            if isinstance(level, np.memmap):
+                level.flush()
+            self._levels[scale] = level
+        return self._levels[scale]
+
+    def get_level_path(self, scale):
+        file_name = 'level_{}.npy'.format(scale) if self.name is None else \
+            '{}_level_{}.npy'.format(self.name, scale)
+        return os.path.join(self.level_directory, file_name)
+
+    def read_window_at_scale(self, slices, scale):
+        """
+        Reads the window at `scale` which is centred on the window at `slices` (in the
+        coordinates of the padded volume at full resolution).
+        """
+        if scale == 0:
+            return self.read_window(slices)
+        level = self.get_level(scale)
+        level_slices, level_padding = [], []
+        for _slice, (pad_before, _), ratio, window_size, size in \
+                zip(slices, self.padding, self.downsampling_ratio, self.window_size,
+                    level.shape):
+            factor = ratio ** scale
+            # Centre of the window at full resolution, without padding
+            centre = (_slice.start + _slice.stop - 1) / 2. - pad_before
+            # Pixel j of the level is centred on pixel j * factor + offset of the volume
+            offset = (factor - 1) / 2. if self.downsampling_mode == 'mean' else 0.
+            start = int(np.floor((centre - offset) / factor - (window_size - 1) / 2. + 0.5))
+            stop = start + window_size
+            # Pad virtually where the window crosses the border
+            pad = [max(0, -start), max(0, stop - size)]
+            level_slices.append(slice(start + pad[0], stop + pad[0]))
+            level_padding.append(pad)
+        return vu.slice_padded(level, level_slices, level_padding)
+
+    def __getitem__(self, index):
+        # Casting to int would allow index to be IndexSpec objects.
+        index = int(index)
+        slices = self.base_sequence[index]
+        windows = tuple(self.read_window_at_scale(slices, scale) for scale in self.scales)
+        if self.transforms is not None:
+            windows = self.transforms(*windows)
+        if self.return_index_spec:
+            return windows, IndexSpec(index=index, base_sequence_at_index=slices)
+        else:
+            return windows
+
+    def __getstate__(self):
+        # Memory mapped levels are sent by path (and opened again), and the others as
+        # they are. Level 0 is the volume.
+        state = self.__dict__.copy()
+        state['_levels'] = {scale: (self.get_level_path(scale)
+                                    if isinstance(level, np.memmap) else level)
+                            for scale, level in self._levels.items() if scale > 0}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Loaders loaded from pickle files might not have the attribute
+        self.__dict__.setdefault('level_directory', None)
+        self._levels = {scale: (np.load(level, mmap_mode='r') if isinstance(level, str)
+                                else level)
+                        for scale, level in self._levels.items()}
+        self._levels[0] = self.volume
+
+
 class HDF5VolumeLoader(VolumeLoader):
+    """
+    Loader for volumes stored in HDF5 files. If `lazy` is set, the dataset is not read
+    to memory, but only the windows (see `inferno.io.volumetric.lazy.LazyHDF5Volume`).
+    Lazily read windows can be assembled from chunks cached in an LRU cache of
+    `cache_size` bytes (see `inferno.io.volumetric.cache.CachedVolume`), which helps when
+    windows overlap.
+    """
     def __init__(self, path, path_in_h5_dataset=None, data_slice=None, transforms=None,
-                 name=None, **slicing_config):
+                 name=None, lazy=False, cache_size=None, **slicing_config):
 
         if isinstance(path, dict):
             assert name is not None
@@ -137,9 +329,19 @@ class HDF5VolumeLoader(VolumeLoader):
         assert 'window_size' in slicing_config_for_name
         assert 'stride' in slicing_config_for_name
 
-        # Read in volume from file
-        volume = iou.fromh5(self.path, self.path_in_h5_dataset,
-                            dataslice=tuple(self.data_slice))
+        self.lazy = lazy
+        if self.lazy:
+            # Read windows from file on demand
+            volume = LazyHDF5Volume(self.path, self.path_in_h5_dataset,
+                                    data_slice=self.data_slice)
+            if cache_size is not None:
+                volume = CachedVolume(volume, max_bytes=cache_size)
+        else:
+            assert cache_size is None, "Only lazily read volumes can be cached."
+            # Read in volume from file
+            volume = iou.fromh5(self.path, self.path_in_h5_dataset,
+                                dataslice=(tuple(self.data_slice)
+                                           if self.data_slice is not None else None))
         # Initialize superclass with the volume
         super(HDF5VolumeLoader, self).__init__(volume=volume, name=name, transforms=transforms,
                                                **slicing_config_for_name)
@@ -147,7 +349,8 @@ class HDF5VolumeLoader(VolumeLoader):
 
 class TIFVolumeLoader(VolumeLoader):
     """Loader for volumes stored in .tif files."""
-    def __init__(self, path, data_slice=None, transforms=None, name=None, **slicing_config):
+    def __init__(self, path, data_slice=None, transforms=None, name=None, lazy=False,
+                 cache_size=None, **slicing_config):
         """
         Parameters
         ----------
@@ -155,6 +358,11 @@ class TIFVolumeLoader(VolumeLoader):
             Path to the volume.
         transforms : callable
             Transforms to apply on the read volume.
+        lazy : bool
+            Whether to read only the pages required for every window, instead of the
+            entire stack (see `inferno.io.volumetric.lazy.LazyTIFVolume`).
+        cache_size : int
+            Budget (in bytes) for caching decoded pages, if `lazy` is set.
         slicing_config : dict
             Dictionary specifying the sliding window. Must contain keys 'window_size'
             and 'stride'.
@@ -181,10 +389,163 @@ class TIFVolumeLoader(VolumeLoader):
         else:
             raise NotImplementedError
 
-        # Read in volume from file
-        volume = skimage.io.imread(self.path)
-        # and slice it
-        volume = volume[self.data_slice] if self.data_slice is not None else volume
+        self.lazy = lazy
+        if self.lazy:
+            # Read pages from file on demand
+            volume = LazyTIFVolume(self.path, data_slice=self.data_slice,
+                                   **({} if cache_size is None else {'cache_size': cache_size}))
+        else:
+            assert cache_size is None, "Only lazily read volumes can be cached."
+            # Read in volume from file
+            volume = skimage.io.imread(self.path)
+            # and slice it
+            volume = volume[tuple(self.data_slice)] if self.data_slice is not None else volume
         # Initialize superclass with the volume
         super(TIFVolumeLoader, self).__init__(volume=volume, transforms=transforms,
-                                              **slicing_config)
\ No newline at end of file
+                                              **slicing_config)
+
+
+class MemmapVolumeLoader(VolumeLoader):
+    """
+    Loader for volumes stored in .npy or raw binary files, which are memory-mapped instead
+    of read to memory. The pages of the file are shared between processes (e.g. the
+    workers of a `torch.utils.data.DataLoader`), and the volume is padded virtually. When
+    pickled, the volume is not copied but mapped again on unpickling.
+    """
+    def __init__(self, path, data_slice=None, dtype=None, shape=None, offset=0, order='C',
+                 mmap_mode='c', transforms=None, name=None, **slicing_config):
+        """
+        Parameters
+        ----------
+        path : str or dict
+            Path to the .npy or raw file (or a dictionary mapping names to paths).
+        data_slice : str or list of slice
+            Slice of the volume to use (optional).
+        dtype : numpy.dtype
+            Data type, required for raw files.
+        shape : tuple
+            Shape of the volume, required for raw files.
+        offset : int
+            Offset (in bytes) of the volume in a raw file.
+        order : {'C', 'F'}
+            Memory layout of the volume in a raw file.
+        mmap_mode : {'r', 'c'}
+            Mode to map the file with. The default ('c', copy-on-write) allows transforms
+            to write to the windows without touching the file.
+        transforms : callable
+            Transforms to apply on the read windows.
+        slicing_config : dict
+            Dictionary specifying the sliding window. Must contain keys 'window_size'
+            and 'stride'.
+        """
+        if isinstance(path, dict):
+            assert name in path.keys()
+            self.path = path.get(name)
+        elif isinstance(path, str):
+            self.path = path
+        else:
+            raise NotImplementedError
+        assert os.path.exists(self.path), "Path {} does not exist.".format(self.path)
+        assert mmap_mode in ['r', 'c']
+
+        if data_slice is None or isinstance(data_slice, (str, list)):
+            self.data_slice = vu.parse_data_slice(data_slice)
+        elif isinstance(data_slice, dict):
+            assert name is not None
+            assert name in data_slice
+            self.data_slice = vu.parse_data_slice(data_slice.get(name))
+        else:
+            raise NotImplementedError
+
+        self.is_npy = self.path.endswith('.npy')
+        if not self.is_npy:
+            assert dtype is not None and shape is not None, \
+                "Data type and shape are required for raw files."
+        self.memmap_config = {'dtype': dtype, 'shape': None if shape is None else tuple(shape),
+                              'offset': offset, 'order': order, 'mmap_mode': mmap_mode}
+
+        slicing_config_for_name = pyu.get_config_for_name(slicing_config, name)
+        assert 'window_size' in slicing_config_for_name
+        assert 'stride' in slicing_config_for_name
+
+        super(MemmapVolumeLoader, self).__init__(volume=self.map_volume(), name=name,
+                                                 transforms=transforms,
+                                                 **slicing_config_for_name)
+
+    def map_volume(self):
+        """Memory-maps the volume (and applies the data slice)."""
+        if self.is_npy:
+            volume = np.load(self.path, mmap_mode=self.memmap_config['mmap_mode'])
+        else:
+            volume = np.memmap(self.path, dtype=self.memmap_config['dtype'],
+                               mode=self.memmap_config['mmap_mode'],
+                               shape=self.memmap_config['shape'],
+                               offset=self.memmap_config['offset'],
+                               order=self.memmap_config['order'])
+        return volume[tuple(self.data_slice)] if self.data_slice is not None else volume
+
+    def __getstate__(self):
+        # Pickling a memmap would copy the volume
+        state = self.__dict__.copy()
+        state['volume'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.volume = self.map_volume()
+
+
+class ChunkedVolumeLoader(VolumeLoader):
+    """
+    Loader for volumes stored as `inferno.io.volumetric.chunked.ChunkedVolume`, which are
+    read lazily (with a thread pool over the chunks of every window).
+    """
+    def __init__(self, path, data_slice=None, transforms=None, name=None, num_threads=1,
+                 cache_size=None, **slicing_config):
+        """
+        Parameters
+        ----------
+        path : str or dict
+            Directory of the chunked volume (or a dictionary mapping names to directories).
+        data_slice : str or list of slice
+            Slice of the volume to use (optional).
+        transforms : callable
+            Transforms to apply on the read windows.
+        num_threads : int
+            Number of threads to read the chunks of a window with. Defaults to 1, since
+            the loader is usually used in several `DataLoader` workers.
+        cache_size : int
+            Budget (in bytes) for caching chunks (optional, see
+            `inferno.io.volumetric.cache.CachedVolume`).
+        slicing_config : dict
+            Dictionary specifying the sliding window. Must contain keys 'window_size'
+            and 'stride'.
+        """
+        if isinstance(path, dict):
+            assert name in path.keys()
+            self.path = path.get(name)
+        elif isinstance(path, str):
+            self.path = path
+        else:
+            raise NotImplementedError
+        assert os.path.exists(self.path), "Path {} does not exist.".format(self.path)
+
+        if data_slice is None or isinstance(data_slice, (str, list)):
+            self.data_slice = vu.parse_data_slice(data_slice)
+        elif isinstance(data_slice, dict):
+            assert name is not None
+            assert name in data_slice
+            self.data_slice = vu.parse_data_slice(data_slice.get(name))
+        else:
+            raise NotImplementedError
+
+        slicing_config_for_name = pyu.get_config_for_name(slicing_config, name)
+        assert 'window_size' in slicing_config_for_name
+        assert 'stride' in slicing_config_for_name
+
+        volume = ChunkedVolume(self.path, data_slice=self.data_slice, num_threads=num_threads)
+        if cache_size is not None:
+            volume = CachedVolume(volume, max_bytes=cache_size)
+        super(ChunkedVolumeLoader, self).__init__(volume=volume, name=name,
+                                                  transforms=transforms,
+                                                  **slicing_config_for_name)
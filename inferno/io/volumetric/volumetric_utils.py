@@ -1,5 +1,6 @@
 import random
 import itertools as it
+import numpy as np
 
 
 # This code is legacy af, don't judge
@@ -78,6 +79,138 @@ def slidingwindowslices(shape, nhoodsize, stride=1, ds=1, window=None, ignorebor
     return it.product(*nslices)
 
 
+def downsampled_shape(shape, factor, mode='mean'):
+    """Gets the shape of a volume of `shape` downsampled with `downsample`."""
+    if mode == 'stride':
+        return tuple(-(-size // f) for size, f in zip(shape, factor))
+    elif mode == 'mean':
+        return tuple(size // f for size, f in zip(shape, factor))
+    else:
+        raise NotImplementedError("Downsampling mode '{}' is not supported.".format(mode))
+
+
+def downsample(volume, factor, mode='mean', out=None, slab_bytes=(64 * 1024 ** 2)):
+    """
+    Downsamples a volume by integer factors. The volume is read slab by slab (along the
+    first axis), such that lazy volumes (and memory maps) are never read to memory as a
+    whole.
+
+    Parameters
+    ----------
+    volume : numpy.ndarray or array-like
+        Volume to downsample.
+    factor : list of int
+        Downsampling factor along every axis.
+    mode : {'mean', 'stride'}
+        If 'mean', blocks of `factor` pixels are averaged (and pixels at the end of an axis
+        which don't fill a block are dropped). If 'stride', every `factor`-th pixel is
+        taken, which is what's required for label volumes.
+    out : numpy.ndarray or array-like
+        Array (e.g. a memory map) to write the downsampled volume to (optional).
+    slab_bytes : int
+        Approximate number of bytes of the volume to read (and process) at once.
+
+    Returns
+    -------
+    numpy.ndarray or array-like
+        The downsampled volume (`out` if given), with the data type of `volume`.
+    """
+    assert len(factor) == volume.ndim
+    shape = downsampled_shape(volume.shape, factor, mode)
+    dtype = np.dtype(volume.dtype)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    assert tuple(out.shape) == shape
+    # Number of downsampled rows per slab (averaging is done in float64)
+    row_bytes = int(np.prod(volume.shape[1:])) * factor[0] * max(dtype.itemsize, 8)
+    num_rows = max(1, slab_bytes // max(row_bytes, 1))
+    for start in range(0, shape[0], num_rows):
+        stop = min(start + num_rows, shape[0])
+        if mode == 'stride':
+            slices = (slice(start * factor[0], min(stop * factor[0], volume.shape[0]),
+                            factor[0]),) + tuple(slice(None, None, f) for f in factor[1:])
+            out[start:stop] = np.asarray(volume[slices])
+            continue
+        slices = (slice(start * factor[0], stop * factor[0]),) + \
+            tuple(slice(0, size * f) for size, f in zip(shape[1:], factor[1:]))
+        slab_shape = (stop - start,) + shape[1:]
+        blocks = np.asarray(volume[slices])\
+            .reshape([dim for size, f in zip(slab_shape, factor) for dim in (size, f)])
+        downsampled = blocks.mean(axis=tuple(range(1, 2 * volume.ndim, 2)))
+        if np.issubdtype(dtype, np.integer):
+            downsampled = np.round(downsampled)
+        out[start:stop] = downsampled.astype(dtype)
+    return out
+
+
+class SlidingWindowIndex(object):
+    """
+    A sequence of sliding window slices which are computed on the fly from the index,
+    instead of being stored. The order of windows is that of `slidingwindowslices` (with
+    `shuffle=False`), i.e. the window start along the last axis changes fastest.
+    """
+    def __init__(self, shape, window_size, stride, ds=1):
+        """
+        Parameters
+        ----------
+        shape : list of int
+            Shape of the volume.
+        window_size : int or list of int
+            Size of the window.
+        stride : int or list of int
+            Stride of the sliding window.
+        ds : int or list of int
+            Step (downsampling) within the window.
+        """
+        ndim = len(shape)
+        self.shape = tuple(shape)
+        self.window_size = tuple([window_size] * ndim if isinstance(window_size, int)
+                                 else window_size)
+        self.stride = tuple([stride] * ndim if isinstance(stride, int) else stride)
+        self.ds = tuple([ds] * ndim if isinstance(ds, int) else ds)
+        assert len(self.window_size) == len(self.stride) == len(self.ds) == ndim
+        # Number of window starts along every axis
+        self.grid_shape = tuple(max((size - window) // stride + 1, 0)
+                                for size, window, stride in zip(self.shape,
+                                                                self.window_size,
+                                                                self.stride))
+        self._length = 1
+        for num_starts in self.grid_shape:
+            self._length *= num_starts
+
+    def __len__(self):
+        return self._length
+
+    def grid_position(self, index):
+        """Decodes the index to the position of the window in the grid of window starts."""
+        index = int(index)
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("Index {} is out of range for {} windows."
+                             .format(index, self._length))
+        position = []
+        for num_starts in reversed(self.grid_shape):
+            index, position_along_axis = divmod(index, num_starts)
+            position.append(position_along_axis)
+        return tuple(reversed(position))
+
+    def __getitem__(self, index):
+        return tuple(slice(position * stride, position * stride + window, ds)
+                     for position, stride, window, ds in zip(self.grid_position(index),
+                                                             self.stride,
+                                                             self.window_size,
+                                                             self.ds))
+
+    def __iter__(self):
+        for index in range(self._length):
+            yield self[index]
+
+    def __repr__(self):
+        return "SlidingWindowIndex(shape={}, window_size={}, stride={}, len={})"\
+            .format(self.shape, self.window_size, self.stride, len(self))
+
+
 def parse_data_slice(data_slice):
     """Parse a dataslice as a list of slice objects."""
     if data_slice is None:
@@ -108,4 +241,69 @@ def parse_data_slice(data_slice):
         # Build slices
         slices.append(slice(start, stop, step))
     # Done.
-    return slices
\ No newline at end of file
+    return slices
+
+
+def reflect_index(index, size):
+    """
+    Maps indices (which may lie outside of `[0, size)`) to `[0, size)` by reflecting at the
+    borders, like `np.pad(..., mode='reflect')` does.
+    """
+    index = np.asarray(index)
+    if size == 1:
+        return np.zeros_like(index)
+    period = 2 * (size - 1)
+    index = np.abs(index) % period
+    return np.where(index >= size, period - index, index)
+
+
+def slice_padded(volume, slices, padding=None):
+    """
+    Slices `volume` as if it were padded with `padding` (in mode 'reflect'), but without
+    padding the volume. Only the axes along which the window crosses the border are
+    gathered from reflected indices; windows in the interior are read with plain slicing
+    (which gives a view for numpy arrays).
+
+    Parameters
+    ----------
+    volume : numpy.ndarray or array-like
+        Volume to slice. Can be anything that supports slicing with a tuple of slices and
+        has a `shape` attribute (e.g. `h5py.Dataset` or `numpy.memmap`).
+    slices : list of slice
+        Slices in the coordinates of the padded volume (with positive steps).
+    padding : list of list of int
+        Padding (before and after) along every axis. Defaults to no padding.
+
+    Returns
+    -------
+    numpy.ndarray
+        The window.
+    """
+    shape = volume.shape
+    if padding is None:
+        padding = [[0, 0]] * len(shape)
+    assert len(slices) == len(shape) == len(padding)
+    read_slices = []
+    gather_indices = []
+    for _slice, (pad_before, pad_after), size in zip(slices, padding, shape):
+        start, stop, step = _slice.indices(size + pad_before + pad_after)
+        assert step > 0, "Only positive steps are supported."
+        start, stop = start - pad_before, stop - pad_before
+        if start >= 0 and stop <= size:
+            read_slices.append(slice(start, stop, step))
+            gather_indices.append(None)
+        else:
+            indices = reflect_index(np.arange(start, stop, step), size)
+            if indices.size == 0:
+                read_slices.append(slice(0, 0))
+                gather_indices.append(None)
+                continue
+            low, high = indices.min(), indices.max() + 1
+            # Read the bounding box, and gather from it
+            read_slices.append(slice(low, high))
+            gather_indices.append(indices - low)
+    window = volume[tuple(read_slices)]
+    for axis, indices in enumerate(gather_indices):
+        if indices is not None:
+            window = np.take(window, indices, axis=axis)
+    return window
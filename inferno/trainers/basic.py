@@ -1,7 +1,6 @@
 import dill
 from datetime import datetime
 import os
-import subprocess
 
 import torch
 from torch.autograd import Variable
@@ -13,6 +12,7 @@ from .callbacks.logging import get_logger
 from ..utils import train_utils as tu
 from ..utils import python_utils as pyu
 from ..utils import torch_utils as thu
+from ..utils import checkpoint_utils as cu
 from ..extensions import metrics
 from ..extensions import optimizers
 from ..extensions import criteria
@@ -61,6 +61,9 @@ class Trainer(object):
         self._loaders = {}
         self._loader_iters = {}
         self._loader_specs = {}
+        # Prefetching
+        self._num_prefetched_batches = {}
+        self._prefetchers = {}
 
         # Iteration and epoch book-keeping
         self._iteration_count = 0
@@ -91,6 +94,13 @@ class Trainer(object):
         self._last_saved_at_epoch = 0
         # This is to allow a callback to trigger a save by setting trainer.save_now = True
         self._save_externally_triggered = False
+        self._save_asynchronously = False
+        self._keep_last_checkpoints = None
+        # The checkpoint writer is built on demand
+        self._checkpoint_writer = None
+
+        # Gradient accumulation
+        self._accumulate_gradients_over = 1
 
         # Stopping conditions
         self._max_num_iterations = None
@@ -99,6 +109,8 @@ class Trainer(object):
         # Callbacks and states
         self._callback_engine = CallbackEngine().bind_trainer(self)
         self._state = {}
+        # States that are not to be materialised lazily
+        self._eagerly_captured_states = set()
 
         # Public
         if model is not None:
@@ -435,6 +447,43 @@ class Trainer(object):
             self.save_to_directory(to_directory)
         return self
 
+    def save_asynchronously(self, yes=True):
+        """
+        Sets whether checkpoints are written to disk on a background thread. Training
+        then only waits for a snapshot of the trainer to be taken.
+        """
+        self._save_asynchronously = yes
+        # The writer is rebuilt on demand
+        self.close_checkpoint_writer()
+        return self
+
+    def keep_last_checkpoints(self, num_checkpoints):
+        """
+        Sets the number of past checkpoints to keep around (in addition to the latest and
+        the best checkpoint). Pass None to keep none.
+        """
+        self._keep_last_checkpoints = num_checkpoints
+        # The writer is rebuilt on demand
+        self.close_checkpoint_writer()
+        return self
+
+    @property
+    def checkpoint_writer(self):
+        """Gets the checkpoint writer."""
+        # Trainers loaded from pickle files might not have '_checkpoint_writer'
+        if getattr(self, '_checkpoint_writer', None) is None:
+            self._checkpoint_writer = \
+                cu.CheckpointWriter(asynchronous=getattr(self, '_save_asynchronously', False),
+                                    keep_last=getattr(self, '_keep_last_checkpoints', None))
+        return self._checkpoint_writer
+
+    def close_checkpoint_writer(self):
+        """Waits for pending checkpoints to be written and shuts down the writer."""
+        if getattr(self, '_checkpoint_writer', None) is not None:
+            self._checkpoint_writer.close()
+            self._checkpoint_writer = None
+        return self
+
     def save_to_directory(self, to_directory):
         assert isinstance(to_directory, str)
         if not os.path.exists(to_directory):
@@ -475,6 +524,36 @@ class Trainer(object):
         self._num_validation_iterations = for_num_iterations
         return self
 
+    @property
+    def accumulating_gradients_over(self):
+        """Gets the number of batches gradients are accumulated over."""
+        # Trainers loaded from pickle files might not have '_accumulate_gradients_over'
+        return getattr(self, '_accumulate_gradients_over', 1)
+
+    def accumulate_gradients_over(self, num_batches):
+        """
+        Accumulate gradients over multiple batches before updating the parameters.
+
+        The gradients are averaged over the batches. Note that an iteration corresponds
+        to a parameter update (i.e. an optimizer step), so the iteration count, frequencies
+        given in iterations and the training iteration callbacks are all with respect to
+        parameter updates and not batches.
+
+        Parameters
+        ----------
+        num_batches : int
+            Number of batches to accumulate gradients over.
+
+        Returns
+        -------
+        Trainer
+            self.
+        """
+        assert isinstance(num_batches, int) and num_batches > 0, \
+            "Number of batches to accumulate gradients over must be a positive integer."
+        self._accumulate_gradients_over = num_batches
+        return self
+
     @property
     def iteration_count(self):
         return self._iteration_count
@@ -551,19 +630,69 @@ class Trainer(object):
         self._state.update({key: value})
         return self
 
+    def update_state_lazily(self, key, value):
+        """
+        Updates the state at `key` without copying `value` to the CPU. The copy is made
+        when (and if) the state is requested with `get_state`, unless the state is to be
+        captured eagerly (see `capture_states_eagerly`).
+
+        Parameters
+        ----------
+        key : str
+            State key.
+        value : torch.autograd.Variable or torch.Tensor or list or tuple or float
+            State value.
+
+        Returns
+        -------
+        Trainer
+            self.
+        """
+        if key in getattr(self, '_eagerly_captured_states', set()):
+            return self.update_state(key, thu.unwrap(value))
+        # Unwrapping without a transfer to the CPU is cheap, and lets go of the graph.
+        return self.update_state(key, tu.LazyState(thu.unwrap(value, to_cpu=False),
+                                                   materialize=thu.unwrap))
+
+    def capture_states_eagerly(self, keys):
+        """
+        Specify the states that should be copied to the CPU as soon as they're updated
+        instead of when they're requested.
+
+        Parameters
+        ----------
+        keys : str or list of str
+            State key(s).
+
+        Returns
+        -------
+        Trainer
+            self.
+        """
+        # Trainers loaded from pickle files might not have '_eagerly_captured_states',
+        # therefore:
+        if not hasattr(self, '_eagerly_captured_states'):
+            setattr(self, '_eagerly_captured_states', set())
+        self._eagerly_captured_states.update(pyu.to_iterable(keys))
+        return self
+
     def update_state_from_model_state_hooks(self):
         if hasattr(self.model, '_state_hooks'):
             state_hooks = getattr(self.model, '_state_hooks')
             if isinstance(state_hooks, dict):
-                # Unwrap variables (or tensors) and
-                self._state.update({state_key: thu.unwrap(state)
-                                    for state_key, state in state_hooks.items()})
+                # Unwrap variables (or tensors) when requested
+                for state_key, state in state_hooks.items():
+                    self.update_state_lazily(state_key, state)
 
     def get_state(self, key, default=None):
         if key in self.DYNAMIC_STATES:
             return getattr(self, self.DYNAMIC_STATES.get(key), default)
-        else:
-            return self._state.get(key, default)
+        state = self._state.get(key, default)
+        if isinstance(state, tu.LazyState):
+            # Materialise the state and hold on to the result for the next get_state
+            state = state.materialize()
+            self._state.update({key: state})
+        return state
 
     @property
     def current_learning_rate(self):
@@ -678,8 +807,88 @@ class Trainer(object):
                 .format(name, set(self._loader_specs.keys()))
         return self._loader_specs.get(name)
 
+    def prefetch(self, num_batches=1, of_loader='train'):
+        """
+        Prefetch batches from a loader on a background thread.
+
+        The prefetched batches are already sent to the device and cast to the right
+        dtype (see `Trainer.wrap_batch`).
+
+        Parameters
+        ----------
+        num_batches : int
+            Number of batches to keep ready. Set to 0 or None to stop prefetching.
+        of_loader : str
+            Name of the loader to prefetch from.
+
+        Returns
+        -------
+        Trainer
+            self.
+        """
+        assert of_loader in ['train', 'validate', 'test']
+        # Trainers loaded from pickle files might not have '_num_prefetched_batches',
+        # therefore:
+        if not hasattr(self, '_num_prefetched_batches'):
+            setattr(self, '_num_prefetched_batches', {})
+        # Stop the current prefetcher (if any), it'll be rebuilt on demand
+        self.stop_prefetching(of_loader)
+        if num_batches:
+            self._num_prefetched_batches.update({of_loader: num_batches})
+        else:
+            self._num_prefetched_batches.pop(of_loader, None)
+        return self
+
+    def is_prefetching(self, from_loader='train'):
+        return bool(getattr(self, '_num_prefetched_batches', {}).get(from_loader))
+
+    def stop_prefetching(self, of_loader=None):
+        # Trainers loaded from pickle files might not have '_prefetchers', therefore:
+        if not hasattr(self, '_prefetchers'):
+            setattr(self, '_prefetchers', {})
+        of_loader = list(self._prefetchers.keys()) if of_loader is None \
+            else pyu.to_iterable(of_loader)
+        for _of_loader in of_loader:
+            prefetcher = self._prefetchers.pop(_of_loader, None)
+            if prefetcher is not None:
+                prefetcher.stop()
+        return self
+
+    def _fetch_next_prefetched_batch(self, from_loader, restart_exhausted_generators,
+                                     update_batch_count,
+                                     update_epoch_count_if_generator_exhausted):
+        # Check if the prefetcher is built
+        if from_loader not in self._prefetchers:
+            self._prefetchers.update({
+                from_loader: tu.BatchPrefetcher(self._loaders[from_loader],
+                                                self._num_prefetched_batches[from_loader],
+                                                process_batch=self.to_device_and_cast)})
+        next_batch = self._prefetchers[from_loader].get()
+        if next_batch is tu.BatchPrefetcher.END_OF_EPOCH:
+            # The prefetcher waits for us to ask for the next epoch. Like with the
+            # iterators, we only keep going if asked to, while the epoch count is
+            # updated on this thread (the callbacks might not be thread-safe).
+            if restart_exhausted_generators:
+                if update_epoch_count_if_generator_exhausted:
+                    self.next_epoch()
+                next_batch = self._prefetchers[from_loader].get()
+                if next_batch is tu.BatchPrefetcher.END_OF_EPOCH:
+                    # Loader is empty
+                    raise StopIteration
+            else:
+                raise StopIteration
+        # Verify
+        self.verify_batch(next_batch, from_loader)
+        if update_batch_count:
+            self._batch_count += 1
+        return next_batch
+
     def fetch_next_batch(self, from_loader='train', restart_exhausted_generators=True,
                          update_batch_count=True, update_epoch_count_if_generator_exhausted=True):
+        if self.is_prefetching(from_loader):
+            return self._fetch_next_prefetched_batch(
+                from_loader, restart_exhausted_generators, update_batch_count,
+                update_epoch_count_if_generator_exhausted)
         # Check if the iterator is built
         if from_loader not in self._loader_iters:
             self._loader_iters.update({from_loader: self._loaders[from_loader].__iter__()})
@@ -749,13 +958,18 @@ class Trainer(object):
 
         self._loader_iters.update({from_loader: self._loaders[from_loader].__iter__()
                                    for from_loader in of_loader})
+        # Prefetchers are restarted on demand
+        self.stop_prefetching([from_loader for from_loader in of_loader
+                               if from_loader in getattr(self, '_prefetchers', {})])
         return self
 
+    def to_device_and_cast(self, batch):
+        # Send to device and cast to the right dtype. Both are no-ops if done already.
+        return self.cast(self.to_device(batch))
+
     def wrap_batch(self, batch, requires_grad=False, volatile=False):
-        # First, send to device
-        batch = self.to_device(batch)
-        # Cast to the right dtype
-        batch = self.cast(batch)
+        # First, send to device and cast to the right dtype
+        batch = self.to_device_and_cast(batch)
         # Second, wrap as variable
         batch = type(batch)([Variable(_batch, requires_grad=requires_grad, volatile=volatile)
                              for _batch in batch])
@@ -836,6 +1050,10 @@ class Trainer(object):
                 self.save()
             run_num += 1
 
+        # Stop prefetching and finish writing checkpoints, we might not be back for a while
+        self.stop_prefetching()
+        self.close_checkpoint_writer()
+
         # Call callback
         self.callbacks.call(self.callbacks.END_OF_FIT,
                             max_num_iterations=max_num_iterations,
@@ -850,8 +1068,13 @@ class Trainer(object):
         # Compute loss
         loss = self.criterion(prediction, target)
         if backward:
-            # Backprop if required
-            loss.backward()
+            # Backprop if required. If gradients are accumulated over multiple batches,
+            # they're averaged.
+            num_accumulated_batches = self.accumulating_gradients_over
+            if num_accumulated_batches > 1:
+                (loss / num_accumulated_batches).backward()
+            else:
+                loss.backward()
         return prediction, loss
 
     def train_for(self, num_iterations=None, break_callback=None):
@@ -879,29 +1102,44 @@ class Trainer(object):
                                 iteration_num=iteration_num)
             # Zero out the grads
             self.optimizer.zero_grad()
-            # No interrupts while computing - a SIGINT could shoot down the driver if
-            # done at the wrong time. Not sure if this has something to do with pinned memory
-            with pyu.delayed_keyboard_interrupt():
-                # Get batch
-                batch = self.fetch_next_batch('train')
-                # Send to device and wrap as variable
-                batch = self.wrap_batch(batch)
-                # Separate inputs from targets
-                inputs, target = self.split_batch(batch, from_loader='train')
-                # Apply model, compute loss and backprop
-                prediction, loss = self.apply_model_and_loss(inputs, target, backward=True)
-            # Compute metric
+            # Gradients are accumulated over one or more batches before the parameters are
+            # updated. An iteration is one parameter update.
+            num_accumulated_batches = self.accumulating_gradients_over
+            accumulated_loss = None
+            for _ in range(num_accumulated_batches):
+                # No interrupts while computing - a SIGINT could shoot down the driver if
+                # done at the wrong time. Not sure if this has something to do with pinned
+                # memory
+                with pyu.delayed_keyboard_interrupt():
+                    # Get batch
+                    batch = self.fetch_next_batch('train')
+                    # Send to device and wrap as variable
+                    batch = self.wrap_batch(batch)
+                    # Separate inputs from targets
+                    inputs, target = self.split_batch(batch, from_loader='train')
+                    # Apply model, compute loss and backprop
+                    prediction, loss = self.apply_model_and_loss(inputs, target,
+                                                                 backward=True)
+                if num_accumulated_batches > 1:
+                    # Keep track of the loss averaged over all accumulated batches
+                    batch_loss = thu.unwrap(loss, to_cpu=False) / num_accumulated_batches
+                    accumulated_loss = batch_loss if accumulated_loss is None \
+                        else accumulated_loss + batch_loss
+            if accumulated_loss is not None:
+                loss = accumulated_loss
+            # Compute metric (on the last batch if gradients are accumulated)
             if self.metric_is_defined:
                 error = self.metric(thu.unwrap(prediction, to_cpu=False),
                                     thu.unwrap(target, to_cpu=False))
-                self.update_state('training_error', thu.unwrap(error))
+                self.update_state_lazily('training_error', error)
             else:
                 error = None
-            # Update state from computation
-            self.update_state('training_inputs', thu.unwrap(inputs))
-            self.update_state('training_target', thu.unwrap(target))
-            self.update_state('training_prediction', thu.unwrap(prediction))
-            self.update_state('training_loss', thu.unwrap(loss))
+            # Update state from computation. The states are copied to the CPU only if
+            # they're requested.
+            self.update_state_lazily('training_inputs', inputs)
+            self.update_state_lazily('training_target', target)
+            self.update_state_lazily('training_prediction', prediction)
+            self.update_state_lazily('training_loss', loss)
             # Update state from model's state hooks
             self.update_state_from_model_state_hooks()
             # Update parameters
@@ -985,13 +1223,13 @@ class Trainer(object):
                 if torch.is_tensor(validation_error):
                     # Convert to float
                     validation_error = validation_error[0]
-                self.update_state('validation_error', thu.unwrap(validation_error))
+                self.update_state_lazily('validation_error', validation_error)
                 validation_error_meter.update(validation_error, n=batch_size)
 
-            self.update_state('validation_input', thu.unwrap(inputs))
-            self.update_state('validation_target', thu.unwrap(target))
-            self.update_state('validation_prediction', thu.unwrap(output))
-            self.update_state('validation_loss', thu.unwrap(loss))
+            self.update_state_lazily('validation_input', inputs)
+            self.update_state_lazily('validation_target', target)
+            self.update_state_lazily('validation_prediction', output)
+            self.update_state_lazily('validation_loss', loss)
             # Update from model's state hooks
             self.update_state_from_model_state_hooks()
 
@@ -1033,6 +1271,11 @@ class Trainer(object):
         # Loader iterators can't be pickled
         if '_loader_iters' in config_dict:
             config_dict.update({'_loader_iters': {}})
+        # Neither can prefetchers or the checkpoint writer (they're rebuilt on demand)
+        if '_prefetchers' in config_dict:
+            config_dict.update({'_prefetchers': {}})
+        if '_checkpoint_writer' in config_dict:
+            config_dict.update({'_checkpoint_writer': None})
         if exclude_loader:
             if '_loaders' in config_dict:
                 config_dict.update({'_loaders': {}})
@@ -1047,18 +1290,52 @@ class Trainer(object):
         self.callbacks.rebind_trainer_to_all_callbacks()
         return self
 
+    def get_checkpoint_snapshot(self, exclude_loader=True):
+        """
+        Takes a snapshot of the trainer to be written as a structured checkpoint (see
+        `inferno.utils.checkpoint_utils.CheckpointSnapshot`).
+
+        The model and the optimizer are checkpointed via their state dictionaries, and the
+        rest of the trainer (sans states) is pickled. The counters are also written to the
+        manifest of the checkpoint, where they can be read without loading the checkpoint.
+        """
+        config_dict = self.get_config(exclude_loader=exclude_loader)
+        # Model and optimizer go in as state dictionaries, and states are not persistent
+        config_dict.update({'_model': None, '_optimizer': None, '_state': {}})
+        if self.optimizer_is_defined:
+            # The optimizer class is referred to by its import path
+            optimizer_class = '{}.{}'.format(type(self.optimizer).__module__,
+                                             type(self.optimizer).__name__)
+            optimizer_defaults = dict(getattr(self.optimizer, 'defaults', {}))
+            optimizer_state_dict = self.optimizer.state_dict()
+        else:
+            optimizer_class = optimizer_defaults = optimizer_state_dict = None
+        state = {'trainer_config': config_dict,
+                 'model_state_dict': self.model.state_dict(),
+                 'optimizer_class': optimizer_class,
+                 'optimizer_defaults': optimizer_defaults,
+                 'optimizer_state_dict': optimizer_state_dict}
+        best_validation_score = self._best_validation_score
+        if best_validation_score is not None:
+            best_validation_score = float(thu.unwrap(best_validation_score, as_numpy=True))
+        counters = {'iteration_count': self._iteration_count,
+                    'epoch_count': self._epoch_count,
+                    'batch_count': self._batch_count,
+                    'best_validation_score': best_validation_score}
+        return cu.CheckpointSnapshot(state, counters=counters)
+
     def save(self, exclude_loader=True, stash_best_checkpoint=True):
         # Log the epoch for save_now
         self._last_saved_at_epoch = self._epoch_count
-        # Save the state dictionary
-        torch.save(self.get_config(exclude_loader=exclude_loader),
-                   os.path.join(self._save_to_directory, 'checkpoint.pytorch'),
-                   pickle_module=dill)
-        if self._is_iteration_with_best_validation_score and stash_best_checkpoint:
-            # Do the stashin'
-            subprocess.Popen(['cp',
-                              os.path.join(self._save_to_directory, 'checkpoint.pytorch'),
-                              os.path.join(self._save_to_directory, 'best_checkpoint.pytorch')])
+        # Take a snapshot of the trainer. This is what the checkpoint writer writes to disk
+        # (possibly while we carry on training).
+        snapshot = self.get_checkpoint_snapshot(exclude_loader=exclude_loader)
+        # Write and do the stashin' (if required)
+        self.checkpoint_writer.write(self._save_to_directory,
+                                     snapshot.write,
+                                     iteration_count=self._iteration_count,
+                                     is_best=(self._is_iteration_with_best_validation_score and
+                                              stash_best_checkpoint))
         # This is required to prevent an infinite save loop?
         self._is_iteration_with_best_validation_score = False
         self.print("Saved to {}.".format(self._save_to_directory))
@@ -1073,21 +1350,76 @@ class Trainer(object):
         return self
 
     def load(self, from_directory=None, best=False):
+        """
+        Loads the trainer from a checkpoint.
+
+        Structured checkpoints (the default) only contain the states of the model and
+        the optimizer, which are loaded into the model (and optimizer) of this trainer.
+        A model must therefore be bound to the trainer before loading from them. Legacy
+        checkpoints (pickled trainers) bring their own model.
+
+        Parameters
+        ----------
+        from_directory : str
+            Directory with the checkpoint. Defaults to the directory checkpoints are saved
+            to.
+        best : bool
+            Whether to load the checkpoint with the best validation score.
+
+        Returns
+        -------
+        Trainer
+            self.
+        """
         from_directory = self._save_to_directory if from_directory is None else from_directory
         assert from_directory is not None, "Nowhere to load from."
+        # Make sure we're not reading a checkpoint that's being written
+        self.close_checkpoint_writer()
         # Get file name
-        file_name = 'best_checkpoint.pytorch' if best else 'checkpoint.pytorch'
-        # Load the dictionary
-        config_dict = torch.load(os.path.join(from_directory, file_name),
-                                 pickle_module=dill)
+        file_name = cu.CheckpointWriter.BEST_CHECKPOINT_FILE_NAME if best \
+            else cu.CheckpointWriter.CHECKPOINT_FILE_NAME
+        file_path = os.path.join(from_directory, file_name)
+        is_structured_checkpoint = cu.is_structured_checkpoint(file_path)
+        # Check before anything is loaded, such that a failed load doesn't leave the trainer
+        # half configured
+        assert not is_structured_checkpoint or self._model is not None, \
+            "A model must be bound to the trainer before loading a structured checkpoint."
+        if not is_structured_checkpoint:
+            # Legacy checkpoint, i.e. a pickled trainer
+            config_dict = torch.load(file_path, pickle_module=dill)
+            # This is required to prevent an infinite save loop?
+            self._is_iteration_with_best_validation_score = False
+            # Set config
+            self.set_config(config_dict)
+            return self
+        # Load the checkpoint. The tensors are memory-mapped, so they're read from disk
+        # as they're copied to the model and the optimizer.
+        state = cu.load_checkpoint(file_path)
+        config_dict = state.get('trainer_config')
+        # Keep the model and optimizer we have, we only load their states
+        config_dict.pop('_model', None)
+        config_dict.pop('_optimizer', None)
+        self.model.load_state_dict(state.get('model_state_dict'))
+        self.set_config(config_dict)
+        if state.get('optimizer_state_dict') is not None:
+            if not self.optimizer_is_defined:
+                self.build_optimizer(pyu.import_from_path(state.get('optimizer_class')),
+                                     **state.get('optimizer_defaults'))
+            self.optimizer.load_state_dict(state.get('optimizer_state_dict'))
         # This is required to prevent an infinite save loop?
         self._is_iteration_with_best_validation_score = False
-        # Set config
-        self.set_config(config_dict)
         return self
 
     def load_model(self, from_directory=None):
         from_directory = self._save_to_directory if from_directory is None else from_directory
+        if os.path.isfile(from_directory) and cu.is_structured_checkpoint(from_directory):
+            # Stream the parameters from the checkpoint to the model we have, one tensor
+            # at a time.
+            assert self._model is not None, \
+                "A model must be bound to the trainer before loading from a checkpoint."
+            with cu.CheckpointReader(from_directory) as reader:
+                reader.load_into(self.model)
+            return self
         # Load the model
         model = torch.load(from_directory, pickle_module=dill)
         # Set model
@@ -1121,8 +1453,15 @@ class Trainer(object):
                 trainer.build_metric(**trainer_config.get('metric_config'))
             if 'checkpoint_config' in trainer_config:
                 trainer.save_every(**trainer_config.get('checkpoint_config'))
+            if trainer_config.get('save_asynchronously'):
+                trainer.save_asynchronously()
+            if 'keep_last_checkpoints' in trainer_config:
+                trainer.keep_last_checkpoints(trainer_config.get('keep_last_checkpoints'))
             if 'validation_config' in trainer_config:
                 trainer.validate_every(**trainer_config.get('validation_config'))
+            if 'accumulate_gradients_over' in trainer_config:
+                trainer.accumulate_gradients_over(
+                    trainer_config.get('accumulate_gradients_over'))
             if 'max_num_iterations' in trainer_config:
                 trainer.set_max_num_iterations(trainer_config.get('max_num_iterations'))
             if 'max_num_epochs' in trainer_config:
@@ -0,0 +1,577 @@
+"""Utilities for writing and reading checkpoints."""
+import copy
+import errno
+import json
+import os
+import re
+import shutil
+import struct
+import threading
+import uuid
+from collections import OrderedDict
+
+import dill
+import numpy as np
+import torch
+
+try:
+    import queue
+except ImportError:
+    # Python 2.7
+    import Queue as queue
+
+# os.replace is atomic on POSIX and Windows, but is not available in Python 2.7
+# (where os.rename is atomic on POSIX).
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _make_temporary_file_name(file_name):
+    directory, base_name = os.path.split(os.path.abspath(file_name))
+    while True:
+        temporary_file_name = os.path.join(directory, '.{}.{}.tmp'.format(base_name,
+                                                                        uuid.uuid4().hex))
+        try:
+            # Unlike tempfile.mkstemp (which makes files only the owner can read), the
+            # file gets the permissions of a file made with open (i.e. 0666 & ~umask)
+            file_descriptor = os.open(temporary_file_name,
+                                      os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+        except OSError as error:
+            if error.errno == errno.EEXIST:
+                continue
+            raise
+        os.close(file_descriptor)
+        return temporary_file_name
+
+
+def atomic_write(file_name, write_function, fsync=True):
+    """
+    Writes a file such that readers either see the old or the new file, but never a
+    partially written one. This is done by writing to a temporary file in the same
+    directory, which is then renamed to `file_name`.
+
+    Parameters
+    ----------
+    file_name : str
+        Name of the file to write.
+    write_function : callable
+        Function that is called with the (binary) file object to write to.
+    fsync : bool
+        Whether to flush the file to disk before renaming it, such that the file is
+        complete even after a system crash.
+    """
+    temporary_file_name = _make_temporary_file_name(file_name)
+    try:
+        with open(temporary_file_name, 'wb') as file_:
+            write_function(file_)
+            if fsync:
+                file_.flush()
+                os.fsync(file_.fileno())
+        _replace(temporary_file_name, file_name)
+    except BaseException:
+        if os.path.exists(temporary_file_name):
+            os.remove(temporary_file_name)
+        raise
+
+
+def atomic_link(source, target):
+    """
+    Atomically makes `target` a hard link to `source`. If the file system does not
+    support hard links, `source` is copied instead (still atomically).
+    """
+    temporary_file_name = _make_temporary_file_name(target)
+    try:
+        os.remove(temporary_file_name)
+        try:
+            os.link(source, temporary_file_name)
+        except (OSError, AttributeError):
+            shutil.copyfile(source, temporary_file_name)
+        _replace(temporary_file_name, target)
+    except BaseException:
+        if os.path.exists(temporary_file_name):
+            os.remove(temporary_file_name)
+        raise
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints to disk, optionally on a background thread.
+
+    Every checkpoint is written atomically to `checkpoint.pytorch` (see `atomic_write`).
+    The best checkpoint is stashed as `best_checkpoint.pytorch` by hard-linking it,
+    and if required, the last few checkpoints are kept as
+    `checkpoint_iteration_<iteration>.pytorch`.
+
+    At most one checkpoint is queued while another is being written, such that
+    the snapshots waiting to be written don't pile up in memory.
+    """
+    CHECKPOINT_FILE_NAME = 'checkpoint.pytorch'
+    BEST_CHECKPOINT_FILE_NAME = 'best_checkpoint.pytorch'
+    HISTORY_FILE_NAME_FORMAT = 'checkpoint_iteration_{}.pytorch'
+    HISTORY_FILE_NAME_PATTERN = re.compile(r'^checkpoint_iteration_(\d+)\.pytorch$')
+
+    def __init__(self, asynchronous=True, keep_last=None):
+        """
+        Parameters
+        ----------
+        asynchronous : bool
+            Whether to write the checkpoints on a background thread.
+        keep_last : int
+            Number of past checkpoints to keep. If None, only the latest
+            (and the best) checkpoint is kept.
+        """
+        assert keep_last is None or (isinstance(keep_last, int) and keep_last > 0), \
+            "The number of checkpoints to keep must be a positive integer."
+        self.asynchronous = asynchronous
+        self.keep_last = keep_last
+        self._queue = None
+        self._thread = None
+        self._exception = None
+
+    def _start(self):
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._write_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write_forever(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._write(*job)
+            except Exception as exception:
+                # Raised on the training thread the next time it comes by
+                self._exception = exception
+            finally:
+                self._queue.task_done()
+
+    def _raise_pending_exception(self):
+        if self._exception is not None:
+            exception, self._exception = self._exception, None
+            raise exception
+
+    def _write(self, to_directory, write_function, iteration_count, is_best):
+        checkpoint_file_name = os.path.join(to_directory, self.CHECKPOINT_FILE_NAME)
+        atomic_write(checkpoint_file_name, write_function)
+        if self.keep_last is not None and iteration_count is not None:
+            atomic_link(checkpoint_file_name,
+                        os.path.join(to_directory,
+                                     self.HISTORY_FILE_NAME_FORMAT.format(iteration_count)))
+            self.prune_history(to_directory)
+        if is_best:
+            atomic_link(checkpoint_file_name,
+                        os.path.join(to_directory, self.BEST_CHECKPOINT_FILE_NAME))
+
+    def prune_history(self, directory):
+        """Removes all but the last `keep_last` past checkpoints in `directory`."""
+        if self.keep_last is None:
+            return self
+        history = []
+        for file_name in os.listdir(directory):
+            match = self.HISTORY_FILE_NAME_PATTERN.match(file_name)
+            if match is not None:
+                history.append((int(match.group(1)), file_name))
+        history.sort()
+        for _, file_name in history[:-self.keep_last]:
+            os.remove(os.path.join(directory, file_name))
+        return self
+
+    def write(self, to_directory, write_function, iteration_count=None, is_best=False):
+        """
+        Writes a checkpoint.
+
+        Parameters
+        ----------
+        to_directory : str
+            Directory to write the checkpoint to.
+        write_function : callable
+            Function that is called with the (binary) file object to write the checkpoint
+            to. If writing asynchronously, it must only depend on a snapshot of the state
+            to be checkpointed, since it's called on the background thread.
+        iteration_count : int
+            Iteration at which the checkpoint is made, used to name the past checkpoints.
+        is_best : bool
+            Whether to stash this checkpoint as the best one.
+
+        Returns
+        -------
+        CheckpointWriter
+            self.
+
+        Raises
+        ------
+        Exception
+            if writing a previous checkpoint failed in the background.
+        """
+        self._raise_pending_exception()
+        job = (to_directory, write_function, iteration_count, is_best)
+        if self.asynchronous:
+            if self._thread is None or not self._thread.is_alive():
+                self._start()
+            self._queue.put(job)
+        else:
+            # Make sure we don't race with writes queued while we were asynchronous
+            self.wait()
+            self._write(*job)
+        return self
+
+    def wait(self):
+        """Waits for all queued checkpoints to be written."""
+        if self._queue is not None:
+            self._queue.join()
+        self._raise_pending_exception()
+        return self
+
+    def close(self):
+        """Waits for all queued checkpoints to be written and stops the background thread."""
+        self.wait()
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = None
+        self._queue = None
+        return self
+
+
+# Structured checkpoints
+# ----------------------
+# A structured checkpoint is a single file with the following layout:
+#   - CHECKPOINT_MAGIC (8 bytes),
+#   - the length of the manifest in bytes (little-endian uint64),
+#   - the manifest, a JSON document with the format version, the counters (e.g. iteration
+#     count), and the location, dtype and shape of all tensors and of the skeleton,
+#   - the data section, which starts at the first multiple of TENSOR_ALIGNMENT after the
+#     manifest. It contains the skeleton (a dill pickle of the checkpointed state, where all
+#     tensors are replaced by `TensorReference`s) and the raw (C-contiguous) tensor data,
+#     each aligned to TENSOR_ALIGNMENT bytes. Offsets in the manifest are with respect to
+#     the start of the data section.
+# Keeping the tensors as raw bytes means they can be memory-mapped when loading.
+CHECKPOINT_MAGIC = b'INFCKPT\x00'
+CHECKPOINT_FORMAT_VERSION = 1
+TENSOR_ALIGNMENT = 64
+# Tensors of these dtypes (which numpy doesn't know about) are stored as raw bits
+_TORCH_DTYPES_STORED_AS = {'bfloat16': 'int16'}
+
+
+def _aligned(num_bytes, alignment=TENSOR_ALIGNMENT):
+    return ((num_bytes + alignment - 1) // alignment) * alignment
+
+
+class TensorReference(object):
+    """Placeholder for a tensor in the skeleton of a structured checkpoint."""
+    def __init__(self, key):
+        self.key = key
+
+    def __repr__(self):
+        return "TensorReference(key={})".format(self.key)
+
+
+def _snapshot_tensor(tensor):
+    # Make a contiguous copy on the CPU that training can't mess with
+    if tensor.is_cuda:
+        return tensor.detach().cpu().contiguous()
+    else:
+        return tensor.detach().clone().contiguous()
+
+
+def _tensor_to_numpy(tensor):
+    dtype_name = str(tensor.dtype).replace('torch.', '')
+    if dtype_name in _TORCH_DTYPES_STORED_AS:
+        tensor = tensor.view(getattr(torch, _TORCH_DTYPES_STORED_AS.get(dtype_name)))
+    return dtype_name, tensor.numpy()
+
+
+def _numpy_to_tensor(array, dtype_name):
+    tensor = torch.from_numpy(array)
+    if dtype_name in _TORCH_DTYPES_STORED_AS:
+        tensor = tensor.view(getattr(torch, dtype_name))
+    return tensor
+
+
+def _flatten_tensors(object_, key, tensors):
+    # Replaces all tensors in (nested) dicts, lists and tuples by references, and
+    # collects snapshots of them in `tensors`.
+    if torch.is_tensor(object_):
+        tensors.update({key: _snapshot_tensor(object_)})
+        return TensorReference(key)
+    elif isinstance(object_, dict):
+        # copy.copy (unlike dict.copy) keeps attributes, e.g. the _metadata of state dicts
+        flattened = copy.copy(object_)
+        for _key, value in object_.items():
+            flattened[_key] = _flatten_tensors(value, '{}/{}'.format(key, _key), tensors)
+        return flattened
+    elif type(object_) in (list, tuple):
+        return type(object_)([_flatten_tensors(value, '{}/{}'.format(key, index), tensors)
+                              for index, value in enumerate(object_)])
+    else:
+        return object_
+
+
+def _unflatten_tensors(object_, get_tensor):
+    # Inverse of _flatten_tensors
+    if isinstance(object_, TensorReference):
+        return get_tensor(object_.key)
+    elif isinstance(object_, dict):
+        unflattened = copy.copy(object_)
+        for _key, value in object_.items():
+            unflattened[_key] = _unflatten_tensors(value, get_tensor)
+        return unflattened
+    elif type(object_) in (list, tuple):
+        return type(object_)([_unflatten_tensors(value, get_tensor) for value in object_])
+    else:
+        return object_
+
+
+class CheckpointSnapshot(object):
+    """
+    A snapshot of a state to be written as a structured checkpoint.
+
+    Taking the snapshot copies all tensors (to the CPU) and pickles everything else, such
+    that it can be written to disk later (e.g. on a background thread) even if the
+    state is modified in the meantime.
+    """
+    def __init__(self, state, counters=None):
+        """
+        Parameters
+        ----------
+        state : dict
+            State to checkpoint. Tensors in (nested) dicts, lists and tuples are stored
+            as raw data, everything else is pickled with dill.
+        counters : dict
+            Counters (e.g. the iteration count) to store in the manifest. Must be JSON
+            serializable.
+        """
+        self.tensors = OrderedDict()
+        self.skeleton = dill.dumps(_flatten_tensors(state, '', self.tensors))
+        self.counters = dict(counters) if counters is not None else {}
+
+    def build_manifest(self):
+        offset = 0
+        skeleton_spec = OrderedDict([('offset', offset), ('nbytes', len(self.skeleton))])
+        offset = _aligned(offset + len(self.skeleton))
+        tensor_specs = OrderedDict()
+        for key, tensor in self.tensors.items():
+            dtype_name, array = _tensor_to_numpy(tensor)
+            tensor_specs[key] = OrderedDict([('dtype', dtype_name),
+                                             ('shape', list(array.shape)),
+                                             ('offset', offset),
+                                             ('nbytes', array.nbytes)])
+            offset = _aligned(offset + array.nbytes)
+        return OrderedDict([('format_version', CHECKPOINT_FORMAT_VERSION),
+                            ('counters', self.counters),
+                            ('skeleton', skeleton_spec),
+                            ('tensors', tensor_specs)])
+
+    def write(self, file_):
+        """Writes the checkpoint to a (binary) file object."""
+        manifest = json.dumps(self.build_manifest()).encode('utf-8')
+        header_nbytes = len(CHECKPOINT_MAGIC) + 8 + len(manifest)
+        file_.write(CHECKPOINT_MAGIC)
+        file_.write(struct.pack('<Q', len(manifest)))
+        file_.write(manifest)
+        file_.write(b'\x00' * (_aligned(header_nbytes) - header_nbytes))
+        # Data section
+        file_.write(self.skeleton)
+        file_.write(b'\x00' * (_aligned(len(self.skeleton)) - len(self.skeleton)))
+        for tensor in self.tensors.values():
+            _, array = _tensor_to_numpy(tensor)
+            # Write from the buffer without making a copy
+            file_.write(memoryview(array.reshape(-1).view(np.uint8)))
+            file_.write(b'\x00' * (_aligned(array.nbytes) - array.nbytes))
+        return self
+
+
+def is_structured_checkpoint(file_name):
+    """Checks whether the file at `file_name` is a structured checkpoint."""
+    with open(file_name, 'rb') as file_:
+        return file_.read(len(CHECKPOINT_MAGIC)) == CHECKPOINT_MAGIC
+
+
+def read_checkpoint_manifest(file_name):
+    """
+    Reads the manifest of a structured checkpoint, without touching the rest of the file.
+
+    Returns
+    -------
+    tuple
+        The manifest (dict) and the offset of the data section in the file (int).
+    """
+    with open(file_name, 'rb') as file_:
+        magic = file_.read(len(CHECKPOINT_MAGIC))
+        assert magic == CHECKPOINT_MAGIC, \
+            "File {} is not a structured checkpoint.".format(file_name)
+        manifest_nbytes, = struct.unpack('<Q', file_.read(8))
+        manifest = json.loads(file_.read(manifest_nbytes).decode('utf-8'),
+                              object_pairs_hook=OrderedDict)
+    assert manifest.get('format_version') == CHECKPOINT_FORMAT_VERSION, \
+        "Unknown checkpoint format version: {}.".format(manifest.get('format_version'))
+    data_offset = _aligned(len(CHECKPOINT_MAGIC) + 8 + manifest_nbytes)
+    return manifest, data_offset
+
+
+class CheckpointReader(object):
+    """
+    Reads structured checkpoints lazily.
+
+    Opening a checkpoint only reads its manifest. Tensors are memory-mapped (copy-on-write)
+    and read from disk when (and if) they're accessed, so it's cheap to inspect the
+    names and shapes of the tensors in a checkpoint, or to load only a few of them.
+
+    Examples
+    --------
+    Compare a parameter across two checkpoints:
+
+        >>> with CheckpointReader('a/checkpoint.pytorch') as a, \\
+        >>>         CheckpointReader('b/checkpoint.pytorch') as b:
+        >>>     difference = a.get_parameter('conv.weight') - b.get_parameter('conv.weight')
+
+    Load the model weights in a checkpoint to a model:
+
+        >>> CheckpointReader('checkpoint.pytorch').load_into(model).close()
+    """
+    # Prefix of the keys of the model parameters in checkpoints made by the trainer
+    MODEL_STATE_PREFIX = '/model_state_dict/'
+
+    def __init__(self, file_name):
+        """
+        Parameters
+        ----------
+        file_name : str
+            Path to the checkpoint.
+        """
+        self.file_name = file_name
+        self.manifest, self._data_offset = read_checkpoint_manifest(file_name)
+        self._data = None
+
+    @property
+    def data(self):
+        """Gets the memory-mapped data section of the checkpoint."""
+        if self._data is None:
+            self._data = np.memmap(self.file_name, dtype=np.uint8, mode='c',
+                                   offset=self._data_offset)
+        return self._data
+
+    @property
+    def counters(self):
+        """Gets the counters (e.g. the iteration count) stored in the manifest."""
+        return self.manifest.get('counters')
+
+    def keys(self, prefix=''):
+        """Gets the keys of all tensors in the checkpoint that start with `prefix`."""
+        return [key for key in self.manifest.get('tensors') if key.startswith(prefix)]
+
+    @property
+    def parameter_names(self):
+        """Gets the names of the model parameters (and buffers) in the checkpoint."""
+        return [key[len(self.MODEL_STATE_PREFIX):]
+                for key in self.keys(prefix=self.MODEL_STATE_PREFIX)]
+
+    def get_spec(self, key):
+        spec = self.manifest.get('tensors').get(key)
+        assert spec is not None, \
+            "Tensor '{}' not found in checkpoint {}.".format(key, self.file_name)
+        return spec
+
+    def get_shape(self, key):
+        """Gets the shape of a tensor without reading it."""
+        return tuple(self.get_spec(key).get('shape'))
+
+    def get_dtype(self, key):
+        """Gets the dtype (name) of a tensor without reading it."""
+        return self.get_spec(key).get('dtype')
+
+    @property
+    def parameter_shapes(self):
+        """Gets a dictionary mapping model parameter names to shapes."""
+        return OrderedDict([(name, self.get_shape(self.MODEL_STATE_PREFIX + name))
+                            for name in self.parameter_names])
+
+    def get_tensor(self, key):
+        """Gets a (memory-mapped) tensor."""
+        spec = self.get_spec(key)
+        dtype_name = spec.get('dtype')
+        array = self.data[spec['offset']:spec['offset'] + spec['nbytes']]\
+            .view(_TORCH_DTYPES_STORED_AS.get(dtype_name, dtype_name))\
+            .reshape(spec['shape'])
+        return _numpy_to_tensor(array, dtype_name)
+
+    def get_parameter(self, name):
+        """Gets a (memory-mapped) model parameter or buffer by its name in the model."""
+        return self.get_tensor(self.MODEL_STATE_PREFIX + name)
+
+    def load_skeleton(self):
+        """Loads the checkpointed state with `TensorReference`s in lieu of tensors."""
+        skeleton_spec = self.manifest.get('skeleton')
+        return dill.loads(self.data[skeleton_spec['offset']:
+                                    skeleton_spec['offset'] + skeleton_spec['nbytes']]
+                          .tobytes())
+
+    def load(self):
+        """Loads the checkpointed state, where all tensors are memory-mapped."""
+        return _unflatten_tensors(self.load_skeleton(), self.get_tensor)
+
+    def load_into(self, model, strict=True):
+        """
+        Copies the model parameters and buffers in the checkpoint to `model`, one tensor
+        at a time. This avoids having all of the checkpoint in memory at once.
+
+        Parameters
+        ----------
+        model : torch.nn.Module
+            Model to load to.
+        strict : bool
+            Whether to require that the parameter and buffer names of the model and the
+            checkpoint match exactly.
+
+        Returns
+        -------
+        CheckpointReader
+            self.
+        """
+        model_state_dict = model.state_dict()
+        checkpoint_names = set(self.parameter_names)
+        if strict:
+            missing = set(model_state_dict.keys()) - checkpoint_names
+            unexpected = checkpoint_names - set(model_state_dict.keys())
+            assert not missing and not unexpected, \
+                "Parameter names of the model and the checkpoint don't match. Missing in " \
+                "checkpoint: {}; unexpected in checkpoint: {}.".format(sorted(missing),
+                                                                      sorted(unexpected))
+        for name, target in model_state_dict.items():
+            if name not in checkpoint_names:
+                continue
+            source = self.get_parameter(name)
+            assert tuple(target.size()) == tuple(source.size()), \
+                "Shape mismatch for parameter '{}': {} in model, {} in checkpoint."\
+                .format(name, tuple(target.size()), tuple(source.size()))
+            target.copy_(source)
+        return self
+
+    def close(self):
+        """Closes the memory-map. Tensors obtained from the reader remain valid."""
+        self._data = None
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        return "CheckpointReader(file_name={}, num_tensors={})"\
+            .format(self.file_name, len(self.manifest.get('tensors')))
+
+
+def load_checkpoint(file_name):
+    """
+    Loads a structured checkpoint. The tensors are memory-mapped (copy-on-write), i.e.
+    they're only read from disk when (and if) they're accessed.
+
+    Returns
+    -------
+    dict
+        The checkpointed state.
+    """
+    return CheckpointReader(file_name).load()
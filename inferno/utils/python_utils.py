@@ -1,4 +1,5 @@
 """Utility functions with no external dependencies."""
+import importlib
 import signal
 
 
@@ -60,3 +61,9 @@ def get_config_for_name(config, name):
         else:
             config_for_name.update({key: val})
     return config_for_name
+
+
+def import_from_path(path):
+    """Imports an object given its full import path, e.g. 'torch.optim.Adam'."""
+    module_name, _, object_name = path.rpartition('.')
+    return getattr(importlib.import_module(module_name), object_name)
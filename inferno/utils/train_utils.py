@@ -1,4 +1,11 @@
 """Utilities for training."""
+import threading
+
+try:
+    import queue
+except ImportError:
+    # Python 2.7
+    import Queue as queue
 
 
 class AverageMeter(object):
@@ -144,6 +151,137 @@ class Frequency(object):
             raise NotImplementedError
 
 
+class BatchPrefetcher(object):
+    """
+    Fetches batches from a data-loader on a background thread and keeps a bounded
+    queue of them ready.
+
+    The loader is iterated over epoch after epoch. When an epoch is exhausted, the
+    marker `BatchPrefetcher.END_OF_EPOCH` is queued in lieu of a batch, such that the
+    consumer (and not the background thread) can take care of the epoch book-keeping.
+    The background thread then pauses until the consumer asks for the next batch after
+    the marker, such that no work is spent on an epoch that might not be needed (e.g.
+    for validation loaders). Exceptions raised while fetching are forwarded to the
+    consumer.
+    """
+    END_OF_EPOCH = 'end_of_epoch'
+
+    def __init__(self, loader, num_batches=1, process_batch=None):
+        """
+        Parameters
+        ----------
+        loader : torch.utils.data.DataLoader or iterable
+            Loader to fetch batches from.
+        num_batches : int
+            Maximum number of batches to keep ready.
+        process_batch : callable
+            Function to apply on every batch on the background thread (e.g. transfer
+            to the device and casting).
+        """
+        assert isinstance(num_batches, int) and num_batches > 0, \
+            "Number of batches to prefetch must be a positive integer."
+        assert process_batch is None or callable(process_batch)
+        self.loader = loader
+        self.num_batches = num_batches
+        self.process_batch = process_batch
+        self._queue = queue.Queue(maxsize=num_batches)
+        self._stop_event = threading.Event()
+        self._next_epoch_event = threading.Event()
+        self._at_end_of_epoch = False
+        self._thread = threading.Thread(target=self._fetch_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        # Wait for a free slot in the queue, but keep an eye on the stop event
+        while not self._stop_event.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fetch_forever(self):
+        while not self._stop_event.is_set():
+            try:
+                for batch in self.loader:
+                    if self.process_batch is not None:
+                        batch = self.process_batch(batch)
+                    if not self._put(batch):
+                        return
+            except Exception as exception:
+                self._put(exception)
+                return
+            if not self._put(self.END_OF_EPOCH):
+                return
+            # Wait until the consumer asks for the next epoch
+            while not self._next_epoch_event.wait(timeout=0.1):
+                if self._stop_event.is_set():
+                    return
+            self._next_epoch_event.clear()
+
+    @property
+    def is_running(self):
+        return self._thread.is_alive()
+
+    def get(self):
+        """
+        Gets the next batch, or `BatchPrefetcher.END_OF_EPOCH` if the loader was exhausted.
+
+        Raises
+        ------
+        Exception
+            if the background thread failed to fetch a batch.
+        """
+        if self._at_end_of_epoch:
+            # Let the background thread start the next epoch
+            self._at_end_of_epoch = False
+            self._next_epoch_event.set()
+        item = self._queue.get()
+        if isinstance(item, Exception):
+            raise item
+        if item is self.END_OF_EPOCH:
+            self._at_end_of_epoch = True
+        return item
+
+    def stop(self):
+        """Stops the background thread and drops all prefetched batches."""
+        self._stop_event.set()
+        # Drain the queue to unblock the background thread
+        while self._thread.is_alive():
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._thread.join(timeout=0.1)
+        return self
+
+
+class LazyState(object):
+    """
+    A trainer state that is materialised only when it's requested.
+
+    This is to avoid copying (say) entire batches to the CPU at every iteration
+    when no one is looking.
+    """
+    def __init__(self, value, materialize):
+        """
+        Parameters
+        ----------
+        value : object
+            The state as is (e.g. a tensor on the GPU).
+        materialize : callable
+            Function to call on `value` to obtain the state.
+        """
+        assert callable(materialize)
+        self.value = value
+        self.materialize_fn = materialize
+
+    def materialize(self):
+        return self.materialize_fn(self.value)
+
+
 class NoLogger(object):
     def __init__(self, logdir=None):
         self.logdir = logdir
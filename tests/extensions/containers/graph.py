@@ -84,5 +84,167 @@ class TestGraph(unittest.TestCase):
         self.assertTrue(history == ['conv0', 'conv1_0', 'conv1_1', 'conv2'] or
                         history == ['conv0', 'conv1_1', 'conv1_2', 'conv2'])
 
+    def test_execution_plan(self):
+        import torch
+        from torch.autograd import Variable
+        from inferno.extensions.containers.graph import Graph
+
+        if not hasattr(self, 'DummyNamedModule'):
+            self.setUp()
+
+        DummyNamedModule = self.DummyNamedModule
+
+        history = []
+        model = Graph()
+        model.add_input_node('input_0')
+        model.add_node('conv0', DummyNamedModule('conv0', history), 'input_0')
+        model.add_output_node('output_0', 'conv0')
+        # The plan is compiled once and cached
+        plan = model.execution_plan
+        self.assertEqual([step.name for step in plan.steps], ['conv0'])
+        self.assertIs(model.execution_plan, plan)
+        model(Variable(torch.rand(10, 10)))
+        self.assertIs(model.execution_plan, plan)
+        # Changing the structure invalidates the plan
+        model.add_node('conv1', DummyNamedModule('conv1', history), 'conv0')
+        model.add_output_node('output_1', 'conv1')
+        self.assertIsNot(model.execution_plan, plan)
+        self.assertEqual([step.name for step in model.execution_plan.steps],
+                         ['conv0', 'conv1'])
+        output_0, output_1 = model(Variable(torch.rand(10, 10)))
+        self.assertTrue(torch.equal(output_0.data, output_1.data))
+        self.assertEqual(history, ['conv0', 'conv0', 'conv1'])
+
+    def test_release_payloads(self):
+        import torch
+        from torch.autograd import Variable
+        from inferno.extensions.containers.graph import Graph
+
+        if not hasattr(self, 'DummyNamedModule'):
+            self.setUp()
+
+        DummyNamedModule = self.DummyNamedModule
+
+        history = []
+        model = Graph()
+        model.add_input_node('input_0')
+        model.add_node('conv0', DummyNamedModule('conv0', history), 'input_0')
+        model.add_node('conv1_0', DummyNamedModule('conv1_0', history), 'conv0')
+        model.add_node('conv1_1', DummyNamedModule('conv1_1', history), 'conv0')
+        model.add_node('conv2', DummyNamedModule('conv2', history, 2),
+                       ['conv1_0', 'conv1_1'])
+        model.add_output_node('output_0', 'conv2')
+        model.add_output_node('output_1', 'conv1_1')
+        # Payloads are released as soon as their last consumer has run
+        release_slots = {step.name: len(step.release_slots)
+                         for step in model.execution_plan.steps}
+        self.assertEqual(release_slots, {'conv0': 1, 'conv1_0': 1, 'conv1_1': 1, 'conv2': 2})
+        input_0 = Variable(torch.rand(10, 10))
+        output_0, output_1 = model(input_0)
+        self.assertTrue(torch.equal(output_0.data, 2 * input_0.data))
+        self.assertTrue(torch.equal(output_1.data, input_0.data))
+        self.assertIsNone(model._payloads)
+        # ... or kept around until the next forward pass
+        model.release_payloads('never')
+        model(input_0)
+        self.assertEqual(len(model._payloads), 7)
+        self.assertTrue(all(payload is not None for payload in model._payloads))
+        # Kept payloads can be forwarded through single nodes
+        self.assertTrue(torch.equal(model.forward_through_node('conv2').data,
+                                    2 * input_0.data))
+        self.assertTrue(torch.equal(model.forward_through_node('conv1_0', input_0).data,
+                                    input_0.data))
+        model.release_payloads('after_forward')
+        model(input_0)
+        self.assertIsNone(model._payloads)
+
+    def test_parallel_branches(self):
+        import torch
+        import copy
+        from torch.autograd import Variable
+        from inferno.extensions.containers.graph import Graph
+
+        if not hasattr(self, 'DummyNamedModule'):
+            self.setUp()
+
+        DummyNamedModule = self.DummyNamedModule
+
+        history = []
+        model = Graph()
+        model.add_input_node('input_0')
+        model.add_node('conv0', DummyNamedModule('conv0', history), 'input_0')
+        model.add_node('conv1_0', DummyNamedModule('conv1_0', history), 'conv0')
+        model.add_node('conv1_1', DummyNamedModule('conv1_1', history), 'conv0')
+        model.add_node('conv1_2', DummyNamedModule('conv1_2', history), 'conv0')
+        model.add_node('conv2', DummyNamedModule('conv2', history, 3),
+                       ['conv1_0', 'conv1_1', 'conv1_2'])
+        model.add_output_node('output_0', 'conv2')
+        model.parallelize_branches(3)
+        self.assertEqual([[step.name for step in level]
+                          for level in model.execution_plan.levels],
+                         [['conv0'], ['conv1_0', 'conv1_1', 'conv1_2'], ['conv2']])
+        input_0 = Variable(torch.rand(10, 10), requires_grad=True)
+        output = model(input_0)
+        self.assertTrue(torch.allclose(output.data, 3 * input_0.data))
+        self.assertEqual(history[0], 'conv0')
+        self.assertEqual(sorted(history[1:4]), ['conv1_0', 'conv1_1', 'conv1_2'])
+        self.assertEqual(history[4], 'conv2')
+        # Gradients flow through the branches
+        output.sum().backward()
+        self.assertTrue(torch.allclose(input_0.grad.data, 3 * torch.ones(10, 10)))
+        # The thread pool is not copied (or pickled)
+        model = copy.deepcopy(model)
+        self.assertIsNone(model._branch_executor)
+        self.assertTrue(model.parallelizing_branches)
+
+    def test_recompute(self):
+        import torch
+        import torch.nn as nn
+        from torch.autograd import Variable
+        from inferno.extensions.containers.graph import Graph
+
+        if not hasattr(self, 'DummyNamedModule'):
+            self.setUp()
+
+        DummyNamedModule = self.DummyNamedModule
+
+        def build_model(history):
+            torch.manual_seed(42)
+            model = Graph()
+            model.add_input_node('input_0')
+            model.add_node('linear0', nn.Linear(10, 10), 'input_0')
+            model.add_node('conv1_0', DummyNamedModule('conv1_0', history), 'linear0')
+            model.add_node('linear1_1', nn.Linear(10, 10), 'linear0')
+            model.add_node('conv2', DummyNamedModule('conv2', history, 2),
+                           ['conv1_0', 'linear1_1'])
+            model.add_node('linear3', nn.Linear(10, 10), 'conv2')
+            model.add_output_node('output_0', 'linear3')
+            return model
+
+        input_0 = torch.rand(4, 10)
+        # Reference without recomputation
+        history = []
+        model = build_model(history)
+        model(Variable(input_0)).sum().backward()
+        expected_grads = [parameter.grad.data.clone() for parameter in model.parameters()]
+        self.assertEqual(history, ['conv1_0', 'conv2'])
+        # Recompute everything between linear0 and conv2
+        history = []
+        model = build_model(history).recompute_path('linear0', 'conv2')
+        self.assertEqual([step.name for step in model.execution_plan.steps],
+                         ['linear0+conv1_0+linear1_1+conv2', 'linear3'])
+        model(Variable(input_0)).sum().backward()
+        # The segment was (at least partially) run again in the backward pass
+        self.assertEqual(history[:3], ['conv1_0', 'conv2', 'conv1_0'])
+        for parameter, expected_grad in zip(model.parameters(), expected_grads):
+            self.assertTrue(torch.allclose(parameter.grad.data, expected_grad))
+        # Nothing is recomputed without gradients
+        history = []
+        model = build_model(history).recompute('conv2')
+        with torch.no_grad():
+            model(Variable(input_0))
+        self.assertEqual(history, ['conv1_0', 'conv2'])
+
+
 if __name__ == '__main__':
     TestGraph().test_graph_basic()
\ No newline at end of file
@@ -0,0 +1,180 @@
+import unittest
+
+
+class TransformTest(unittest.TestCase):
+    def test_apply_on_leading_axes(self):
+        import numpy as np
+        from inferno.io.transform import Transform
+
+        class SumOverImage(Transform):
+            def image_function(self, image):
+                assert image.ndim == 2
+                return image.sum(axis=0)
+
+        class SumOverVolume(Transform):
+            def volume_function(self, volume):
+                assert volume.ndim == 3
+                return volume.sum(axis=0)
+
+        tensor = np.random.uniform(size=(2, 3, 4, 5, 6))
+        self.assertTrue(np.allclose(SumOverImage()(tensor), tensor.sum(axis=3)))
+        self.assertTrue(np.allclose(SumOverImage()(tensor[0, 0]), tensor[0, 0].sum(axis=1)))
+        self.assertTrue(np.allclose(SumOverVolume()(tensor), tensor.sum(axis=2)))
+        self.assertTrue(np.allclose(SumOverVolume()(tensor[0]), tensor[0].sum(axis=1)))
+        with self.assertRaises(NotImplementedError):
+            SumOverVolume()(tensor[0, 0, 0])
+
+    def test_broadcasting_transforms(self):
+        import numpy as np
+        from inferno.io.transform.image import RandomRotate, RandomFlip, CenterCrop
+        from inferno.io.transform.volume import RandomFlip3D, CentralSlice
+
+        tensor = np.random.uniform(size=(2, 3, 4, 6, 6))
+        for transform in [RandomRotate(), RandomFlip(), CenterCrop(4),
+                          RandomFlip3D(), CentralSlice()]:
+            self.assertTrue(transform.BROADCASTS_OVER_LEADING_AXES)
+            transformed = transform(tensor)
+            # Compare with the transform applied image by image (or volume by volume),
+            # with the same random variables
+            if hasattr(transform, 'image_function'):
+                expected = np.array([[[transform.image_function(image) for image in volume]
+                                      for volume in batch] for batch in tensor])
+            else:
+                expected = np.array([[transform.volume_function(volume) for volume in batch]
+                                     for batch in tensor])
+            self.assertTrue(np.array_equal(transformed, expected))
+            self.assertTrue(transformed.flags.c_contiguous)
+
+    def test_noise_on_tensors_of_different_shapes(self):
+        import numpy as np
+        from inferno.io.transform.image import AdditiveGaussianNoise
+        first, second = AdditiveGaussianNoise(sigma=1.)(np.zeros((3, 8, 8)), np.zeros((1, 8, 8)))
+        self.assertEqual(first.shape, (3, 8, 8))
+        self.assertEqual(second.shape, (1, 8, 8))
+        self.assertTrue(np.array_equal(first[0], second[0]))
+
+    def test_fused_compose(self):
+        import numpy as np
+        from inferno.io.transform import Compose
+        from inferno.io.transform.generic import Cast, NormalizeRange, Normalize
+        from inferno.io.transform.image import AdditiveGaussianNoise, RandomFlip
+
+        # Noise with sigma 0 keeps the results deterministic
+        transforms = [Cast('float'), NormalizeRange(255.), Normalize(),
+                      RandomFlip(apply_to=[0]), Normalize(apply_to=[1]),
+                      AdditiveGaussianNoise(sigma=0.)]
+        image = np.random.randint(0, 255, size=(3, 32, 32)).astype('uint8')
+        labels = np.random.randint(0, 255, size=(3, 32, 32)).astype('uint8')
+        fused = Compose(*transforms)
+        self.assertEqual([len(transform) if isinstance(transform, list) else 1
+                          for transform in fused.get_fused_transforms()], [3, 1, 2])
+        # Compare with the transforms run one by one (and without flips)
+        transforms[3].build_random_variables = \
+            lambda **_: transforms[3].set_random_variable('flip_lr', False) or \
+            transforms[3].set_random_variable('flip_ud', False)
+        fused_image, fused_labels = fused(image, labels)
+        unfused = Compose(*transforms)
+        unfused.fuse_elementwise = False
+        unfused_image, unfused_labels = unfused(image, labels)
+        self.assertEqual(fused_image.dtype, np.dtype('float32'))
+        self.assertEqual(unfused_image.dtype, np.dtype('float32'))
+        self.assertTrue(np.allclose(fused_image, unfused_image, atol=1e-5))
+        self.assertTrue(np.allclose(fused_labels, unfused_labels, atol=1e-5))
+        # The inputs are not modified
+        self.assertEqual(image.dtype, np.dtype('uint8'))
+
+    def test_fast_elastic_transform(self):
+        import numpy as np
+        from inferno.io.transform.image import ElasticTransform
+        image = np.random.uniform(size=(64, 48)).astype('float32')
+        # Without displacement, the image is not changed
+        transform = ElasticTransform(alpha=0., sigma=8., fast=True)
+        self.assertTrue(np.allclose(transform(image), image, atol=1e-5))
+        # The field is shared by all images of a stack
+        transform = ElasticTransform(alpha=200., sigma=8., fast=True)
+        stack = np.stack([image, image])
+        transformed = transform(stack)
+        self.assertEqual(transformed.shape, stack.shape)
+        self.assertEqual(transformed.dtype, stack.dtype)
+        self.assertTrue(np.allclose(transformed[0], transformed[1]))
+        self.assertFalse(np.allclose(transformed[0], image))
+        self.assertEqual(transform.make_displacement(image.shape).shape, (2, 64, 48))
+
+    def test_elastic_transform_3d(self):
+        import numpy as np
+        from inferno.io.transform.image import ElasticTransform3D
+        volume = np.random.uniform(size=(16, 32, 32)).astype('float32')
+        labels = np.random.randint(0, 5, size=(16, 32, 32)).astype('uint16')
+        transform = ElasticTransform3D(alpha=500., sigma=[2., 8., 8.], label_indices=[1])
+        transformed_volume, transformed_labels = transform(volume, labels)
+        self.assertEqual(transformed_volume.shape, volume.shape)
+        self.assertEqual(transformed_labels.dtype, labels.dtype)
+        self.assertFalse(np.allclose(transformed_volume, volume))
+        # Labels are not interpolated
+        self.assertTrue(set(np.unique(transformed_labels)) <= set(np.unique(labels)))
+        # Volume and labels are deformed with the same field
+        transform.label_indices = [0, 1]
+        transformed_volume, transformed_labels = transform(labels.astype('float32'), labels)
+        self.assertTrue(np.array_equal(transformed_volume, transformed_labels))
+        # Batches of volumes
+        batch = np.stack([volume, volume])[:, None]
+        self.assertEqual(transform(batch).shape, batch.shape)
+
+    def test_seeding(self):
+        import numpy as np
+        from inferno.io.transform import Compose
+        from inferno.io.transform.image import AdditiveGaussianNoise, RandomFlip
+        from inferno.io.core.data_utils import seed_transforms
+        image = np.random.uniform(size=(16, 16)).astype('float32')
+
+        def make_transforms(seed):
+            return Compose(RandomFlip(), AdditiveGaussianNoise(sigma=1.)).set_seed(seed)
+
+        # The same seed gives the same stream
+        first, second = make_transforms(42), make_transforms(42)
+        for _ in range(3):
+            self.assertTrue(np.array_equal(first(image), second(image)))
+        self.assertFalse(np.array_equal(first(image), make_transforms(43)(image)))
+        # A seed replays the stream
+        noise = AdditiveGaussianNoise(sigma=1., seed=[1, 2])
+        stream = [noise(image) for _ in range(2)]
+        noise.set_seed([1, 2])
+        self.assertTrue(all([np.array_equal(noise(image), expected) for expected in stream]))
+
+        # Seeding the transforms of a dataset
+        class Dataset(object):
+            def __init__(self):
+                self.transforms = make_transforms(0)
+        first, second = seed_transforms(Dataset(), [7, 0]), seed_transforms(Dataset(), [7, 0])
+        self.assertTrue(np.array_equal(first.transforms(image), second.transforms(image)))
+
+    def test_seeding_in_workers(self):
+        import numpy as np
+        import torch
+        from torch.utils.data import DataLoader, Dataset
+        from inferno.io.transform.image import AdditiveGaussianNoise
+
+        class NoiseDataset(Dataset):
+            def __init__(self, seed):
+                self.transforms = AdditiveGaussianNoise(sigma=1., seed=seed)
+
+            def __len__(self):
+                return 4
+
+            def __getitem__(self, index):
+                return self.transforms(np.zeros((2, 2), dtype='float32'))
+
+        def draw(seed, num_workers):
+            loader = DataLoader(NoiseDataset(seed), batch_size=1, num_workers=num_workers)
+            return torch.cat(list(loader)).numpy()
+
+        # Seeds are kept in workers
+        self.assertTrue(np.array_equal(draw(0, 1), draw(0, 1)))
+        self.assertFalse(np.array_equal(draw(0, 1), draw(1, 1)))
+        # Workers don't share streams
+        samples = draw(0, 2)
+        self.assertFalse(np.array_equal(samples[0], samples[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
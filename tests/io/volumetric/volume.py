@@ -0,0 +1,322 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+
+class TestVolumeLoader(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_lazy_hdf5(self):
+        import pickle
+        import numpy as np
+        import h5py as h5
+        from inferno.io.volumetric import HDF5VolumeLoader, LazyHDF5Volume
+
+        path = os.path.join(self.temp_dir, 'volume.h5')
+        volume = np.random.uniform(size=(20, 30, 40)).astype('float32')
+        with h5.File(path, 'w') as h5file:
+            h5file.create_dataset('data', data=volume, chunks=(5, 10, 10))
+
+        slicing_config = {'window_size': [4, 8, 8], 'stride': [3, 5, 6],
+                          'padding': [[2, 2], [3, 3], [4, 4]]}
+        eager = HDF5VolumeLoader(path, 'data', data_slice='2:18, :, 1:39:2',
+                                 **slicing_config)
+        lazy = HDF5VolumeLoader(path, 'data', data_slice='2:18, :, 1:39:2', lazy=True,
+                                **slicing_config)
+        self.assertIsInstance(lazy.volume, LazyHDF5Volume)
+        self.assertEqual(lazy.volume.shape, (16, 30, 19))
+        self.assertEqual(len(lazy), len(eager))
+        for index in range(len(eager)):
+            self.assertTrue(np.array_equal(lazy[index], eager[index]))
+        # The file handle is not pickled, but reopened
+        lazy = pickle.loads(pickle.dumps(lazy))
+        self.assertIsNone(lazy.volume._dataset)
+        self.assertTrue(np.array_equal(lazy[3], eager[3]))
+
+    def test_cached_hdf5(self):
+        import numpy as np
+        import h5py as h5
+        from inferno.io.volumetric import HDF5VolumeLoader, CachedVolume
+
+        path = os.path.join(self.temp_dir, 'volume.h5')
+        volume = np.random.uniform(size=(20, 30, 40)).astype('float32')
+        with h5.File(path, 'w') as h5file:
+            h5file.create_dataset('data', data=volume, chunks=(5, 10, 10))
+
+        slicing_config = {'window_size': [5, 10, 10], 'stride': [2, 5, 5],
+                          'padding': [[1, 1], [2, 2], [3, 3]]}
+        eager = HDF5VolumeLoader(path, 'data', data_slice='1:19, :, ::3', **slicing_config)
+        cached = HDF5VolumeLoader(path, 'data', data_slice='1:19, :, ::3', lazy=True,
+                                  cache_size=(20 * 30 * 40 * 4), **slicing_config)
+        self.assertIsInstance(cached.volume, CachedVolume)
+        self.assertEqual(cached.volume.block_shape, (5, 10, 10))
+        for index in range(len(eager)):
+            self.assertTrue(np.array_equal(cached[index], eager[index]))
+        # The cache fits the entire volume, so every chunk is read exactly once
+        cache = cached.volume.cache
+        self.assertEqual(cache.misses, 4 * 3 * 4)
+        self.assertGreater(cache.hits, cache.misses)
+        self.assertEqual(cache.evictions, 0)
+        # With a budget of a single chunk, chunks are evicted
+        cached = HDF5VolumeLoader(path, 'data', data_slice='1:19, :, ::3', lazy=True,
+                                  cache_size=(5 * 10 * 10 * 4), **slicing_config)
+        for index in range(len(eager)):
+            self.assertTrue(np.array_equal(cached[index], eager[index]))
+        self.assertEqual(len(cached.volume.cache), 1)
+        self.assertGreater(cached.volume.cache.evictions, 0)
+        # Volumes sharing a cache don't share blocks
+        other = CachedVolume(cached.volume.volume, cache=cache)
+        self.assertNotEqual(other.token, cached.volume.token)
+
+    def test_sliding_window_index(self):
+        import numpy as np
+        from inferno.io.core import Zip
+        from inferno.io.volumetric import VolumeLoader
+        from inferno.io.volumetric import volumetric_utils as vu
+
+        shape, window_size, stride = [13, 20, 31], [4, 6, 5], [3, 4, 7]
+        index = vu.SlidingWindowIndex(shape, window_size, stride)
+        expected = list(vu.slidingwindowslices(shape, window_size, stride, shuffle=False))
+        self.assertEqual(len(index), len(expected))
+        self.assertEqual(list(index), expected)
+        self.assertEqual(index[-1], expected[-1])
+        with self.assertRaises(IndexError):
+            index[len(expected)]
+        # Synced and zipped loaders share the index
+        raw = VolumeLoader(np.random.uniform(size=shape), window_size, stride)
+        labels = VolumeLoader(np.random.uniform(size=shape), window_size, stride)
+        zipped = Zip(raw, labels, sync=True)
+        self.assertIs(labels.base_sequence, raw.base_sequence)
+        self.assertEqual(len(zipped), len(expected))
+        self.assertEqual(zipped.base_sequence[5], (expected[5], expected[5]))
+        fetched_raw, fetched_labels = zipped[5]
+        self.assertTrue(np.array_equal(fetched_raw, raw.volume[expected[5]]))
+        self.assertTrue(np.array_equal(fetched_labels, labels.volume[expected[5]]))
+
+    def test_memmap(self):
+        import pickle
+        import numpy as np
+        from inferno.io.volumetric import VolumeLoader, MemmapVolumeLoader
+
+        volume = np.random.uniform(size=(20, 30, 40)).astype('float32')
+        npy_path = os.path.join(self.temp_dir, 'volume.npy')
+        raw_path = os.path.join(self.temp_dir, 'volume.raw')
+        np.save(npy_path, volume)
+        volume.tofile(raw_path)
+
+        slicing_config = {'window_size': [4, 8, 8], 'stride': [3, 5, 6],
+                          'padding': [[2, 2], [3, 3], [4, 4]]}
+        eager = VolumeLoader(volume[2:18], **slicing_config)
+        loaders = [MemmapVolumeLoader(npy_path, data_slice='2:18, :, :', **slicing_config),
+                   MemmapVolumeLoader(raw_path, data_slice='2:18, :, :', dtype='float32',
+                                      shape=(20, 30, 40), **slicing_config)]
+        for loader in loaders:
+            self.assertIsInstance(loader.volume, np.memmap)
+            self.assertEqual(len(loader), len(eager))
+            for index in range(len(eager)):
+                self.assertTrue(np.array_equal(loader[index], eager[index]))
+            # The volume is mapped again instead of being pickled
+            pickled = pickle.dumps(loader)
+            self.assertLess(len(pickled), volume.nbytes)
+            loader = pickle.loads(pickled)
+            self.assertIsInstance(loader.volume, np.memmap)
+            self.assertTrue(np.array_equal(loader[7], eager[7]))
+
+    def test_virtual_padding(self):
+        import numpy as np
+        from inferno.io.volumetric import VolumeLoader
+
+        volume = np.random.uniform(size=(10, 17, 1))
+        slicing_config = {'window_size': [4, 8, 1], 'stride': [3, 2, 1],
+                          'padding': [[5, 3], [2, 9], [2, 2]]}
+        padded = VolumeLoader(volume, pad_virtually=False, **slicing_config)
+        loader = VolumeLoader(volume, **slicing_config)
+        self.assertIs(loader.volume, volume)
+        self.assertEqual(loader.shape, padded.volume.shape)
+        self.assertEqual(len(loader), len(padded))
+        num_views = 0
+        for index in range(len(loader)):
+            window = loader[index]
+            self.assertTrue(np.array_equal(window, padded[index]))
+            num_views += np.shares_memory(window, volume)
+        # Only the windows crossing the border are copies
+        self.assertGreater(num_views, 0)
+        self.assertLess(num_views, len(loader))
+
+    def test_lazy_tif(self):
+        import numpy as np
+        import tifffile
+        from inferno.io.volumetric import TIFVolumeLoader, LazyTIFVolume
+
+        path = os.path.join(self.temp_dir, 'volume.tif')
+        volume = np.random.randint(0, 255, size=(12, 30, 40)).astype('uint8')
+        tifffile.imwrite(path, volume)
+
+        slicing_config = {'window_size': [3, 8, 8], 'stride': [2, 5, 6],
+                          'padding': [[1, 1], [3, 3], [4, 4]]}
+        eager = TIFVolumeLoader(path, data_slice='1:11, :, 2:', **slicing_config)
+        lazy = TIFVolumeLoader(path, data_slice='1:11, :, 2:', lazy=True, **slicing_config)
+        self.assertIsInstance(lazy.volume, LazyTIFVolume)
+        self.assertEqual(lazy.volume.shape, eager.volume.shape)
+        for index in range(len(eager)):
+            self.assertTrue(np.array_equal(lazy[index], eager[index]))
+        # Every page was decoded once
+        self.assertEqual(lazy.volume.page_cache.misses, 10)
+        # Single pages have no page axis, like when read eagerly
+        tifffile.imwrite(path, volume[0])
+        slicing_config = {'window_size': [8, 8], 'stride': [5, 6]}
+        eager = TIFVolumeLoader(path, **slicing_config)
+        lazy = TIFVolumeLoader(path, lazy=True, **slicing_config)
+        self.assertEqual(lazy.volume.shape, (30, 40))
+        self.assertEqual(lazy.volume.shape, eager.volume.shape)
+        for index in range(len(eager)):
+            self.assertTrue(np.array_equal(lazy[index], eager[index]))
+
+    def test_chunked(self):
+        import numpy as np
+        from inferno.io.volumetric import VolumeLoader, ChunkedVolumeLoader, ChunkedVolume
+
+        directory = os.path.join(self.temp_dir, 'volume')
+        volume = np.random.uniform(size=(20, 30, 40)).astype('float32')
+        chunked = ChunkedVolume.from_array(directory, volume, chunks=(8, 16, 16),
+                                           num_threads=4)
+        self.assertEqual(chunked.chunk_grid_shape, (3, 2, 3))
+        self.assertTrue(np.array_equal(chunked[:], volume))
+        self.assertTrue(np.array_equal(chunked[3:17, 5:29:2, 30:], volume[3:17, 5:29:2, 30:]))
+        # Partial writes, and chunks that were never written
+        empty = ChunkedVolume.create(os.path.join(self.temp_dir, 'empty'), shape=(20, 30, 40),
+                                     chunks=(8, 16, 16), dtype='int64', fill_value=-1)
+        empty[5:10, 10:20, 0:1] = 3
+        expected = np.full((20, 30, 40), -1, dtype='int64')
+        expected[5:10, 10:20, 0:1] = 3
+        self.assertTrue(np.array_equal(empty[:], expected))
+        self.assertEqual(len(os.listdir(empty.directory)), 1 + 4)
+        # Load windows
+        slicing_config = {'window_size': [4, 8, 8], 'stride': [3, 5, 6],
+                          'padding': [[2, 2], [3, 3], [4, 4]]}
+        eager = VolumeLoader(volume[2:18], **slicing_config)
+        loader = ChunkedVolumeLoader(directory, data_slice='2:18, :, :', **slicing_config)
+        self.assertEqual(len(loader), len(eager))
+        for index in range(len(eager)):
+            self.assertTrue(np.array_equal(loader[index], eager[index]))
+
+    def test_pyramid(self):
+        import numpy as np
+        from inferno.io.volumetric import VolumeLoader, PyramidVolumeLoader
+        from inferno.io.volumetric import volumetric_utils as vu
+
+        volume = np.random.uniform(size=(32, 48)).astype('float32')
+        slicing_config = {'window_size': [8, 8], 'stride': [4, 4], 'padding': [[4, 4], [4, 4]]}
+        loader = PyramidVolumeLoader(volume, scales=[0, 2], downsampling_ratio=2,
+                                     **slicing_config)
+        base = VolumeLoader(volume, **slicing_config)
+        self.assertEqual(len(loader), len(base))
+        for index in range(len(base)):
+            window, context = loader[index]
+            self.assertTrue(np.array_equal(window, base[index]))
+            self.assertEqual(context.shape, (8, 8))
+        # Levels are computed once
+        self.assertEqual(sorted(loader._levels.keys()), [0, 1, 2])
+        level_2 = vu.downsample(volume, [4, 4])
+        self.assertTrue(np.allclose(loader.get_level(2), level_2, atol=1e-6))
+        self.assertIs(loader.get_level(2), loader.get_level(2))
+        # The context is centred on the window: the window [12, 20) x [16, 24) (without
+        # padding) is centred on (3.5, 4.5) in level 2
+        index = list(loader.base_sequence).index((slice(16, 24, 1), slice(20, 28, 1)))
+        window, context = loader[index]
+        self.assertTrue(np.array_equal(window, volume[12:20, 16:24]))
+        self.assertTrue(np.allclose(context, level_2[0:8, 1:9], atol=1e-6))
+
+    def test_pyramid_levels_on_disk(self):
+        import pickle
+        import numpy as np
+        from inferno.io.volumetric import PyramidVolumeLoader, ChunkedVolume
+        from inferno.io.volumetric import volumetric_utils as vu
+
+        volume = np.random.randint(0, 100, size=(37, 21, 18)).astype('uint8')
+        chunked = ChunkedVolume.from_array(os.path.join(self.temp_dir, 'volume'), volume,
+                                           chunks=(8, 8, 8))
+        # Downsampling lazy volumes slab by slab
+        for mode in ['mean', 'stride']:
+            expected = vu.downsample(volume, [2, 3, 2], mode=mode)
+            self.assertTrue(np.array_equal(vu.downsample(chunked, [2, 3, 2], mode=mode,
+                                                         slab_bytes=1000), expected))
+        loader = PyramidVolumeLoader(chunked, window_size=[4, 4, 4], stride=[4, 4, 4],
+                                     scales=[0, 1, 2],
+                                     level_directory=os.path.join(self.temp_dir, 'levels'))
+        loader.precompute_levels()
+        self.assertIsInstance(loader.get_level(2), np.memmap)
+        self.assertTrue(np.array_equal(loader.get_level(2),
+                                       vu.downsample(vu.downsample(volume, [2, 2, 2]),
+                                                     [2, 2, 2])))
+        # Levels are sent along when pickled
+        unpickled = pickle.loads(pickle.dumps(loader))
+        self.assertEqual(sorted(unpickled._levels.keys()), [0, 1, 2])
+        for index in [0, len(loader) - 1]:
+            for window, expected in zip(unpickled[index], loader[index]):
+                self.assertTrue(np.array_equal(window, expected))
+
+    def test_weighted_sampler(self):
+        import numpy as np
+        from inferno.io.core import Zip
+        from inferno.io.volumetric import VolumeLoader, WeightedWindowSampler
+
+        labels = np.zeros((20, 30, 40), dtype='uint8')
+        labels[2:6, 10:20, 5:9] = 1
+        slicing_config = {'window_size': [4, 6, 8], 'stride': [2, 4, 6],
+                          'padding': [[2, 2], [0, 0], [4, 4]]}
+        raw_loader = VolumeLoader(np.random.uniform(size=labels.shape), **slicing_config)
+        label_loader = VolumeLoader(labels, **slicing_config)
+        dataset = Zip(raw_loader, label_loader, sync=True)
+        cache_path = os.path.join(self.temp_dir, 'statistics.npy')
+        sampler = WeightedWindowSampler(label_loader, weighting=lambda fraction: fraction,
+                                        num_samples=100, cache_path=cache_path)
+        # Compare with the statistics computed from the windows
+        expected = np.array([label_loader[index].mean() for index in range(len(dataset))])
+        self.assertTrue(np.allclose(sampler.statistics, expected))
+        # Too large summed-area tables fall back to reading the windows
+        sampler.MAX_TABLE_BYTES = 0
+        self.assertTrue(np.allclose(sampler.compute_statistics(), expected))
+        # Only windows with foreground are drawn
+        indices = list(sampler)
+        self.assertEqual(len(indices), 100)
+        self.assertTrue(all([expected[index] > 0 for index in indices]))
+        # Statistics are loaded from the cache
+        self.assertTrue(os.path.exists(cache_path))
+        np.save(cache_path, np.ones(len(dataset)))
+        sampler = WeightedWindowSampler(label_loader, cache_path=cache_path)
+        self.assertTrue(np.array_equal(sampler.statistics, np.ones(len(dataset))))
+
+    def test_sliding_window_prediction(self):
+        import numpy as np
+        import torch
+        from inferno.io.volumetric import SlidingWindowPredictor, ChunkedVolume
+
+        volume = np.random.uniform(size=(19, 30, 23)).astype('float32')
+        model = torch.nn.Conv3d(1, 2, 1)
+        model.weight.data[:] = 1.
+        model.bias.data[:] = torch.Tensor([0., 1.])
+        expected = np.stack([volume, volume + 1])
+        for blending in ['constant', 'gaussian']:
+            predictor = SlidingWindowPredictor(model, window_size=[6, 8, 8], stride=[4, 5, 6],
+                                               padding=[2, 3, 0], batch_size=3,
+                                               blending=blending)
+            prediction = predictor.predict(volume)
+            self.assertEqual(prediction.shape, (2, 19, 30, 23))
+            self.assertTrue(np.allclose(prediction, expected, atol=1e-5))
+        # Stream to a chunked volume
+        output = ChunkedVolume.create(os.path.join(self.temp_dir, 'prediction'),
+                                      shape=(2, 19, 30, 23), chunks=(1, 5, 16, 16),
+                                      dtype='float32')
+        predictor.predict(volume, output=output)
+        self.assertTrue(np.allclose(output[:], expected, atol=1e-5))
+        self.assertTrue(model.training)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -30,6 +30,20 @@ class TestTrainer(TestCase):
                                 nn.Softmax())
         return toy_net
 
+    @staticmethod
+    def _make_dummy_dataset(length, input_shape=(3, 8, 8), num_inputs=1, num_targets=1):
+        from torch.utils.data.dataset import Dataset
+        import torch
+
+        class DummyDataset(Dataset):
+            def __len__(self):
+                return length
+
+            def __getitem__(self, item):
+                return tuple([torch.rand(*input_shape) for _ in range(num_inputs)] +
+                             [torch.rand(1).uniform_() for _ in range(num_targets)])
+        return DummyDataset()
+
     def test_cifar(self):
         from inferno.trainers.basic import Trainer
         from inferno.io.box.cifar10 import get_cifar10_loaders
@@ -62,23 +76,10 @@ class TestTrainer(TestCase):
         print("[*] Elapsed time: {} seconds.".format(toc - tic))
 
     def test_multi_io(self):
-        from torch.utils.data.dataset import Dataset
         from torch.utils.data.dataloader import DataLoader
         from inferno.trainers.basic import Trainer
         import torch
 
-        class DummyDataset(Dataset):
-            def __len__(self):
-                return 42
-
-            def __getitem__(self, item):
-                # 2 inputs and 3 targets (say)
-                return torch.rand(3, 32, 32), \
-                       torch.rand(3, 32, 32), \
-                       torch.rand(1).uniform_(), \
-                       torch.rand(1).uniform_(), \
-                       torch.rand(1).uniform_()
-
         class DummyNetwork(torch.nn.Module):
             def __init__(self):
                 super(DummyNetwork, self).__init__()
@@ -96,7 +97,9 @@ class TestTrainer(TestCase):
                 assert len(predictions) == len(targets) == 3
                 return predictions[0].mean()
 
-        loader = DataLoader(DummyDataset())
+        # 2 inputs and 3 targets (say)
+        loader = DataLoader(self._make_dummy_dataset(42, input_shape=(3, 32, 32),
+                                                     num_inputs=2, num_targets=3))
         net = DummyNetwork()
 
         trainer = Trainer(net)\
@@ -107,6 +110,150 @@ class TestTrainer(TestCase):
 
         trainer.fit()
 
+    def test_prefetch(self):
+        from torch.utils.data.dataloader import DataLoader
+        from inferno.trainers.basic import Trainer
+        import torch
+
+        class DummyNetwork(torch.nn.Module):
+            def __init__(self):
+                super(DummyNetwork, self).__init__()
+                self.conv = torch.nn.Conv2d(3, 1, 3, padding=1)
+
+            def forward(self, input):
+                return self.conv(input).view(input.size(0), -1).mean(1)
+
+        loader = DataLoader(self._make_dummy_dataset(10), batch_size=2)
+        trainer = Trainer(DummyNetwork())\
+            .build_criterion('MSELoss')\
+            .build_optimizer('Adam')\
+            .set_max_num_iterations(12)\
+            .bind_loader('train', loader)\
+            .prefetch(3)
+        trainer.fit()
+        # 5 batches per epoch
+        self.assertEqual(trainer.iteration_count, 12)
+        self.assertEqual(trainer.epoch_count, 2)
+        self.assertEqual(trainer._batch_count, 2)
+        # Prefetchers are shut down at the end of fit
+        self.assertEqual(trainer._prefetchers, {})
+
+    def test_prefetcher_pauses_at_end_of_epoch(self):
+        import time
+        from inferno.utils.train_utils import BatchPrefetcher
+
+        class CountingLoader(object):
+            def __init__(self):
+                self.num_epochs = 0
+
+            def __iter__(self):
+                self.num_epochs += 1
+                return iter(range(3))
+
+        loader = CountingLoader()
+        prefetcher = BatchPrefetcher(loader, num_batches=5)
+        self.assertEqual([prefetcher.get() for _ in range(4)],
+                         [0, 1, 2, BatchPrefetcher.END_OF_EPOCH])
+        # The next epoch is only started when asked for
+        time.sleep(0.3)
+        self.assertEqual(loader.num_epochs, 1)
+        self.assertEqual(prefetcher.get(), 0)
+        self.assertEqual(loader.num_epochs, 2)
+        prefetcher.stop()
+        self.assertFalse(prefetcher.is_running)
+
+    def test_lazy_states(self):
+        from torch.utils.data.dataloader import DataLoader
+        from inferno.trainers.basic import Trainer
+        from inferno.utils.train_utils import LazyState
+        import torch
+
+        net = torch.nn.Sequential(torch.nn.Conv2d(3, 1, 3), torch.nn.AdaptiveAvgPool2d(1))
+        trainer = Trainer(net)\
+            .build_criterion('MSELoss')\
+            .build_optimizer('Adam')\
+            .set_max_num_iterations(2)\
+            .bind_loader('train', DataLoader(self._make_dummy_dataset(4), batch_size=2))\
+            .capture_states_eagerly('training_loss')
+        trainer.fit()
+        # Eagerly captured states are not lazy
+        self.assertNotIsInstance(trainer._state['training_loss'], LazyState)
+        # The others are until requested
+        self.assertIsInstance(trainer._state['training_inputs'], LazyState)
+        training_inputs = trainer.get_state('training_inputs')
+        self.assertEqual(list(training_inputs[0].size()), [2, 3, 8, 8])
+        self.assertNotIsInstance(trainer._state['training_inputs'], LazyState)
+
+    def test_gradient_accumulation(self):
+        from torch.utils.data.dataloader import DataLoader
+        from inferno.trainers.basic import Trainer
+        import torch
+
+        class CountingCallback(object):
+            def __init__(self):
+                self.num_calls = 0
+
+            def end_of_training_iteration(self, **_):
+                self.num_calls += 1
+
+            def __call__(self, **kwargs):
+                self.end_of_training_iteration(**kwargs)
+
+        net = torch.nn.Sequential(torch.nn.Conv2d(3, 1, 3), torch.nn.AdaptiveAvgPool2d(1))
+        trainer = Trainer.build(net,
+                                criterion_config={'method': 'MSELoss'},
+                                optimizer_config={'method': 'Adam'},
+                                accumulate_gradients_over=3,
+                                max_num_iterations=4)
+        callback = CountingCallback()
+        trainer.register_callback(callback)
+        trainer.bind_loader('train', DataLoader(self._make_dummy_dataset(10), batch_size=2))
+        trainer.fit()
+        # 4 optimizer steps over 3 batches each, with 5 batches per epoch
+        self.assertEqual(trainer.iteration_count, 4)
+        self.assertEqual(callback.num_calls, 4)
+        self.assertEqual(trainer.epoch_count, 2)
+        self.assertEqual(trainer._batch_count, 2)
+
+    def test_checkpoint(self):
+        from torch.utils.data.dataloader import DataLoader
+        from inferno.trainers.basic import Trainer
+        import torch
+        import tempfile
+        import shutil
+
+        def make_net():
+            return torch.nn.Sequential(torch.nn.Conv2d(3, 1, 3),
+                                       torch.nn.AdaptiveAvgPool2d(1))
+
+        save_directory = tempfile.mkdtemp()
+        try:
+            net = make_net()
+            trainer = Trainer(net)\
+                .build_criterion('MSELoss')\
+                .build_optimizer('Adam', lr=0.01)\
+                .save_every((3, 'iterations'), to_directory=save_directory)\
+                .save_asynchronously()\
+                .set_max_num_iterations(3)\
+                .bind_loader('train', DataLoader(self._make_dummy_dataset(4), batch_size=2))
+            trainer.fit()
+            # Load to a fresh model and trainer
+            loaded_trainer = Trainer(make_net()).load(from_directory=save_directory)
+            self.assertEqual(loaded_trainer.iteration_count, 3)
+            self.assertEqual(loaded_trainer.epoch_count, 1)
+            self.assertEqual(type(loaded_trainer.optimizer).__name__, 'Adam')
+            self.assertEqual(loaded_trainer.current_learning_rate, 0.01)
+            for parameter, loaded_parameter in zip(net.parameters(),
+                                                   loaded_trainer.model.parameters()):
+                self.assertTrue(torch.equal(parameter.data, loaded_parameter.data))
+            # Without a model, nothing is loaded
+            trainer_without_model = Trainer()
+            with self.assertRaises(AssertionError):
+                trainer_without_model.load(from_directory=save_directory)
+            self.assertEqual(trainer_without_model.iteration_count, 0)
+        finally:
+            shutil.rmtree(save_directory)
+
     def test_serialization(self):
         from inferno.trainers.basic import Trainer
         import os
@@ -0,0 +1,108 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+
+class TestCheckpointUtils(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_checkpoint_writer(self):
+        from inferno.utils.checkpoint_utils import CheckpointWriter
+        writer = CheckpointWriter(asynchronous=True, keep_last=2)
+        for iteration_count in range(1, 5):
+            content = str(iteration_count).encode()
+            writer.write(self.directory, lambda file_, content=content: file_.write(content),
+                         iteration_count=iteration_count, is_best=(iteration_count == 2))
+        writer.close()
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['best_checkpoint.pytorch',
+                          'checkpoint.pytorch',
+                          'checkpoint_iteration_3.pytorch',
+                          'checkpoint_iteration_4.pytorch'])
+        with open(os.path.join(self.directory, 'checkpoint.pytorch'), 'rb') as f:
+            self.assertEqual(f.read(), b'4')
+        with open(os.path.join(self.directory, 'best_checkpoint.pytorch'), 'rb') as f:
+            self.assertEqual(f.read(), b'2')
+
+    def test_checkpoint_writer_failure(self):
+        from inferno.utils.checkpoint_utils import CheckpointWriter
+
+        def failing_write_function(file_):
+            file_.write(b'incomplete')
+            raise RuntimeError
+
+        writer = CheckpointWriter(asynchronous=True)
+        writer.write(self.directory, failing_write_function)
+        with self.assertRaises(RuntimeError):
+            writer.wait()
+        writer.close()
+        # Nothing (not even a temporary file) is left behind
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_structured_checkpoint(self):
+        import torch
+        from inferno.utils.checkpoint_utils import CheckpointSnapshot, load_checkpoint, \
+            read_checkpoint_manifest, atomic_write
+        state = {'weights': {'conv.weight': torch.rand(4, 3, 3, 3),
+                             'conv.bias': torch.rand(4),
+                             'steps': torch.tensor(5)},
+                 'history': [torch.arange(6).view(2, 3), 'not a tensor'],
+                 'name': 'checkpoint'}
+        file_name = os.path.join(self.directory, 'checkpoint.pytorch')
+        snapshot = CheckpointSnapshot(state, counters={'iteration_count': 42})
+        # Tensors are snapshotted
+        state['weights']['conv.bias'].zero_()
+        atomic_write(file_name, snapshot.write)
+        # The file has the permissions of a file made with open
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(os.stat(file_name).st_mode & 0o777, 0o666 & ~umask)
+        # Read manifest only
+        manifest, _ = read_checkpoint_manifest(file_name)
+        self.assertEqual(manifest['counters']['iteration_count'], 42)
+        self.assertEqual(manifest['tensors']['/weights/conv.weight']['shape'], [4, 3, 3, 3])
+        # Load everything
+        loaded = load_checkpoint(file_name)
+        self.assertEqual(loaded['name'], 'checkpoint')
+        self.assertEqual(loaded['history'][1], 'not a tensor')
+        self.assertTrue(torch.equal(loaded['history'][0], torch.arange(6).view(2, 3)))
+        self.assertTrue(torch.equal(loaded['weights']['conv.weight'],
+                                    state['weights']['conv.weight']))
+        self.assertFalse(torch.equal(loaded['weights']['conv.bias'],
+                                     state['weights']['conv.bias']))
+        self.assertEqual(int(loaded['weights']['steps']), 5)
+
+    def test_checkpoint_reader(self):
+        import torch
+        from inferno.utils.checkpoint_utils import CheckpointSnapshot, CheckpointReader, \
+            atomic_write, load_checkpoint
+        model = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3), torch.nn.BatchNorm2d(4))
+        file_name = os.path.join(self.directory, 'checkpoint.pytorch')
+        atomic_write(file_name,
+                     CheckpointSnapshot({'model_state_dict': model.state_dict()}).write)
+        with CheckpointReader(file_name) as reader:
+            self.assertEqual(reader.parameter_names, list(model.state_dict().keys()))
+            self.assertEqual(reader.parameter_shapes['0.weight'], (4, 3, 3, 3))
+            self.assertTrue(torch.equal(reader.get_parameter('0.bias'), model[0].bias.data))
+            # Stream to a fresh model
+            other_model = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3),
+                                              torch.nn.BatchNorm2d(4))
+            reader.load_into(other_model)
+        for name, tensor in other_model.state_dict().items():
+            self.assertTrue(torch.equal(tensor, model.state_dict()[name]))
+        # The metadata of the state dict (e.g. module versions) survives the round trip
+        loaded = load_checkpoint(file_name)['model_state_dict']
+        self.assertEqual(loaded._metadata, model.state_dict()._metadata)
+        # Shape mismatch
+        with self.assertRaises(AssertionError):
+            CheckpointReader(file_name).load_into(torch.nn.Sequential(torch.nn.Conv2d(3, 5, 3),
+                                                                      torch.nn.BatchNorm2d(5)))
+
+
+if __name__ == '__main__':
+    unittest.main()